@@ -7,7 +7,7 @@ import os
 import time
 from collections.abc import AsyncGenerator
 from pathlib import Path
-from typing import Any, Union, cast
+from typing import Any, Optional, Union, cast
 
 from azure.cognitiveservices.speech import (
     ResultReason,
@@ -16,7 +16,9 @@ from azure.cognitiveservices.speech import (
     SpeechSynthesisResult,
     SpeechSynthesizer,
 )
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.core.rest import AsyncHttpResponse
 from azure.identity.aio import (
     AzureDeveloperCliCredential,
     ManagedIdentityCredential,
@@ -28,7 +30,7 @@ from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.storage.blob.aio import ContainerClient
 from azure.storage.blob.aio import StorageStreamDownloader as BlobDownloader
-from azure.storage.filedatalake.aio import FileSystemClient
+from azure.storage.filedatalake.aio import DataLakeFileClient, FileSystemClient
 from azure.storage.filedatalake.aio import StorageStreamDownloader as DatalakeDownloader
 from openai import AsyncAzureOpenAI, AsyncOpenAI
 from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
@@ -40,12 +42,12 @@ from opentelemetry.instrumentation.openai import OpenAIInstrumentor
 from quart import (
     Blueprint,
     Quart,
+    Response,
     abort,
     current_app,
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
 from quart_cors import cors
@@ -71,9 +73,12 @@ from config import (
     CONFIG_CREDENTIAL,
     CONFIG_DEFAULT_REASONING_EFFORT,
     CONFIG_GPT4V_DEPLOYED,
+    CONFIG_HTTP_SESSION,
     CONFIG_INGESTER,
     CONFIG_LANGUAGE_PICKER_ENABLED,
     CONFIG_OPENAI_CLIENT,
+    CONFIG_QUERY_EMBEDDING_CACHE,
+    CONFIG_QUERY_EMBEDDING_CACHE_BACKEND,
     CONFIG_QUERY_REWRITING_ENABLED,
     CONFIG_REASONING_EFFORT_ENABLED,
     CONFIG_SEARCH_CLIENT,
@@ -91,6 +96,8 @@ from config import (
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import QueryEmbeddingCache
+from core.imageshelper import PageImageCache
 from core.sessionhelper import create_session_id
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
@@ -101,6 +108,7 @@ from prepdocs import (
     setup_search_info,
 )
 from prepdocslib.filestrategy import UploadUserFileStrategy
+from prepdocslib.httpsession import create_http_session
 from prepdocslib.listfilestrategy import File
 
 bp = Blueprint("routes", __name__, static_folder="static")
@@ -131,6 +139,27 @@ async def assets(path):
     return await send_from_directory(Path(__file__).resolve().parent / "static" / "assets", path)
 
 
+# Files served from storage are downloaded and streamed to the client in chunks of this size
+CONTENT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def parse_byte_range(range_header: Optional[str]) -> Optional[tuple[int, Optional[int]]]:
+    """
+    Parses a Range header with a single range of bytes, such as bytes=0-1023 or bytes=1024-,
+    returning its first byte and its last byte if given.
+    Returns None for other ranges, such as suffix or multiple ranges, so that the whole file is served instead.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    first, _, last = range_header[len("bytes=") :].strip().partition("-")
+    if not first.isdigit() or (last and not last.isdigit()):
+        return None
+    start, end = int(first), int(last) if last else None
+    if end is not None and end < start:
+        return None
+    return start, end
+
+
 @bp.route("/content/<path>")
 @authenticated_path
 async def content_file(path: str, auth_claims: dict[str, Any]):
@@ -139,7 +168,8 @@ async def content_file(path: str, auth_claims: dict[str, Any]):
     *** NOTE *** if you are using app services authentication, this route will return unauthorized to all users that are not logged in
     if AZURE_ENFORCE_ACCESS_CONTROL is not set or false, logged in users can access all files regardless of access control
     if AZURE_ENFORCE_ACCESS_CONTROL is set to true, logged in users can only access files they have access to
-    This is also slow and memory hungry.
+    Files are streamed from storage in chunks. A single range of bytes can be requested with a Range header,
+    so PDF viewers only load the pages they show, and If-None-Match is answered with 304 when the file is unchanged.
     """
     # Remove page number from path, filename-1.txt -> filename.txt
     # This shouldn't typically be necessary as browsers don't send hash fragments to servers
@@ -147,33 +177,72 @@ async def content_file(path: str, auth_claims: dict[str, Any]):
         path_parts = path.rsplit("#page=", 1)
         path = path_parts[0]
     current_app.logger.info("Opening file %s", path)
+    download_args: dict[str, Any] = {}
+    byte_range = parse_byte_range(request.headers.get("Range"))
+    if byte_range:
+        start, end = byte_range
+        download_args["offset"] = start
+        download_args["length"] = None if end is None else end - start + 1
+    if if_none_match := request.headers.get("If-None-Match"):
+        download_args["etag"] = if_none_match
+        download_args["match_condition"] = MatchConditions.IfModified
     blob_container_client: ContainerClient = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+    blob_client = blob_container_client.get_blob_client(path)
+    file_client: Optional[DataLakeFileClient] = None
     blob: Union[BlobDownloader, DatalakeDownloader]
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
-    except ResourceNotFoundError:
-        current_app.logger.info("Path not found in general Blob container: %s", path)
-        if current_app.config[CONFIG_USER_UPLOAD_ENABLED]:
-            try:
-                user_oid = auth_claims["oid"]
-                user_blob_container_client = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
-                user_directory_client: FileSystemClient = user_blob_container_client.get_directory_client(user_oid)
-                file_client = user_directory_client.get_file_client(path)
-                blob = await file_client.download_file()
-            except ResourceNotFoundError:
-                current_app.logger.exception("Path not found in DataLake: %s", path)
+        try:
+            blob = await blob_client.download_blob(**download_args)
+        except ResourceNotFoundError:
+            current_app.logger.info("Path not found in general Blob container: %s", path)
+            if current_app.config[CONFIG_USER_UPLOAD_ENABLED]:
+                try:
+                    user_oid = auth_claims["oid"]
+                    user_blob_container_client = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
+                    user_directory_client: FileSystemClient = user_blob_container_client.get_directory_client(user_oid)
+                    file_client = user_directory_client.get_file_client(path)
+                    blob = await file_client.download_file(**download_args)
+                except ResourceNotFoundError:
+                    current_app.logger.exception("Path not found in DataLake: %s", path)
+                    abort(404)
+            else:
                 abort(404)
-        else:
-            abort(404)
+    except HttpResponseError as error:
+        if error.status_code == 304:
+            # A 304 carries the validator that a 200 would have sent, the If-None-Match header may list several
+            etag = cast(AsyncHttpResponse, error.response).headers.get("ETag") if error.response is not None else None
+            return "", 304, {"ETag": etag} if etag else {}
+        if error.status_code == 416:
+            if file_client is not None:
+                size = (await file_client.get_file_properties()).size
+            else:
+                size = (await blob_client.get_blob_properties()).size
+            return "", 416, {"Content-Range": f"bytes */{size}"}
+        raise
     if not blob.properties or not blob.properties.has_key("content_settings"):
         abort(404)
     mime_type = blob.properties["content_settings"]["content_type"]
     if mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+
+    async def stream_chunks() -> AsyncGenerator[bytes, None]:
+        async for chunk in blob.chunks():
+            yield chunk
+
+    response = Response(stream_chunks(), status=206 if byte_range else 200, mimetype=mime_type)
+    response.content_length = blob.size
+    response.accept_ranges = "bytes"
+    if blob.properties.etag:
+        response.headers["ETag"] = blob.properties.etag
+    if blob.properties.last_modified:
+        response.last_modified = blob.properties.last_modified
+    if byte_range:
+        # The range reported by the SDK ends at the requested byte, which may be past the end of the file,
+        # so the range is rebuilt from the bytes actually sent. Only blob downloads report the total size of the file,
+        # the size of data lake files is left unknown.
+        total_size = (blob.properties.get("content_range") or "/*").rpartition("/")[2]
+        response.headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[0] + blob.size - 1}/{total_size}"
+    return response
 
 
 @bp.route("/ask", methods=["POST"])
@@ -386,6 +455,8 @@ async def upload(auth_claims: dict[str, Any]):
     file_io.seek(0)
     ingester: UploadUserFileStrategy = current_app.config[CONFIG_INGESTER]
     await ingester.add_file(File(content=file_io, acls={"oids": [user_oid]}, url=file_client.url))
+    # The user may now access a file that was denied before
+    current_app.config[CONFIG_AUTH_CLIENT].invalidate_path_auth(user_oid)
     return jsonify({"message": "File uploaded successfully"}), 200
 
 
@@ -401,6 +472,7 @@ async def delete_uploaded(auth_claims: dict[str, Any]):
     await file_client.delete_file()
     ingester = current_app.config[CONFIG_INGESTER]
     await ingester.remove_file(filename, user_oid)
+    current_app.config[CONFIG_AUTH_CLIENT].invalidate_path_auth(user_oid)
     return jsonify({"message": f"File {filename} deleted successfully"}), 200
 
 
@@ -488,6 +560,13 @@ async def setup_clients():
     USE_CHAT_HISTORY_BROWSER = os.getenv("USE_CHAT_HISTORY_BROWSER", "").lower() == "true"
     USE_CHAT_HISTORY_COSMOS = os.getenv("USE_CHAT_HISTORY_COSMOS", "").lower() == "true"
     USE_AGENTIC_RETRIEVAL = os.getenv("USE_AGENTIC_RETRIEVAL", "").lower() == "true"
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE") or 1000)
+    QUERY_EMBEDDING_CACHE_TTL = int(os.getenv("QUERY_EMBEDDING_CACHE_TTL") or 3600)
+    QUERY_EMBEDDING_CACHE_STATS_INTERVAL = int(os.getenv("QUERY_EMBEDDING_CACHE_STATS_INTERVAL") or 1000)
+    PATH_AUTH_CACHE_SIZE = int(os.getenv("PATH_AUTH_CACHE_SIZE") or 10000)
+    PATH_AUTH_CACHE_TTL = int(os.getenv("PATH_AUTH_CACHE_TTL") or 60)
+    GROUPS_CACHE_TTL = int(os.getenv("GROUPS_CACHE_TTL") or 300)
+    PAGE_IMAGE_CACHE_SIZE_MB = int(os.getenv("PAGE_IMAGE_CACHE_SIZE_MB") or 64)
 
     # WEBSITE_HOSTNAME is always set by App Service, RUNNING_IN_PRODUCTION is set in main.bicep
     RUNNING_ON_AZURE = os.getenv("WEBSITE_HOSTNAME") is not None or os.getenv("RUNNING_IN_PRODUCTION") is not None
@@ -520,6 +599,10 @@ async def setup_clients():
     # Set the Azure credential in the app config for use in other parts of the app
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
 
+    # One session per worker for the aiohttp requests, so connections to Entra, Graph and Vision are reused
+    http_session = create_http_session()
+    current_app.config[CONFIG_HTTP_SESSION] = http_session
+
     # Set up clients for AI Search and Storage
     search_client = SearchClient(
         endpoint=AZURE_SEARCH_ENDPOINT,
@@ -531,7 +614,11 @@ async def setup_clients():
     )
 
     blob_container_client = ContainerClient(
-        f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", AZURE_STORAGE_CONTAINER, credential=azure_credential
+        f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        AZURE_STORAGE_CONTAINER,
+        credential=azure_credential,
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE,
     )
 
     # Set up authentication helper
@@ -554,6 +641,10 @@ async def setup_clients():
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
         enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
         enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
+        path_auth_cache_size=PATH_AUTH_CACHE_SIZE,
+        path_auth_cache_ttl=PATH_AUTH_CACHE_TTL,
+        groups_cache_ttl=GROUPS_CACHE_TTL,
+        http_session=http_session,
     )
 
     if USE_USER_UPLOAD:
@@ -566,6 +657,8 @@ async def setup_clients():
             f"https://{AZURE_USERSTORAGE_ACCOUNT}.dfs.core.windows.net",
             AZURE_USERSTORAGE_CONTAINER,
             credential=azure_credential,
+            max_single_get_size=CONTENT_CHUNK_SIZE,
+            max_chunk_get_size=CONTENT_CHUNK_SIZE,
         )
         current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT] = user_blob_container_client
 
@@ -685,6 +778,20 @@ async def setup_clients():
 
     prompt_manager = PromptyManager()
 
+    # Shared by all approaches, so a query embedded for /chat is reused by /ask. A size of 0 disables the cache.
+    # An EmbeddingCacheBackend set in the app config before serving lets the workers share their embeddings.
+    query_embedding_cache = (
+        QueryEmbeddingCache(
+            max_size=QUERY_EMBEDDING_CACHE_SIZE,
+            ttl=QUERY_EMBEDDING_CACHE_TTL,
+            backend=current_app.config.get(CONFIG_QUERY_EMBEDDING_CACHE_BACKEND),
+            stats_log_interval=QUERY_EMBEDDING_CACHE_STATS_INTERVAL,
+        )
+        if QUERY_EMBEDDING_CACHE_SIZE > 0
+        else None
+    )
+    current_app.config[CONFIG_QUERY_EMBEDDING_CACHE] = query_embedding_cache
+
     # Set up the two default RAG approaches for /ask and /chat
     # RetrieveThenReadApproach is used by /ask for single-turn Q&A
     current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
@@ -707,6 +814,7 @@ async def setup_clients():
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
         prompt_manager=prompt_manager,
         reasoning_effort=OPENAI_REASONING_EFFORT,
+        query_embedding_cache=query_embedding_cache,
     )
 
     # ChatReadRetrieveReadApproach is used by /chat for multi-turn conversation
@@ -730,6 +838,7 @@ async def setup_clients():
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
         prompt_manager=prompt_manager,
         reasoning_effort=OPENAI_REASONING_EFFORT,
+        query_embedding_cache=query_embedding_cache,
     )
 
     if USE_GPT4V:
@@ -750,6 +859,12 @@ async def setup_clients():
             )
 
         token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
+        # Shared by both vision approaches, so a page image sent for /chat is reused by /ask. A size of 0 disables it.
+        page_image_cache = (
+            PageImageCache(max_size_bytes=PAGE_IMAGE_CACHE_SIZE_MB * 1024 * 1024)
+            if PAGE_IMAGE_CACHE_SIZE_MB > 0
+            else None
+        )
 
         current_app.config[CONFIG_ASK_VISION_APPROACH] = RetrieveThenReadVisionApproach(
             search_client=search_client,
@@ -769,6 +884,9 @@ async def setup_clients():
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
             prompt_manager=prompt_manager,
+            query_embedding_cache=query_embedding_cache,
+            http_session=http_session,
+            page_image_cache=page_image_cache,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -791,6 +909,9 @@ async def setup_clients():
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
             prompt_manager=prompt_manager,
+            query_embedding_cache=query_embedding_cache,
+            http_session=http_session,
+            page_image_cache=page_image_cache,
         )
 
 
@@ -800,6 +921,10 @@ async def close_clients():
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
         await current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT].close()
+    if current_app.config.get(CONFIG_HTTP_SESSION):
+        await current_app.config[CONFIG_HTTP_SESSION].close()
+    if current_app.config.get(CONFIG_QUERY_EMBEDDING_CACHE):
+        current_app.config[CONFIG_QUERY_EMBEDDING_CACHE].log_stats()
 
 
 def create_app():
@@ -35,6 +35,8 @@ from openai.types.chat import (
 
 from approaches.promptmanager import PromptManager
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import QueryEmbeddingCache
+from prepdocslib.httpsession import use_http_session
 
 
 @dataclass
@@ -155,6 +157,8 @@ class Approach(ABC):
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
         reasoning_effort: Optional[str] = None,
+        query_embedding_cache: Optional[QueryEmbeddingCache] = None,
+        http_session: Optional[aiohttp.ClientSession] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -170,6 +174,8 @@ class Approach(ABC):
         self.vision_token_provider = vision_token_provider
         self.prompt_manager = prompt_manager
         self.reasoning_effort = reasoning_effort
+        self.query_embedding_cache = query_embedding_cache
+        self.http_session = http_session
         self.include_token_usage = True
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
@@ -365,18 +371,27 @@ class Approach(ABC):
         dimensions_args: ExtraArgs = (
             {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
         )
-        embedding = await self.openai_client.embeddings.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-            **dimensions_args,
-        )
-        query_vector = embedding.data[0].embedding
+
+        async def create_embedding() -> list[float]:
+            embedding = await self.openai_client.embeddings.create(
+                # Azure OpenAI takes the deployment name as the model name
+                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
+                input=q,
+                **dimensions_args,
+            )
+            return embedding.data[0].embedding
+
+        if self.query_embedding_cache:
+            query_vector = await self.query_embedding_cache.get_or_compute(
+                self.embedding_model, self.embedding_dimensions, q, create_embedding
+            )
+        else:
+            query_vector = await create_embedding()
         # This performs an oversampling due to how the search index was setup,
         # so we do not need to explicitly pass in an oversampling parameter here
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields=self.embedding_field)
 
-    async def compute_image_embedding(self, q: str):
+    async def compute_image_embedding(self, q: str) -> VectorizedQuery:
         endpoint = urljoin(self.vision_endpoint, "computervision/retrieval:vectorizeText")
         headers = {"Content-Type": "application/json"}
         params = {"api-version": "2024-02-01", "model-version": "2023-04-15"}
@@ -384,7 +399,7 @@ class Approach(ABC):
 
         headers["Authorization"] = "Bearer " + await self.vision_token_provider()
 
-        async with aiohttp.ClientSession() as session:
+        async with use_http_session(self.http_session) as session:
             async with session.post(
                 url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
             ) as response:
@@ -16,6 +16,7 @@ from approaches.approach import DataPoints, ExtraInfo, ThoughtStep
 from approaches.chatapproach import ChatApproach
 from approaches.promptmanager import PromptManager
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import QueryEmbeddingCache
 
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -47,6 +48,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         query_speller: str,
         prompt_manager: PromptManager,
         reasoning_effort: Optional[str] = None,
+        query_embedding_cache: Optional[QueryEmbeddingCache] = None,
     ):
         self.search_client = search_client
         self.search_index_name = search_index_name
@@ -70,6 +72,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.query_rewrite_tools = self.prompt_manager.load_tools("chat_query_rewrite_tools.json")
         self.answer_prompt = self.prompt_manager.load_prompt("chat_answer_question.prompty")
         self.reasoning_effort = reasoning_effort
+        self.query_embedding_cache = query_embedding_cache
         self.include_token_usage = True
 
     async def run_until_final_call(
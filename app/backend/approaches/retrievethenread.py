@@ -9,6 +9,7 @@ from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
 from approaches.approach import Approach, DataPoints, ExtraInfo, ThoughtStep
 from approaches.promptmanager import PromptManager
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import QueryEmbeddingCache
 
 
 class RetrieveThenReadApproach(Approach):
@@ -40,6 +41,7 @@ class RetrieveThenReadApproach(Approach):
         query_speller: str,
         prompt_manager: PromptManager,
         reasoning_effort: Optional[str] = None,
+        query_embedding_cache: Optional[QueryEmbeddingCache] = None,
     ):
         self.search_client = search_client
         self.search_index_name = search_index_name
@@ -62,6 +64,7 @@ class RetrieveThenReadApproach(Approach):
         self.prompt_manager = prompt_manager
         self.answer_prompt = self.prompt_manager.load_prompt("ask_answer_question.prompty")
         self.reasoning_effort = reasoning_effort
+        self.query_embedding_cache = query_embedding_cache
         self.include_token_usage = True
 
     async def run(
@@ -1,7 +1,10 @@
+import asyncio
 from collections.abc import Awaitable
 from typing import Any, Callable, Optional
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorQuery
 from azure.storage.blob.aio import ContainerClient
 from openai import AsyncOpenAI
 from openai.types.chat import (
@@ -11,7 +14,8 @@ from openai.types.chat import (
 from approaches.approach import Approach, DataPoints, ExtraInfo, ThoughtStep
 from approaches.promptmanager import PromptManager
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.embeddingcache import QueryEmbeddingCache
+from core.imageshelper import PageImageCache, fetch_images
 
 
 class RetrieveThenReadVisionApproach(Approach):
@@ -41,6 +45,9 @@ class RetrieveThenReadVisionApproach(Approach):
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
         prompt_manager: PromptManager,
+        query_embedding_cache: Optional[QueryEmbeddingCache] = None,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        page_image_cache: Optional[PageImageCache] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -60,6 +67,9 @@ class RetrieveThenReadVisionApproach(Approach):
         self.vision_token_provider = vision_token_provider
         self.prompt_manager = prompt_manager
         self.answer_prompt = self.prompt_manager.load_prompt("ask_answer_question_vision.prompty")
+        self.query_embedding_cache = query_embedding_cache
+        self.http_session = http_session
+        self.page_image_cache = page_image_cache
         # Currently disabled due to issues with rendering token usage in the UI
         self.include_token_usage = False
 
@@ -91,12 +101,15 @@ class RetrieveThenReadVisionApproach(Approach):
         send_images_to_gptvision = overrides.get("gpt4v_input") in ["textAndImages", "images", None]
 
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
+        vectors: list[VectorQuery] = []
         if use_vector_search:
+            embedding_tasks = []
             if vector_fields == "textEmbeddingOnly" or vector_fields == "textAndImageEmbeddings":
-                vectors.append(await self.compute_text_embedding(q))
+                embedding_tasks.append(self.compute_text_embedding(q))
             if vector_fields == "imageEmbeddingOnly" or vector_fields == "textAndImageEmbeddings":
-                vectors.append(await self.compute_image_embedding(q))
+                embedding_tasks.append(self.compute_image_embedding(q))
+            # The text and image embeddings come from different services, so they are computed at the same time
+            vectors.extend(await asyncio.gather(*embedding_tasks))
 
         results = await self.search(
             top,
@@ -118,10 +131,7 @@ class RetrieveThenReadVisionApproach(Approach):
         if send_text_to_gptvision:
             text_sources = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
         if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_sources.append(url)
+            image_sources = await fetch_images(self.blob_container_client, results, self.page_image_cache)
 
         messages = self.prompt_manager.render_prompt(
             self.answer_prompt,
@@ -34,3 +34,6 @@ CONFIG_AGENTIC_RETRIEVAL_ENABLED = "agentic_retrieval"
 CONFIG_COSMOS_HISTORY_CLIENT = "cosmos_history_client"
 CONFIG_COSMOS_HISTORY_CONTAINER = "cosmos_history_container"
 CONFIG_COSMOS_HISTORY_VERSION = "cosmos_history_version"
+CONFIG_QUERY_EMBEDDING_CACHE = "query_embedding_cache"
+CONFIG_QUERY_EMBEDDING_CACHE_BACKEND = "query_embedding_cache_backend"
+CONFIG_HTTP_SESSION = "http_session"
@@ -1,8 +1,11 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
 import base64
+import hashlib
 import json
 import logging
+import time
 from typing import Any, Optional
 
 import aiohttp
@@ -20,6 +23,13 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from core.ttlcache import TTLCache
+from prepdocslib.httpsession import use_http_session
+
+# The signing keys of Entra are fetched again after a day, and at most every 5 minutes for tokens signed with an unknown key
+JWKS_MAX_AGE = 24 * 60 * 60
+JWKS_MIN_REFRESH_INTERVAL = 5 * 60
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -45,6 +55,11 @@ class AuthenticationHelper:
         require_access_control: bool = False,
         enable_global_documents: bool = False,
         enable_unauthenticated_access: bool = False,
+        path_auth_cache_size: int = 10000,
+        path_auth_cache_ttl: float = 60,
+        verified_token_cache_size: int = 10000,
+        groups_cache_ttl: float = 300,
+        http_session: Optional[aiohttp.ClientSession] = None,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
@@ -61,6 +76,29 @@ class AuthenticationHelper:
         self.valid_audiences = [f"api://{server_app_id}", str(server_app_id)]
         # See https://learn.microsoft.com/entra/identity-platform/access-tokens#validate-the-issuer for more information on token validation
         self.key_url = f"{self.authority}/discovery/v2.0/keys"
+        # Signing keys of Entra, and the PEM public keys built from them, keyed by kid
+        self.jwks: Optional[dict[str, Any]] = None
+        self.jwks_fetched_at = 0.0
+        self.jwks_lock = asyncio.Lock()
+        self.signing_keys: dict[str, bytes] = {}
+        # Hashes of the access tokens that were validated, until the tokens expire
+        self.verified_tokens: Optional[TTLCache[str, bool]] = (
+            TTLCache(max_size=verified_token_cache_size) if verified_token_cache_size > 0 else None
+        )
+        # Claims read with the on-behalf-of flow, keyed by the hash of the access token, until the token expires
+        self.auth_claims_cache: Optional[TTLCache[str, dict[str, Any]]] = (
+            TTLCache(max_size=verified_token_cache_size) if verified_token_cache_size > 0 else None
+        )
+        # Session shared with the rest of the app for the requests to Entra and Microsoft Graph, if given
+        self.http_session = http_session
+        # Groups listed from Microsoft Graph for users with a groups overage, keyed by oid
+        self.groups_cache: Optional[TTLCache[str, list[str]]] = (
+            TTLCache(max_size=verified_token_cache_size, ttl=groups_cache_ttl) if groups_cache_ttl > 0 else None
+        )
+        # Access decisions of check_path_auth, keyed by the oid, a hash of the groups and the path
+        self.path_auth_cache: Optional[TTLCache[tuple[str, str, str], bool]] = (
+            TTLCache(max_size=path_auth_cache_size, ttl=path_auth_cache_ttl) if path_auth_cache_size > 0 else None
+        )
 
         if self.use_authentication:
             field_names = [field.name for field in search_index.fields] if search_index else []
@@ -179,13 +217,17 @@ class AuthenticationHelper:
         return security_filter
 
     @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(
+        graph_resource_access_token: dict, session: Optional[aiohttp.ClientSession] = None
+    ) -> list[str]:
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        async with use_http_session(session) as session:
             resp_json = None
             resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
+            async with session.get(
+                url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id", headers=headers
+            ) as resp:
                 resp_json = await resp.json()
                 resp_status = resp.status
                 if resp_status != 200:
@@ -197,7 +239,7 @@ class AuthenticationHelper:
                     groups.append(group["id"])
                 next_link = resp_json.get("@odata.nextLink")
                 if next_link:
-                    async with session.get(url=next_link) as resp:
+                    async with session.get(url=next_link, headers=headers) as resp:
                         resp_json = await resp.json()
                         resp_status = resp.status
                 else:
@@ -207,6 +249,15 @@ class AuthenticationHelper:
 
         return groups
 
+    @staticmethod
+    def get_token_ttl(token: str) -> Optional[float]:
+        """Returns the number of seconds until a validated token expires, or None if it has no expiry"""
+        try:
+            expiry = jwt.decode(token, options={"verify_signature": False}).get("exp")
+        except jwt.PyJWTError:
+            return None
+        return expiry - time.time() if isinstance(expiry, (int, float)) else None
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
@@ -218,10 +269,19 @@ class AuthenticationHelper:
             # Validate the token before use
             await self.validate_access_token(auth_token)
 
+            token_hash = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            if self.auth_claims_cache is not None:
+                cached_claims = self.auth_claims_cache.get(token_hash)
+                if cached_claims is not None:
+                    return {"oid": cached_claims["oid"], "groups": list(cached_claims["groups"])}
+
             # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
             # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
+            # MSAL makes the request synchronously, so it runs in a thread to keep serving other requests meanwhile
+            graph_resource_access_token = await asyncio.to_thread(
+                self.confidential_client.acquire_token_on_behalf_of,
+                user_assertion=auth_token,
+                scopes=["https://graph.microsoft.com/.default"],
             )
             if "error" in graph_resource_access_token:
                 raise AuthError(error=str(graph_resource_access_token), status_code=401)
@@ -241,8 +301,18 @@ class AuthenticationHelper:
                 and "groups" in id_token_claims["_claim_names"]
             )
             if missing_groups_claim or has_group_overage_claim:
-                # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+                # Read the user's groups from Microsoft Graph, unless they were listed recently
+                groups = self.groups_cache.get(auth_claims["oid"]) if self.groups_cache is not None else None
+                if groups is None:
+                    groups = await AuthenticationHelper.list_groups(graph_resource_access_token, self.http_session)
+                    if self.groups_cache is not None:
+                        self.groups_cache.set(auth_claims["oid"], groups)
+                auth_claims["groups"] = list(groups)
+
+            if self.auth_claims_cache is not None:
+                ttl = AuthenticationHelper.get_token_ttl(auth_token)
+                if ttl is not None and ttl > 0:
+                    self.auth_claims_cache.set(token_hash, auth_claims, ttl=ttl)
             return auth_claims
         except AuthError as e:
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -267,6 +337,16 @@ class AuthenticationHelper:
         if fragment_index != -1:
             path = path[:fragment_index]
 
+        cache_key = (
+            auth_claims.get("oid", ""),
+            hashlib.sha256("\n".join(sorted(set(auth_claims.get("groups", [])))).encode("utf-8")).hexdigest(),
+            path,
+        )
+        if self.path_auth_cache is not None:
+            cached = self.path_auth_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
         # Filter down to only chunks that are from the specific source file
         # Sourcepage is used for GPT-4V
         # Replace ' with '' to escape the single quote for the filter
@@ -282,8 +362,15 @@ class AuthenticationHelper:
             allowed = True
             break
 
+        if self.path_auth_cache is not None:
+            self.path_auth_cache.set(cache_key, allowed)
         return allowed
 
+    def invalidate_path_auth(self, oid: str):
+        """Forgets the access decisions of a user, after their uploaded files changed"""
+        if self.path_auth_cache is not None:
+            self.path_auth_cache.remove_where(lambda key: key[0] == oid)
+
     async def create_pem_format(self, jwks, token):
         unverified_header = jwt.get_unverified_header(token)
         for key in jwks["keys"]:
@@ -302,11 +389,7 @@ class AuthenticationHelper:
                 rsa_key = pem_key
                 return rsa_key
 
-    # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
-    async def validate_access_token(self, token: str):
-        """
-        Validate an access token is issued by Entra
-        """
+    async def fetch_jwks(self) -> dict[str, Any]:
         jwks = None
         async for attempt in AsyncRetrying(
             retry=retry_if_exception_type(AuthError),
@@ -314,7 +397,7 @@ class AuthenticationHelper:
             stop=stop_after_attempt(5),
         ):
             with attempt:
-                async with aiohttp.ClientSession() as session:
+                async with use_http_session(self.http_session) as session:
                     async with session.get(url=self.key_url) as resp:
                         resp_status = resp.status
                         if resp_status in [500, 502, 503, 504]:
@@ -325,19 +408,52 @@ class AuthenticationHelper:
 
         if not jwks or "keys" not in jwks:
             raise AuthError("Unable to get keys to validate auth token.", 401)
+        return jwks
+
+    async def get_signing_key(self, token: str) -> Optional[bytes]:
+        """
+        Returns the PEM public key of the key that signed a token, reusing the keys of Entra that were fetched before.
+        The keys are fetched again once they are a day old, or when the token was signed with an unknown key,
+        at most once per JWKS_MIN_REFRESH_INTERVAL so that tokens with made up key ids can't flood Entra with requests.
+        """
+        kid = jwt.get_unverified_header(token).get("kid")
+        if not isinstance(kid, str):
+            return None
+        if kid in self.signing_keys and time.monotonic() - self.jwks_fetched_at < JWKS_MAX_AGE:
+            return self.signing_keys[kid]
+        async with self.jwks_lock:
+            now = time.monotonic()
+            known_kids = {key.get("kid") for key in self.jwks["keys"]} if self.jwks else set()
+            if (
+                self.jwks is None
+                or now - self.jwks_fetched_at >= JWKS_MAX_AGE
+                or (kid not in known_kids and now - self.jwks_fetched_at >= JWKS_MIN_REFRESH_INTERVAL)
+            ):
+                self.jwks = await self.fetch_jwks()
+                self.jwks_fetched_at = now
+                self.signing_keys = {}
+            if kid not in self.signing_keys:
+                rsa_key = await self.create_pem_format(self.jwks, token)
+                if not rsa_key:
+                    return None
+                self.signing_keys[kid] = rsa_key
+            return self.signing_keys[kid]
+
+    # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
+    async def validate_access_token(self, token: str):
+        """
+        Validate an access token is issued by Entra
+        """
+        token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        if self.verified_tokens is not None and self.verified_tokens.get(token_hash):
+            return
 
-        rsa_key = None
-        issuer = None
-        audience = None
         try:
             unverified_claims = jwt.decode(token, options={"verify_signature": False})
-            issuer = unverified_claims.get("iss")
-            audience = unverified_claims.get("aud")
-            rsa_key = await self.create_pem_format(jwks, token)
         except jwt.PyJWTError as exc:
             raise AuthError("Unable to parse authorization token.", 401) from exc
-        if not rsa_key:
-            raise AuthError("Unable to find appropriate key", 401)
+        issuer = unverified_claims.get("iss")
+        audience = unverified_claims.get("aud")
 
         if issuer not in self.valid_issuers:
             raise AuthError(f"Issuer {issuer} not in {','.join(self.valid_issuers)}", 401)
@@ -348,8 +464,16 @@ class AuthenticationHelper:
                 401,
             )
 
+        # Only tokens for this app can make the keys be fetched again
         try:
-            jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
+            rsa_key = await self.get_signing_key(token)
+        except jwt.PyJWTError as exc:
+            raise AuthError("Unable to parse authorization token.", 401) from exc
+        if not rsa_key:
+            raise AuthError("Unable to find appropriate key", 401)
+
+        try:
+            claims = jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
         except jwt.ExpiredSignatureError as jwt_expired_exc:
             raise AuthError("Token is expired", 401) from jwt_expired_exc
         except (jwt.InvalidAudienceError, jwt.InvalidIssuerError) as jwt_claims_exc:
@@ -359,3 +483,8 @@ class AuthenticationHelper:
             ) from jwt_claims_exc
         except Exception as exc:
             raise AuthError("Unable to parse authorization token.", 401) from exc
+
+        if self.verified_tokens is not None and isinstance(claims.get("exp"), (int, float)):
+            ttl = claims["exp"] - time.time()
+            if ttl > 0:
+                self.verified_tokens.set(token_hash, True, ttl=ttl)
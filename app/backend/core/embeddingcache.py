@@ -0,0 +1,152 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections.abc import Awaitable
+from typing import Callable, Optional
+
+from core.ttlcache import TTLCache
+
+
+class EmbeddingCacheBackend(ABC):
+    """
+    Cache shared between app workers, such as a Redis instance, consulted when a query embedding
+    is not in the local cache of a worker.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[list[float]]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, embedding: list[float], ttl: float):
+        pass
+
+
+class InMemoryEmbeddingCacheBackend(EmbeddingCacheBackend):
+    """
+    Stand-in for a shared cache that keeps embeddings in the memory of the current process.
+    It only shares embeddings between the caches that use the same instance.
+    """
+
+    def __init__(self):
+        self.entries: dict[str, tuple[float, list[float]]] = {}
+
+    async def get(self, key: str) -> Optional[list[float]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, embedding = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+        return embedding
+
+    async def set(self, key: str, embedding: list[float], ttl: float):
+        self.entries[key] = (time.monotonic() + ttl, embedding)
+
+
+class QueryEmbeddingCache:
+    """
+    LRU cache of query embeddings, keyed by the model, the dimensions and the normalized query.
+    Entries expire after ttl seconds. Concurrent requests for the same query share a single embeddings call,
+    and an optional shared backend lets app workers reuse each other's embeddings.
+    The stats are logged every stats_log_interval lookups, if set.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: float = 3600,
+        backend: Optional[EmbeddingCacheBackend] = None,
+        stats_log_interval: int = 0,
+    ):
+        self.ttl = ttl
+        self.backend = backend
+        self.entries: TTLCache[str, list[float]] = TTLCache(max_size=max_size, ttl=ttl)
+        self.in_flight: dict[str, asyncio.Task[list[float]]] = {}
+        self.shared_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.lookups = 0
+        self.stats_log_interval = stats_log_interval
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(unicodedata.normalize("NFC", query).split())
+
+    def make_key(self, model: str, dimensions: int, query: str) -> str:
+        query_hash = hashlib.sha256(self.normalize_query(query).encode("utf-8")).hexdigest()
+        return f"{model}:{dimensions}:{query_hash}"
+
+    async def get_or_compute(
+        self, model: str, dimensions: int, query: str, compute: Callable[[], Awaitable[list[float]]]
+    ) -> list[float]:
+        self.lookups += 1
+        if self.stats_log_interval and self.lookups % self.stats_log_interval == 0:
+            self.log_stats()
+        key = self.make_key(model, dimensions, query)
+        if (embedding := self.entries.get(key)) is not None:
+            return embedding
+        if (task := self.in_flight.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            # The call runs in its own task, so it completes for the waiting requests even if this one is cancelled
+            task = asyncio.create_task(self.fetch_and_store(key, compute))
+            self.in_flight[key] = task
+            task.add_done_callback(functools.partial(self.finish_in_flight, key))
+        # Shield the shared call, so a cancelled request doesn't cancel it for the other waiting requests
+        return await asyncio.shield(task)
+
+    async def fetch_and_store(self, key: str, compute: Callable[[], Awaitable[list[float]]]) -> list[float]:
+        embedding = await self.fetch(key, compute)
+        self.entries.set(key, embedding)
+        return embedding
+
+    def finish_in_flight(self, key: str, task: asyncio.Task[list[float]]):
+        del self.in_flight[key]
+        # All the waiting requests may have been cancelled, so mark the exception as retrieved
+        if not task.cancelled():
+            task.exception()
+
+    async def fetch(self, key: str, compute: Callable[[], Awaitable[list[float]]]) -> list[float]:
+        if self.backend is not None:
+            try:
+                embedding = await self.backend.get(key)
+            except Exception:
+                logging.exception("Failed to read query embedding from the shared cache")
+                embedding = None
+            if embedding is not None:
+                self.shared_hits += 1
+                return embedding
+        self.misses += 1
+        embedding = await compute()
+        if self.backend is not None:
+            try:
+                await self.backend.set(key, embedding, self.ttl)
+            except Exception:
+                logging.exception("Failed to write query embedding to the shared cache")
+        return embedding
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self.entries),
+            "hits": self.entries.hits,
+            "shared_hits": self.shared_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info(
+            "Query embedding cache: %d hits, %d shared hits, %d coalesced, %d misses, %d entries",
+            stats["hits"],
+            stats["shared_hits"],
+            stats["coalesced"],
+            stats["misses"],
+            stats["size"],
+        )
@@ -1,9 +1,12 @@
+import asyncio
 import base64
 import logging
 import os
+from collections import OrderedDict
 from typing import Optional
 
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.storage.blob.aio import ContainerClient
 from typing_extensions import Literal, Required, TypedDict
 
@@ -18,23 +21,102 @@ class ImageURL(TypedDict, total=False):
     """Specifies the detail level of the image."""
 
 
-async def download_blob_as_base64(blob_container_client: ContainerClient, file_path: str) -> Optional[str]:
+class PageImageCache:
+    """
+    In-memory LRU cache of page images encoded as data URLs, keyed by blob name and ETag.
+    When the data URLs take more than max_size_bytes, the least recently used ones are evicted.
+    """
+
+    def __init__(self, max_size_bytes: int = 64 * 1024 * 1024):
+        self.max_size_bytes = max_size_bytes
+        self.size_bytes = 0
+        # Only the latest ETag of each blob is kept, older versions of a page image are never read again
+        self.entries: OrderedDict[str, tuple[str, str]] = OrderedDict()
+
+    def get(self, blob_name: str) -> Optional[tuple[str, str]]:
+        """Returns the ETag and the data URL of the cached image of a blob, if any"""
+        entry = self.entries.get(blob_name)
+        if entry is not None:
+            self.entries.move_to_end(blob_name)
+        return entry
+
+    def put(self, blob_name: str, etag: str, data_url: str):
+        if len(data_url) > self.max_size_bytes:
+            return
+        self.remove(blob_name)
+        self.entries[blob_name] = (etag, data_url)
+        self.size_bytes += len(data_url)
+        while self.size_bytes > self.max_size_bytes:
+            _, (_, evicted_url) = self.entries.popitem(last=False)
+            self.size_bytes -= len(evicted_url)
+
+    def remove(self, blob_name: str):
+        entry = self.entries.pop(blob_name, None)
+        if entry is not None:
+            self.size_bytes -= len(entry[1])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+async def download_blob_as_base64(
+    blob_container_client: ContainerClient, file_path: str, cache: Optional[PageImageCache] = None
+) -> Optional[str]:
     base_name, _ = os.path.splitext(file_path)
     image_filename = base_name + ".png"
+    cached = cache.get(image_filename) if cache is not None else None
     try:
-        blob = await blob_container_client.get_blob_client(image_filename).download_blob()
+        blob_client = blob_container_client.get_blob_client(image_filename)
+        if cached is not None:
+            # Only download the image again if it changed since it was cached
+            blob = await blob_client.download_blob(etag=cached[0], match_condition=MatchConditions.IfModified)
+        else:
+            blob = await blob_client.download_blob()
         if not blob.properties:
             logging.warning(f"No blob exists for {image_filename}")
             return None
         img = base64.b64encode(await blob.readall()).decode("utf-8")
-        return f"data:image/png;base64,{img}"
+        # Page images keep a .png name, but may be stored in another format
+        mime_type = blob.properties["content_settings"]["content_type"]
+        if not mime_type or not mime_type.startswith("image/"):
+            mime_type = "image/png"
+        data_url = f"data:{mime_type};base64,{img}"
+        if cache is not None and blob.properties.get("etag"):
+            cache.put(image_filename, blob.properties["etag"], data_url)
+        return data_url
     except ResourceNotFoundError:
         logging.warning(f"No blob exists for {image_filename}")
+        if cache is not None:
+            cache.remove(image_filename)
         return None
+    except HttpResponseError as error:
+        if cached is not None and error.status_code == 304:
+            return cached[1]
+        raise
 
 
-async def fetch_image(blob_container_client: ContainerClient, result: Document) -> Optional[str]:
+async def fetch_image(
+    blob_container_client: ContainerClient, result: Document, cache: Optional[PageImageCache] = None
+) -> Optional[str]:
     if result.sourcepage:
-        img = await download_blob_as_base64(blob_container_client, result.sourcepage)
+        img = await download_blob_as_base64(blob_container_client, result.sourcepage, cache)
         return img
     return None
+
+
+async def fetch_images(
+    blob_container_client: ContainerClient, results: list[Document], cache: Optional[PageImageCache] = None
+) -> list[str]:
+    """
+    Downloads the page images of the results concurrently, in the order of the results.
+    Results that share a page download its image once, and results without an image are skipped.
+    """
+    results_by_page: dict[str, Document] = {}
+    for result in results:
+        if result.sourcepage:
+            results_by_page.setdefault(result.sourcepage, result)
+    images = await asyncio.gather(
+        *(fetch_image(blob_container_client, result, cache) for result in results_by_page.values())
+    )
+    images_by_page = dict(zip(results_by_page, images))
+    return [image for result in results if result.sourcepage and (image := images_by_page[result.sourcepage])]
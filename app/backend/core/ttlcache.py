@@ -0,0 +1,55 @@
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Callable, Generic, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    In-memory LRU cache whose entries expire after a time to live, by default ttl seconds.
+    When it holds more than max_size entries, the least recently used ones are evicted.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None):
+        """Stores a value, which expires after ttl seconds if given, otherwise after the ttl of the cache"""
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def remove_where(self, predicate: Callable[[K], bool]) -> int:
+        """Removes the entries whose key matches the predicate, returning how many were removed"""
+        keys = [key for key in self.entries if predicate(key)]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -2,6 +2,8 @@ import argparse
 import asyncio
 import logging
 import os
+from collections.abc import Iterable
+from concurrent.futures import Executor, ProcessPoolExecutor
 from typing import Optional, Union
 
 from azure.core.credentials import AzureKeyCredential
@@ -12,6 +14,7 @@ from rich.logging import RichHandler
 from load_azd_env import load_azd_env
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.csvparser import CsvParser
+from prepdocslib.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     ImageEmbeddings,
@@ -20,6 +23,9 @@ from prepdocslib.embeddings import (
 from prepdocslib.fileprocessor import FileProcessor
 from prepdocslib.filestrategy import FileStrategy
 from prepdocslib.htmlparser import LocalHTMLParser
+from prepdocslib.httpsession import SharedHttpSession
+from prepdocslib.ingestionmanifest import IngestionManifest
+from prepdocslib.ingestionpipeline import PipelineConfig
 from prepdocslib.integratedvectorizerstrategy import (
     IntegratedVectorizerStrategy,
 )
@@ -33,7 +39,11 @@ from prepdocslib.parser import Parser
 from prepdocslib.pdfparser import DocumentAnalysisParser, LocalPdfParser
 from prepdocslib.strategy import DocumentAction, SearchInfo, Strategy
 from prepdocslib.textparser import TextParser
-from prepdocslib.textsplitter import SentenceTextSplitter, SimpleTextSplitter
+from prepdocslib.textsplitter import (
+    IndexedSentenceTextSplitter,
+    SentenceTextSplitter,
+    SimpleTextSplitter,
+)
 
 logger = logging.getLogger("scripts")
 
@@ -84,6 +94,10 @@ def setup_blob_manager(
     subscription_id: str,
     search_images: bool,
     storage_key: Union[str, None] = None,
+    image_format: str = "png",
+    image_quality: int = 85,
+    image_executor: Optional[Executor] = None,
+    image_executor_workers: int = 1,
 ):
     storage_creds: Union[AsyncTokenCredential, str] = azure_credential if storage_key is None else storage_key
     return BlobManager(
@@ -94,6 +108,10 @@ def setup_blob_manager(
         resourceGroup=storage_resource_group,
         subscriptionId=subscription_id,
         store_page_images=search_images,
+        image_format=image_format,
+        image_quality=image_quality,
+        executor=image_executor,
+        executor_workers=image_executor_workers,
     )
 
 
@@ -104,6 +122,8 @@ def setup_list_file_strategy(
     datalake_filesystem: Union[str, None],
     datalake_path: Union[str, None],
     datalake_key: Union[str, None],
+    manifest: Optional[IngestionManifest] = None,
+    datalake_concurrency: int = 4,
 ):
     list_file_strategy: ListFileStrategy
     if datalake_storage_account:
@@ -116,10 +136,12 @@ def setup_list_file_strategy(
             data_lake_filesystem=datalake_filesystem,
             data_lake_path=datalake_path,
             credential=adls_gen2_creds,
+            manifest=manifest,
+            download_concurrency=datalake_concurrency,
         )
     elif local_files:
         logger.info("Using local files: %s", local_files)
-        list_file_strategy = LocalListFileStrategy(path_pattern=local_files)
+        list_file_strategy = LocalListFileStrategy(path_pattern=local_files, manifest=manifest)
     else:
         raise ValueError("Either local_files or datalake_storage_account must be provided.")
     return list_file_strategy
@@ -138,6 +160,8 @@ def setup_embeddings_service(
     openai_org: Union[str, None],
     disable_vectors: bool = False,
     disable_batch_vectors: bool = False,
+    embedding_concurrency: int = 1,
+    embedding_cache: Optional[EmbeddingCache] = None,
 ):
     if disable_vectors:
         logger.info("Not setting up embeddings service")
@@ -156,6 +180,8 @@ def setup_embeddings_service(
             open_ai_api_version=openai_api_version,
             credential=azure_open_ai_credential,
             disable_batch=disable_batch_vectors,
+            batch_concurrency=embedding_concurrency,
+            cache=embedding_cache,
         )
     else:
         if openai_key is None:
@@ -166,9 +192,15 @@ def setup_embeddings_service(
             credential=openai_key,
             organization=openai_org,
             disable_batch=disable_batch_vectors,
+            batch_concurrency=embedding_concurrency,
+            cache=embedding_cache,
         )
 
 
+# Local parsers that can run their CPU-bound work in a process pool
+LOCAL_PARSERS = ("pdf", "html", "csv", "json")
+
+
 def setup_file_processors(
     azure_credential: AsyncTokenCredential,
     document_intelligence_service: Union[str, None],
@@ -178,8 +210,17 @@ def setup_file_processors(
     search_images: bool = False,
     use_content_understanding: bool = False,
     content_understanding_endpoint: Union[str, None] = None,
+    figure_concurrency: int = 4,
+    parser_executor: Optional[Executor] = None,
+    parser_executor_workers: int = 1,
+    executor_parsers: Iterable[str] = LOCAL_PARSERS,
+    http_session: Optional[SharedHttpSession] = None,
+    use_indexed_splitter: bool = False,
 ):
-    sentence_text_splitter = SentenceTextSplitter()
+    sentence_text_splitter = IndexedSentenceTextSplitter() if use_indexed_splitter else SentenceTextSplitter()
+
+    def executor_for(parser_name: str) -> Optional[Executor]:
+        return parser_executor if parser_name in executor_parsers else None
 
     doc_int_parser: Optional[DocumentAnalysisParser] = None
     # check if Azure Document Intelligence credentials are provided
@@ -192,11 +233,13 @@ def setup_file_processors(
             credential=documentintelligence_creds,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=content_understanding_endpoint,
+            figure_concurrency=figure_concurrency,
+            http_session=http_session,
         )
 
     pdf_parser: Optional[Parser] = None
     if local_pdf_parser or document_intelligence_service is None:
-        pdf_parser = LocalPdfParser()
+        pdf_parser = LocalPdfParser(executor=executor_for("pdf"), executor_workers=parser_executor_workers)
     elif document_intelligence_service is not None:
         pdf_parser = doc_int_parser
     else:
@@ -204,7 +247,7 @@ def setup_file_processors(
 
     html_parser: Optional[Parser] = None
     if local_html_parser or document_intelligence_service is None:
-        html_parser = LocalHTMLParser()
+        html_parser = LocalHTMLParser(executor=executor_for("html"))
     elif document_intelligence_service is not None:
         html_parser = doc_int_parser
     else:
@@ -212,10 +255,10 @@ def setup_file_processors(
 
     # These file formats can always be parsed:
     file_processors = {
-        ".json": FileProcessor(JsonParser(), SimpleTextSplitter()),
+        ".json": FileProcessor(JsonParser(executor=executor_for("json")), SimpleTextSplitter()),
         ".md": FileProcessor(TextParser(), sentence_text_splitter),
         ".txt": FileProcessor(TextParser(), sentence_text_splitter),
-        ".csv": FileProcessor(CsvParser(), sentence_text_splitter),
+        ".csv": FileProcessor(CsvParser(executor=executor_for("csv")), sentence_text_splitter),
     }
     # These require either a Python package or Document Intelligence
     if pdf_parser is not None:
@@ -241,7 +284,12 @@ def setup_file_processors(
 
 
 def setup_image_embeddings_service(
-    azure_credential: AsyncTokenCredential, vision_endpoint: Union[str, None], search_images: bool
+    azure_credential: AsyncTokenCredential,
+    vision_endpoint: Union[str, None],
+    search_images: bool,
+    image_embedding_concurrency: int = 4,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    http_session: Optional[SharedHttpSession] = None,
 ) -> Union[ImageEmbeddings, None]:
     image_embeddings_service: Optional[ImageEmbeddings] = None
     if search_images:
@@ -250,15 +298,32 @@ def setup_image_embeddings_service(
         image_embeddings_service = ImageEmbeddings(
             endpoint=vision_endpoint,
             token_provider=get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default"),
+            concurrency=image_embedding_concurrency,
+            cache=embedding_cache,
+            http_session=http_session,
         )
     return image_embeddings_service
 
 
-async def main(strategy: Strategy, setup_index: bool = True):
-    if setup_index:
-        await strategy.setup()
+async def main(
+    strategy: Strategy,
+    setup_index: bool = True,
+    blob_manager: Optional[BlobManager] = None,
+    image_embeddings: Optional[ImageEmbeddings] = None,
+    http_session: Optional[SharedHttpSession] = None,
+):
+    try:
+        if setup_index:
+            await strategy.setup()
 
-    await strategy.run()
+        await strategy.run()
+    finally:
+        if blob_manager:
+            await blob_manager.close()
+        if image_embeddings:
+            await image_embeddings.close()
+        if http_session:
+            await http_session.close()
 
 
 if __name__ == "__main__":
@@ -276,6 +341,85 @@ if __name__ == "__main__":
     parser.add_argument(
         "--disablebatchvectors", action="store_true", help="Don't compute embeddings in batch for the sections"
     )
+    parser.add_argument(
+        "--embeddingconcurrency",
+        type=int,
+        default=1,
+        help="Number of embedding batches to send at the same time, paced by the rate limit headers of the deployment",
+    )
+    parser.add_argument(
+        "--imageembeddingconcurrency",
+        type=int,
+        default=4,
+        help="Number of page images to embed with Azure AI Vision at the same time",
+    )
+    parser.add_argument(
+        "--figureconcurrency",
+        type=int,
+        default=4,
+        help="Number of figures of a document to describe at the same time with Content Understanding",
+    )
+    parser.add_argument(
+        "--parserprocesses",
+        type=int,
+        default=0,
+        help="Number of processes that run the local parsers and render page images, so they use several cores. 0 runs them on the main process",
+    )
+    parser.add_argument(
+        "--processparsers",
+        default=",".join(LOCAL_PARSERS),
+        help=f"Comma-separated list of the local parsers that run in the --parserprocesses pool, among {', '.join(LOCAL_PARSERS)}",
+    )
+    parser.add_argument(
+        "--pageimageformat",
+        choices=["png", "jpeg", "webp"],
+        default="png",
+        help="Image format of the pages stored for GPT-4 with Vision",
+    )
+    parser.add_argument(
+        "--pageimagequality",
+        type=int,
+        default=85,
+        help="Quality of the JPEG and WebP page images, from 1 to 100",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Path of a SQLite file that records the ingested files, instead of .md5 files next to each local file. "
+        "Unchanged files are skipped, and files deleted since they were ingested are removed from the index",
+    )
+    parser.add_argument(
+        "--embeddingcache",
+        help="Path of a SQLite file that caches embeddings across runs, so unchanged chunks aren't embedded again",
+    )
+    parser.add_argument(
+        "--embeddingcachesize",
+        type=int,
+        default=1024,
+        help="Maximum size in MB of the embeddings stored in the embedding cache, least recently used ones are evicted first",
+    )
+    parser.add_argument(
+        "--pipeline",
+        nargs="?",
+        const="",
+        metavar="STAGE=WORKERS[:QUEUE_SIZE],...",
+        help="Ingest files concurrently through parse, blob, embed and index stages. Optionally set the workers and queue size of each stage, for example --pipeline parse=8,embed=2:8",
+    )
+    parser.add_argument(
+        "--datalakeconcurrency",
+        type=int,
+        default=4,
+        help="Number of files downloaded at the same time from Azure Data Lake Gen2, ahead of the ingestion",
+    )
+    parser.add_argument(
+        "--contenthashids",
+        action="store_true",
+        help="Derive the id of each chunk from a hash of its content, so that re-ingesting a changed file only embeds and uploads the chunks that changed, and removes the ones that are gone",
+    )
+    parser.add_argument(
+        "--indexedsplitter",
+        action="store_true",
+        help="Split text with IndexedSentenceTextSplitter, which makes the same chunks in fewer passes over long documents and streams the pages of a file to the splitter",
+    )
     parser.add_argument(
         "--remove",
         action="store_true",
@@ -372,6 +516,7 @@ if __name__ == "__main__":
             search_key=clean_key_if_exists(args.searchkey),
         )
     )
+    parser_executor = ProcessPoolExecutor(max_workers=args.parserprocesses) if args.parserprocesses > 0 else None
     blob_manager = setup_blob_manager(
         azure_credential=azd_credential,
         storage_account=os.environ["AZURE_STORAGE_ACCOUNT"],
@@ -380,7 +525,12 @@ if __name__ == "__main__":
         subscription_id=os.environ["AZURE_SUBSCRIPTION_ID"],
         search_images=use_gptvision,
         storage_key=clean_key_if_exists(args.storagekey),
+        image_format=args.pageimageformat,
+        image_quality=args.pageimagequality,
+        image_executor=parser_executor,
+        image_executor_workers=args.parserprocesses,
     )
+    manifest = IngestionManifest(args.manifest) if args.manifest else None
     list_file_strategy = setup_list_file_strategy(
         azure_credential=azd_credential,
         local_files=args.files,
@@ -388,6 +538,8 @@ if __name__ == "__main__":
         datalake_filesystem=os.getenv("AZURE_ADLS_GEN2_FILESYSTEM"),
         datalake_path=os.getenv("AZURE_ADLS_GEN2_FILESYSTEM_PATH"),
         datalake_key=clean_key_if_exists(args.datalakekey),
+        manifest=manifest,
+        datalake_concurrency=args.datalakeconcurrency,
     )
 
     openai_host = os.environ["OPENAI_HOST"]
@@ -400,6 +552,14 @@ if __name__ == "__main__":
     openai_dimensions = 1536
     if os.getenv("AZURE_OPENAI_EMB_DIMENSIONS"):
         openai_dimensions = int(os.environ["AZURE_OPENAI_EMB_DIMENSIONS"])
+    embedding_cache = (
+        EmbeddingCache(args.embeddingcache, max_size_bytes=args.embeddingcachesize * 1024 * 1024)
+        if args.embeddingcache and (not dont_use_vectors or use_gptvision)
+        else None
+    )
+    executor_parsers = [name.strip() for name in args.processparsers.split(",") if name.strip()]
+    if unknown_parsers := set(executor_parsers) - set(LOCAL_PARSERS):
+        raise ValueError(f"Unknown parsers in --processparsers: {', '.join(sorted(unknown_parsers))}")
     openai_embeddings_service = setup_embeddings_service(
         azure_credential=azd_credential,
         openai_host=openai_host,
@@ -414,9 +574,14 @@ if __name__ == "__main__":
         openai_org=os.getenv("OPENAI_ORGANIZATION"),
         disable_vectors=dont_use_vectors,
         disable_batch_vectors=args.disablebatchvectors,
+        embedding_concurrency=args.embeddingconcurrency,
+        embedding_cache=embedding_cache,
     )
 
     ingestion_strategy: Strategy
+    image_embeddings_service: Optional[ImageEmbeddings] = None
+    # Shared by the Vision and Content Understanding requests, so their connections are reused across files
+    http_session = SharedHttpSession()
     if use_int_vectorization:
 
         if not openai_embeddings_service or not isinstance(openai_embeddings_service, AzureOpenAIEmbeddingService):
@@ -445,11 +610,20 @@ if __name__ == "__main__":
             search_images=use_gptvision,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=os.getenv("AZURE_CONTENTUNDERSTANDING_ENDPOINT"),
+            figure_concurrency=args.figureconcurrency,
+            parser_executor=parser_executor,
+            parser_executor_workers=args.parserprocesses,
+            executor_parsers=executor_parsers,
+            http_session=http_session,
+            use_indexed_splitter=args.indexedsplitter,
         )
         image_embeddings_service = setup_image_embeddings_service(
             azure_credential=azd_credential,
             vision_endpoint=os.getenv("AZURE_VISION_ENDPOINT"),
             search_images=use_gptvision,
+            image_embedding_concurrency=args.imageembeddingconcurrency,
+            embedding_cache=embedding_cache,
+            http_session=http_session,
         )
 
         ingestion_strategy = FileStrategy(
@@ -467,7 +641,25 @@ if __name__ == "__main__":
             category=args.category,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=os.getenv("AZURE_CONTENTUNDERSTANDING_ENDPOINT"),
+            pipeline_config=PipelineConfig.from_spec(args.pipeline) if args.pipeline is not None else None,
+            use_content_hash_ids=args.contenthashids,
+            http_session=http_session,
         )
 
-    loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
+    loop.run_until_complete(
+        main(
+            ingestion_strategy,
+            setup_index=not args.remove and not args.removeall,
+            blob_manager=blob_manager,
+            image_embeddings=image_embeddings_service,
+            http_session=http_session,
+        )
+    )
     loop.close()
+    if parser_executor:
+        parser_executor.shutdown()
+    if manifest:
+        manifest.close()
+    if embedding_cache:
+        embedding_cache.log_stats()
+        embedding_cache.close()
@@ -1,26 +1,112 @@
+import asyncio
 import datetime
+import functools
+import hashlib
 import io
 import logging
 import os
-import re
+from collections.abc import Generator
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
 from typing import Optional, Union
 
 import pymupdf
 from azure.core.credentials_async import AsyncTokenCredential
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceNotFoundError,
+)
 from azure.storage.blob import (
     BlobSasPermissions,
+    ContentSettings,
     UserDelegationKey,
     generate_blob_sas,
 )
 from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 from PIL import Image, ImageDraw, ImageFont
-from pypdf import PdfReader
 
 from .listfilestrategy import File
+from .parser import split_page_ranges
 
 logger = logging.getLogger("scripts")
 
 
+PAGE_IMAGE_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+PAGE_IMAGE_CONTENT_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+@functools.cache
+def load_page_image_font() -> Union[ImageFont.FreeTypeFont, ImageFont.ImageFont, None]:
+    try:
+        return ImageFont.truetype("arial.ttf", 20)
+    except OSError:
+        try:
+            return ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
+        except OSError:
+            logger.info("Unable to find arial.ttf or FreeMono.ttf, using default font")
+            return None
+
+
+def render_pages(
+    doc: pymupdf.Document, start: int, end: int, blob_names: list[str], image_format: str, image_quality: int
+) -> Generator[bytes, None, None]:
+    """
+    Renders the pages from start (included) to end (excluded) of an open PDF, with the name of their blob
+    written above each page, and encodes them in the given format
+    """
+    font = load_page_image_font()
+    for page_num, blob_name in zip(range(start, end), blob_names):
+        pix = doc.load_page(page_num).get_pixmap()
+        original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
+
+        # Create a new image with additional space for text
+        text_height = 40  # Height of the text area
+        new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
+
+        # Paste the original image onto the new image
+        new_img.paste(original_img, (0, text_height))
+
+        # Draw the text on the white area, 10 pixels from the top and left of the image
+        draw = ImageDraw.Draw(new_img)
+        draw.text((10, 10), f"SourceFileName:{blob_name}", font=font, fill="black")
+
+        output = io.BytesIO()
+        if image_format == "png":
+            new_img.save(output, format=PAGE_IMAGE_FORMATS[image_format])
+        else:
+            new_img.save(output, format=PAGE_IMAGE_FORMATS[image_format], quality=image_quality)
+        yield output.getvalue()
+
+
+def render_page_images(
+    pdf_data: bytes, start: int, end: int, blob_names: list[str], image_format: str, image_quality: int
+) -> list[bytes]:
+    """Renders a range of pages of a PDF, opening it once, so that ranges can be rendered in a process pool"""
+    with pymupdf.open(stream=pdf_data, filetype="pdf") as doc:
+        return list(render_pages(doc, start, end, blob_names, image_format, image_quality))
+
+
+@dataclass(frozen=True)
+class PageImage:
+    """SAS URL of the uploaded image of a page, and the SHA-256 hash of the image, which identifies its content"""
+
+    url: str
+    content_hash: str
+
+
+# The blob batch API deletes at most 256 blobs per request
+MAX_DELETE_BATCH_SIZE = 256
+
+
+@dataclass
+class BlobRemovalSummary:
+    """Names of the blobs that were removed, and of the blobs that failed to be removed"""
+
+    deleted: list[str] = field(default_factory=list)
+    failed: list[str] = field(default_factory=list)
+
+
 class BlobManager:
     """
     Class to manage uploading and deleting blobs containing citation information from a blob storage account
@@ -35,6 +121,11 @@ class BlobManager:
         resourceGroup: str,
         subscriptionId: str,
         store_page_images: bool = False,
+        upload_concurrency: int = 4,
+        image_format: str = "png",
+        image_quality: int = 85,
+        executor: Optional[Executor] = None,
+        executor_workers: int = 1,
     ):
         self.endpoint = endpoint
         self.credential = credential
@@ -44,27 +135,77 @@ class BlobManager:
         self.resourceGroup = resourceGroup
         self.subscriptionId = subscriptionId
         self.user_delegation_key: Optional[UserDelegationKey] = None
+        # Number of blocks of a large blob or page images uploaded, or of batches of blobs deleted, at the same time
+        self.upload_concurrency = upload_concurrency
+        if image_format not in PAGE_IMAGE_FORMATS:
+            raise ValueError(
+                f"Unsupported page image format {image_format}, use one of {', '.join(PAGE_IMAGE_FORMATS)}"
+            )
+        # Page images keep their .png blob names whatever their format, their content type gives the format
+        self.image_format = image_format
+        # Quality of JPEG and WebP page images, from 1 to 100
+        self.image_quality = image_quality
+        # Executor, typically a process pool, that renders the page images
+        self.executor = executor
+        # Number of workers of the executor, each of them renders one range of pages
+        self.executor_workers = executor_workers
+        # The client is shared by all the uploads and removals, so connections are reused across files
+        self.service_client: Optional[BlobServiceClient] = None
+        self.container_exists = False
 
-    async def upload_blob(self, file: File) -> Optional[list[str]]:
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential, max_single_put_size=4 * 1024 * 1024
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
+    def get_service_client(self) -> BlobServiceClient:
+        if self.service_client is None:
+            self.service_client = BlobServiceClient(
+                account_url=self.endpoint, credential=self.credential, max_single_put_size=4 * 1024 * 1024
+            )
+        return self.service_client
+
+    async def get_container_client(self, create: bool) -> Optional[ContainerClient]:
+        """
+        Returns a client for the container, creating the container first if needed when create is set,
+        or None if the container doesn't exist. The container is only checked until it is known to exist.
+        """
+        container_client = self.get_service_client().get_container_client(self.container)
+        if not self.container_exists:
             if not await container_client.exists():
-                await container_client.create_container()
-
-            # Re-open and upload the original file
-            if file.url is None:
-                with open(file.content.name, "rb") as reopened_file:
-                    blob_name = BlobManager.blob_name_from_file_name(file.content.name)
-                    logger.info("Uploading blob for whole file -> %s", blob_name)
-                    blob_client = await container_client.upload_blob(blob_name, reopened_file, overwrite=True)
-                    file.url = blob_client.url
-
-            if self.store_page_images:
-                if os.path.splitext(file.content.name)[1].lower() == ".pdf":
-                    return await self.upload_pdf_blob_images(service_client, container_client, file)
-                else:
-                    logger.info("File %s is not a PDF, skipping image upload", file.content.name)
+                if not create:
+                    return None
+                try:
+                    await container_client.create_container()
+                except ResourceExistsError:
+                    # Another upload created the container in the meantime
+                    pass
+            self.container_exists = True
+        return container_client
+
+    async def close(self):
+        if self.service_client is not None:
+            await self.service_client.close()
+            self.service_client = None
+
+    async def upload_blob(self, file: File) -> Optional[list[PageImage]]:
+        container_client = await self.get_container_client(create=True)
+        assert container_client is not None
+
+        # Upload the original file from its content, keeping the position of any parser that is reading it
+        if file.url is None:
+            blob_name = BlobManager.blob_name_from_file_name(file.content.name)
+            logger.info("Uploading blob for whole file -> %s", blob_name)
+            position = file.content.tell()
+            file.content.seek(0)
+            try:
+                blob_client = await container_client.upload_blob(
+                    blob_name, file.content, overwrite=True, max_concurrency=self.upload_concurrency
+                )
+            finally:
+                file.content.seek(position)
+            file.url = blob_client.url
+
+        if self.store_page_images:
+            if os.path.splitext(file.content.name)[1].lower() == ".pdf":
+                return await self.upload_pdf_blob_images(self.get_service_client(), container_client, file)
+            else:
+                logger.info("File %s is not a PDF, skipping image upload", file.content.name)
 
         return None
 
@@ -73,57 +214,33 @@ class BlobManager:
 
     async def upload_pdf_blob_images(
         self, service_client: BlobServiceClient, container_client: ContainerClient, file: File
-    ) -> list[str]:
-        with open(file.content.name, "rb") as reopened_file:
-            reader = PdfReader(reopened_file)
-            page_count = len(reader.pages)
-        doc = pymupdf.open(file.content.name)
-        sas_uris = []
+    ) -> list[PageImage]:
+        """
+        Renders each page of a PDF as an image and uploads it, returning the images with their SAS URIs in page order.
+        With an executor, the pages are rendered in one range per worker of the executor, otherwise one page at a time.
+        The images of the pages that are rendered are uploaded while the next pages are being rendered.
+        """
+        # Files downloaded from a data lake may only be held in memory, so the PDF is read from its content
+        position = file.content.tell()
+        file.content.seek(0)
+        pdf_data = file.content.read()
+        file.content.seek(position)
+
         start_time = datetime.datetime.now(datetime.timezone.utc)
         expiry_time = start_time + datetime.timedelta(days=1)
+        if not self.user_delegation_key:
+            self.user_delegation_key = await service_client.get_user_delegation_key(start_time, expiry_time)
+        content_settings = ContentSettings(content_type=PAGE_IMAGE_CONTENT_TYPES[self.image_format])
 
-        font = None
-        try:
-            font = ImageFont.truetype("arial.ttf", 20)
-        except OSError:
-            try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
-            except OSError:
-                logger.info("Unable to find arial.ttf or FreeMono.ttf, using default font")
-
-        for i in range(page_count):
-            blob_name = BlobManager.blob_image_name_from_file_page(file.content.name, i)
-            logger.info("Converting page %s to image and uploading -> %s", i, blob_name)
-
-            doc = pymupdf.open(file.content.name)
-            page = doc.load_page(i)
-            pix = page.get_pixmap()
-            original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
-
-            # Create a new image with additional space for text
-            text_height = 40  # Height of the text area
-            new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
-
-            # Paste the original image onto the new image
-            new_img.paste(original_img, (0, text_height))
-
-            # Draw the text on the white area
-            draw = ImageDraw.Draw(new_img)
-            text = f"SourceFileName:{blob_name}"
-
-            # 10 pixels from the top and left of the image
-            x = 10
-            y = 10
-            draw.text((x, y), text, font=font, fill="black")
-
-            output = io.BytesIO()
-            new_img.save(output, format="PNG")
-            output.seek(0)
-
-            blob_client = await container_client.upload_blob(blob_name, output, overwrite=True)
-            if not self.user_delegation_key:
-                self.user_delegation_key = await service_client.get_user_delegation_key(start_time, expiry_time)
+        semaphore = asyncio.Semaphore(self.upload_concurrency)
+        uploads: set[asyncio.Task[None]] = set()
+        page_images: list[Optional[PageImage]] = []
 
+        async def upload_image(page_num: int, image: bytes):
+            async with semaphore:
+                blob_client = await container_client.upload_blob(
+                    blob_names[page_num], image, overwrite=True, content_settings=content_settings
+                )
             if blob_client.account_name is not None:
                 sas_token = generate_blob_sas(
                     account_name=blob_client.account_name,
@@ -134,33 +251,148 @@ class BlobManager:
                     expiry=expiry_time,
                     start=start_time,
                 )
-                sas_uris.append(f"{blob_client.url}?{sas_token}")
+                page_images[page_num] = PageImage(
+                    url=f"{blob_client.url}?{sas_token}", content_hash=hashlib.sha256(image).hexdigest()
+                )
 
-        return sas_uris
+        async def add_upload(page_num: int, image: bytes):
+            logger.info("Uploading image of page %s -> %s", page_num, blob_names[page_num])
+            # Rendered images wait for an upload slot in memory, so wait for some uploads when too many are waiting
+            while len(uploads) >= 2 * self.upload_concurrency:
+                done, _ = await asyncio.wait(uploads, return_when=asyncio.FIRST_COMPLETED)
+                uploads.difference_update(done)
+                for task in done:
+                    task.result()
+            uploads.add(asyncio.create_task(upload_image(page_num, image)))
 
-    async def remove_blob(self, path: Optional[str] = None):
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
-            if not await container_client.exists():
-                return
-            if path is None:
-                prefix = None
-                blobs = container_client.list_blob_names()
-            else:
-                prefix = os.path.splitext(os.path.basename(path))[0]
-                blobs = container_client.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0])
-            async for blob_path in blobs:
-                # This still supports PDFs split into individual pages, but we could remove in future to simplify code
-                if (
-                    prefix is not None
-                    and (
-                        not re.match(rf"{prefix}-\d+\.pdf", blob_path) or not re.match(rf"{prefix}-\d+\.png", blob_path)
+        futures: list[asyncio.Future[list[bytes]]] = []
+        try:
+            with pymupdf.open(stream=pdf_data, filetype="pdf") as doc:
+                page_count = doc.page_count
+                blob_names = [
+                    BlobManager.blob_image_name_from_file_page(file.content.name, i) for i in range(page_count)
+                ]
+                page_images = [None] * page_count
+                if self.executor is None:
+                    for page_num, image in enumerate(
+                        render_pages(doc, 0, page_count, blob_names, self.image_format, self.image_quality)
+                    ):
+                        await add_upload(page_num, image)
+                        # Let the uploads progress before rendering the next page
+                        await asyncio.sleep(0)
+            if self.executor is not None:
+                loop = asyncio.get_running_loop()
+                page_ranges = split_page_ranges(page_count, self.executor_workers)
+                futures = [
+                    loop.run_in_executor(
+                        self.executor,
+                        render_page_images,
+                        pdf_data,
+                        page_range.start,
+                        page_range.stop,
+                        blob_names[page_range.start : page_range.stop],
+                        self.image_format,
+                        self.image_quality,
                     )
-                ) or (path is not None and blob_path == os.path.basename(path)):
+                    for page_range in page_ranges
+                ]
+                for page_range, future in zip(page_ranges, futures):
+                    for page_num, image in enumerate(await future, page_range.start):
+                        await add_upload(page_num, image)
+            await asyncio.gather(*uploads)
+        finally:
+            for future in futures:
+                future.cancel()
+            for task in uploads:
+                task.cancel()
+
+        return [page_image for page_image in page_images if page_image is not None]
+
+    async def remove_blob(self, path: Optional[str] = None) -> BlobRemovalSummary:
+        """
+        Removes the blob of a file along with the blobs of its pages, or all the blobs if no path is given.
+        Blobs are deleted in batches of MAX_DELETE_BATCH_SIZE, several batches at a time.
+        """
+        summary = BlobRemovalSummary()
+        container_client = await self.get_container_client(create=False)
+        if container_client is None:
+            return summary
+        if path is None:
+            blobs = container_client.list_blob_names()
+        else:
+            blobs = container_client.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(path))[0])
+
+        semaphore = asyncio.Semaphore(self.upload_concurrency)
+
+        async def remove_batch(batch: list[str]):
+            async with semaphore:
+                await self.delete_blob_batch(container_client, batch, summary)
+
+        tasks: list[asyncio.Task[None]] = []
+        batch: list[str] = []
+        try:
+            async for blob_name in blobs:
+                if path is not None and not BlobManager.is_blob_of_file(blob_name, path):
                     continue
-                logger.info("Removing blob %s", blob_path)
-                await container_client.delete_blob(blob_path)
+                batch.append(blob_name)
+                if len(batch) == MAX_DELETE_BATCH_SIZE:
+                    tasks.append(asyncio.create_task(remove_batch(batch)))
+                    batch = []
+            if batch:
+                tasks.append(asyncio.create_task(remove_batch(batch)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        logger.info("Removed %d blobs, failed to remove %d blobs", len(summary.deleted), len(summary.failed))
+        return summary
+
+    async def delete_blob_batch(
+        self, container_client: ContainerClient, blob_names: list[str], summary: BlobRemovalSummary
+    ):
+        logger.info("Removing %d blobs, from %s to %s", len(blob_names), blob_names[0], blob_names[-1])
+        try:
+            responses = await container_client.delete_blobs(*blob_names, raise_on_any_failure=False)
+            # The responses are in the same order as the blobs
+            statuses = [response.status_code async for response in responses]
+        except HttpResponseError as error:
+            # Batch requests aren't available everywhere, such as on some storage emulators, so delete one at a time
+            logger.warning("Batch deletion failed (%s), removing the blobs one at a time", error.message)
+            statuses = []
+            for blob_name in blob_names:
+                try:
+                    await container_client.delete_blob(blob_name)
+                    statuses.append(202)
+                except ResourceNotFoundError:
+                    statuses.append(404)
+                except HttpResponseError as blob_error:
+                    statuses.append(blob_error.status_code or 500)
+        for blob_name, status in zip(blob_names, statuses):
+            # A blob that no longer exists was already removed
+            if status < 300 or status == 404:
+                summary.deleted.append(blob_name)
+            else:
+                logger.error("Failed to remove blob %s (%s)", blob_name, status)
+                summary.failed.append(blob_name)
+
+    @classmethod
+    def is_blob_of_file(cls, blob_name: str, path: str) -> bool:
+        """
+        Checks if a blob stores a file, or the image of one of its pages as named by blob_image_name_from_file_page.
+        Other files whose name looks like a page, such as report-2.pdf next to report.pdf, are not matched.
+        """
+        filename = os.path.basename(path)
+        if blob_name == filename:
+            return True
+        file_stem, file_extension = os.path.splitext(filename)
+        # Page images are only rendered for PDFs
+        if file_extension.lower() != ".pdf":
+            return False
+        stem, extension = os.path.splitext(blob_name)
+        if extension != ".png":
+            return False
+        image_stem, separator, page = stem.rpartition("-")
+        return separator == "-" and image_stem == file_stem and page.isdigit()
 
     @classmethod
     def sourcepage_from_file_page(cls, filename, page=0) -> str:
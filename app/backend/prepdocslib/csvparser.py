@@ -1,16 +1,37 @@
 import csv
 from collections.abc import AsyncGenerator
-from typing import IO
+from concurrent.futures import Executor
+from typing import IO, Optional
 
 from .page import Page
-from .parser import Parser
+from .parser import Parser, run_in_executor
+
+
+def csv_to_pages(content_str: str) -> list[Page]:
+    # Create a CSV reader from the text content
+    reader = csv.reader(content_str.splitlines())
+    offset = 0
+
+    # Skip the header row
+    next(reader, None)
+
+    pages = []
+    for i, row in enumerate(reader):
+        page_text = ",".join(row)
+        pages.append(Page(i, offset, page_text))
+        offset += len(page_text) + 1  # Account for newline character
+    return pages
 
 
 class CsvParser(Parser):
     """
     Concrete parser that can parse CSV into Page objects. Each row becomes a Page object.
+    With an executor, the rows are parsed in it instead of on the event loop.
     """
 
+    def __init__(self, executor: Optional[Executor] = None):
+        self.executor = executor
+
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         # Check if content is in bytes (binary file) and decode to string
         content_str: str
@@ -19,14 +40,5 @@ class CsvParser(Parser):
         elif hasattr(content, "read"):  # Handle BufferedReader
             content_str = content.read().decode("utf-8")
 
-        # Create a CSV reader from the text content
-        reader = csv.reader(content_str.splitlines())
-        offset = 0
-
-        # Skip the header row
-        next(reader, None)
-
-        for i, row in enumerate(reader):
-            page_text = ",".join(row)
-            yield Page(i, offset, page_text)
-            offset += len(page_text) + 1  # Account for newline character
+        for page in await run_in_executor(self.executor, csv_to_pages, content_str):
+            yield page
@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+logger = logging.getLogger("scripts")
+
+T = TypeVar("T")
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of embeddings, stored in a SQLite database.
+    Embeddings are keyed by the model, the dimensions and the SHA-256 hash of the text, or of the bytes of an image,
+    so identical chunks and page images are only embedded once across runs. When the stored embeddings exceed
+    max_size_bytes, the least recently used ones are evicted.
+    The embeddings are read and written on a thread of the cache, one call at a time, so that SQLite doesn't block
+    the event loop. The database is opened when the cache is created, before the ingestion starts.
+    """
+
+    def __init__(self, path: str, max_size_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The connection is created here but only used on the thread of the executor afterwards
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embeddingcache")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, dimensions INTEGER NOT NULL, text_hash TEXT NOT NULL, "
+            "embedding BLOB NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (model, dimensions, text_hash))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.connection.commit()
+        self.size_bytes = self.connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def get_many(self, model: str, dimensions: int, texts: list[str]) -> list[Optional[list[float]]]:
+        """Returns the cached embedding of each text, or None for texts that are not cached"""
+        return await self.get_many_by_hash(model, dimensions, [self.hash_text(text) for text in texts])
+
+    async def get_many_by_hash(self, model: str, dimensions: int, hashes: list[str]) -> list[Optional[list[float]]]:
+        """Returns the cached embedding of each content hash, or None for hashes that are not cached"""
+        return await self.run(self.read, model, dimensions, hashes)
+
+    async def put_many(self, model: str, dimensions: int, texts: list[str], embeddings: list[list[float]]):
+        await self.put_many_by_hash(model, dimensions, [self.hash_text(text) for text in texts], embeddings)
+
+    async def put_many_by_hash(self, model: str, dimensions: int, hashes: list[str], embeddings: list[list[float]]):
+        await self.run(self.write, model, dimensions, hashes, embeddings)
+
+    def read(self, model: str, dimensions: int, hashes: list[str]) -> list[Optional[list[float]]]:
+        found: dict[str, list[float]] = {}
+        unique_hashes = list(set(hashes))
+        # Stay under SQLite's default limit of 999 variables per statement
+        for start in range(0, len(unique_hashes), 900):
+            chunk = unique_hashes[start : start + 900]
+            rows = self.connection.execute(
+                "SELECT text_hash, embedding FROM embeddings WHERE model = ? AND dimensions = ? "
+                f"AND text_hash IN ({', '.join('?' * len(chunk))})",
+                [model, dimensions, *chunk],
+            )
+            found.update((text_hash, array("d", embedding).tolist()) for text_hash, embedding in rows)
+        if found:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND dimensions = ? AND text_hash = ?",
+                [(now, model, dimensions, text_hash) for text_hash in found],
+            )
+            self.connection.commit()
+        embeddings = [found.get(text_hash) for text_hash in hashes]
+        hits = sum(1 for embedding in embeddings if embedding is not None)
+        self.hits += hits
+        self.misses += len(embeddings) - hits
+        return embeddings
+
+    def write(self, model: str, dimensions: int, hashes: list[str], embeddings: list[list[float]]):
+        now = time.time()
+        rows = {text_hash: array("d", embedding).tobytes() for text_hash, embedding in zip(hashes, embeddings)}
+        for text_hash, embedding in rows.items():
+            previous = self.connection.execute(
+                "SELECT LENGTH(embedding) FROM embeddings WHERE model = ? AND dimensions = ? AND text_hash = ?",
+                (model, dimensions, text_hash),
+            ).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO embeddings (model, dimensions, text_hash, embedding, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (model, dimensions, text_hash, embedding, now),
+            )
+            self.size_bytes += len(embedding) - (previous[0] if previous else 0)
+        self.connection.commit()
+        if self.size_bytes > self.max_size_bytes:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used embeddings until the cache fits in max_size_bytes"""
+        rowids = []
+        for rowid, size in self.connection.execute(
+            "SELECT rowid, LENGTH(embedding) FROM embeddings ORDER BY last_used"
+        ):
+            if self.size_bytes <= self.max_size_bytes:
+                break
+            rowids.append((rowid,))
+            self.size_bytes -= size
+        self.connection.executemany("DELETE FROM embeddings WHERE rowid = ?", rowids)
+        self.connection.commit()
+        logger.info("Evicted %d embeddings from the embedding cache", len(rowids))
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        logger.info(
+            "Embedding cache: %d hits, %d misses (%.1f%% hit rate), %d bytes stored",
+            self.hits,
+            self.misses,
+            100 * self.hits / total if total else 0,
+            self.size_bytes,
+        )
+
+    def close(self):
+        self.executor.shutdown()
+        self.connection.close()
@@ -1,6 +1,9 @@
+import asyncio
+import functools
 import logging
+import time
 from abc import ABC
-from collections.abc import Awaitable
+from collections.abc import Awaitable, Mapping
 from typing import Callable, Optional, Union
 from urllib.parse import urljoin
 
@@ -18,9 +21,18 @@ from tenacity import (
 )
 from typing_extensions import TypedDict
 
+from .embeddingcache import EmbeddingCache
+from .httpsession import SharedHttpSession
+
 logger = logging.getLogger("scripts")
 
 
+@functools.cache
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding of a model, loading it only once per model"""
+    return tiktoken.encoding_for_model(model_name)
+
+
 class EmbeddingBatch:
     """
     Represents a batch of text that is going to be embedded
@@ -35,6 +47,107 @@ class ExtraArgs(TypedDict, total=False):
     dimensions: int
 
 
+class TokenBucket:
+    """
+    Token bucket for a per-minute quota, such as the tokens or requests per minute of a deployment.
+    The capacity is learned from rate limit response headers: the reported limit if there is one,
+    otherwise the largest remaining amount seen so far. Until then, the bucket doesn't hold anything back.
+    """
+
+    def __init__(self):
+        self.capacity: Optional[float] = None
+        self.available = 0.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if self.capacity is not None:
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def update(self, limit: Optional[int], remaining: Optional[int], now: float):
+        self.refill(now)
+        if limit is not None:
+            self.capacity = float(limit)
+        if remaining is not None:
+            if self.capacity is None or (limit is None and remaining > self.capacity):
+                self.capacity = float(remaining)
+            self.available = float(remaining)
+
+    def delay(self, amount: int) -> float:
+        """Returns how many seconds to wait until the amount is available"""
+        if self.capacity is None or self.capacity <= 0:
+            return 0
+        needed = min(amount, self.capacity)
+        if self.available >= needed:
+            return 0
+        return (needed - self.available) * 60 / self.capacity
+
+    def take(self, amount: int):
+        if self.capacity is not None:
+            self.available -= amount
+
+
+def parse_int_header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class EmbeddingRateLimiter:
+    """
+    Paces requests to a single embeddings deployment, using the x-ratelimit-* headers of its responses
+    to track the remaining tokens and requests, and pausing every request after the deployment rate limits one.
+    """
+
+    def __init__(self):
+        self.tokens = TokenBucket()
+        self.requests = TokenBucket()
+        self.resume_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, token_count: int):
+        # Holding the lock while waiting makes requests go out in the order they asked for capacity
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens.refill(now)
+                self.requests.refill(now)
+                delay = max(self.resume_at - now, self.tokens.delay(token_count), self.requests.delay(1))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.tokens.take(token_count)
+            self.requests.take(1)
+
+    def update(self, headers: Mapping[str, str]):
+        now = time.monotonic()
+        self.tokens.update(
+            parse_int_header(headers, "x-ratelimit-limit-tokens"),
+            parse_int_header(headers, "x-ratelimit-remaining-tokens"),
+            now,
+        )
+        self.requests.update(
+            parse_int_header(headers, "x-ratelimit-limit-requests"),
+            parse_int_header(headers, "x-ratelimit-remaining-requests"),
+            now,
+        )
+
+    def back_off(self, seconds: float):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+
 class OpenAIEmbeddings(ABC):
     """
     Contains common logic across both OpenAI and Azure OpenAI embedding services
@@ -52,10 +165,20 @@ class OpenAIEmbeddings(ABC):
         "text-embedding-3-large": True,
     }
 
-    def __init__(self, open_ai_model_name: str, open_ai_dimensions: int, disable_batch: bool = False):
+    def __init__(
+        self,
+        open_ai_model_name: str,
+        open_ai_dimensions: int,
+        disable_batch: bool = False,
+        batch_concurrency: int = 1,
+        cache: Optional[EmbeddingCache] = None,
+    ):
         self.open_ai_model_name = open_ai_model_name
         self.open_ai_dimensions = open_ai_dimensions
         self.disable_batch = disable_batch
+        self.batch_concurrency = batch_concurrency
+        self.rate_limiter: Optional[EmbeddingRateLimiter] = None
+        self.cache = cache
 
     async def create_client(self) -> AsyncOpenAI:
         raise NotImplementedError
@@ -64,10 +187,27 @@ class OpenAIEmbeddings(ABC):
         logger.info("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
 
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
+        return len(get_encoding(self.open_ai_model_name).encode(text))
+
+    def calculate_token_lengths(
+        self, texts: list[str], token_counts: Optional[list[Optional[int]]] = None
+    ) -> list[int]:
+        """
+        Returns the token length of each text, reusing the token counts that are already known
+        and encoding the remaining texts in a single batch
+        """
+        known_counts = token_counts or [None] * len(texts)
+        unknown_texts = [text for text, count in zip(texts, known_counts) if count is None]
+        encoded_lengths = iter(
+            [len(tokens) for tokens in get_encoding(self.open_ai_model_name).encode_batch(unknown_texts)]
+            if unknown_texts
+            else []
+        )
+        return [next(encoded_lengths) if count is None else count for count in known_counts]
 
-    def split_text_into_batches(self, texts: list[str]) -> list[EmbeddingBatch]:
+    def split_text_into_batches(
+        self, texts: list[str], token_counts: Optional[list[Optional[int]]] = None
+    ) -> list[EmbeddingBatch]:
         batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
         if not batch_info:
             raise NotImplementedError(
@@ -79,8 +219,7 @@ class OpenAIEmbeddings(ABC):
         batches: list[EmbeddingBatch] = []
         batch: list[str] = []
         batch_token_length = 0
-        for text in texts:
-            text_token_length = self.calculate_token_length(text)
+        for text, text_token_length in zip(texts, self.calculate_token_lengths(texts, token_counts)):
             if batch_token_length + text_token_length >= batch_token_limit and len(batch) > 0:
                 batches.append(EmbeddingBatch(batch, batch_token_length))
                 batch = []
@@ -98,10 +237,14 @@ class OpenAIEmbeddings(ABC):
 
         return batches
 
-    async def create_embedding_batch(self, texts: list[str], dimensions_args: ExtraArgs) -> list[list[float]]:
-        batches = self.split_text_into_batches(texts)
+    async def create_embedding_batch(
+        self, texts: list[str], dimensions_args: ExtraArgs, token_counts: Optional[list[Optional[int]]] = None
+    ) -> list[list[float]]:
+        batches = self.split_text_into_batches(texts, token_counts)
         embeddings = []
         client = await self.create_client()
+        if self.batch_concurrency > 1:
+            return await self.create_embedding_batches_concurrently(client, batches, dimensions_args)
         for batch in batches:
             async for attempt in AsyncRetrying(
                 retry=retry_if_exception_type(RateLimitError),
@@ -122,6 +265,50 @@ class OpenAIEmbeddings(ABC):
 
         return embeddings
 
+    async def create_embedding_batches_concurrently(
+        self, client: AsyncOpenAI, batches: list[EmbeddingBatch], dimensions_args: ExtraArgs
+    ) -> list[list[float]]:
+        """
+        Sends up to batch_concurrency batches at the same time, paced by a rate limiter for the deployment.
+        The embeddings are returned in the same order as the batches.
+        """
+        if self.rate_limiter is None:
+            self.rate_limiter = EmbeddingRateLimiter()
+        rate_limiter = self.rate_limiter
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+        default_wait = wait_random_exponential(min=1, max=60)
+
+        def before_retry_sleep(retry_state):
+            exception = retry_state.outcome.exception()
+            headers = exception.response.headers if isinstance(exception, RateLimitError) else {}
+            rate_limiter.update(headers)
+            rate_limiter.back_off(retry_after_seconds(headers) or default_wait(retry_state))
+            self.before_retry_sleep(retry_state)
+
+        async def embed_batch(batch: EmbeddingBatch) -> list[list[float]]:
+            async with semaphore:
+                async for attempt in AsyncRetrying(
+                    retry=retry_if_exception_type(RateLimitError),
+                    stop=stop_after_attempt(15),
+                    before_sleep=before_retry_sleep,
+                ):
+                    with attempt:
+                        await rate_limiter.acquire(batch.token_length)
+                        raw_response = await client.embeddings.with_raw_response.create(
+                            model=self.open_ai_model_name, input=batch.texts, **dimensions_args
+                        )
+                        rate_limiter.update(raw_response.headers)
+                        emb_response = raw_response.parse()
+                logger.info(
+                    "Computed embeddings in batch. Batch size: %d, Token count: %d",
+                    len(batch.texts),
+                    batch.token_length,
+                )
+                return [data.embedding for data in emb_response.data]
+
+        batch_embeddings = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        return [embedding for embeddings in batch_embeddings for embedding in embeddings]
+
     async def create_embedding_single(self, text: str, dimensions_args: ExtraArgs) -> list[float]:
         client = await self.create_client()
         async for attempt in AsyncRetrying(
@@ -138,7 +325,32 @@ class OpenAIEmbeddings(ABC):
 
         return emb_response.data[0].embedding
 
-    async def create_embeddings(self, texts: list[str]) -> list[list[float]]:
+    async def create_embeddings(
+        self, texts: list[str], token_counts: Optional[list[Optional[int]]] = None
+    ) -> list[list[float]]:
+        """
+        Returns the embedding of each text. The token counts of the texts can be passed when they are already known,
+        for example from the text splitter, so the texts don't need to be tokenized again for batching.
+        """
+        if self.cache is None:
+            return await self.compute_embeddings(texts, token_counts)
+
+        cached = await self.cache.get_many(self.open_ai_model_name, self.open_ai_dimensions, texts)
+        # Only embed each missing text once, even if it appears several times
+        missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, cached) if embedding is None))
+        computed: dict[str, list[float]] = {}
+        if missing_texts:
+            known_counts = dict(zip(texts, token_counts or [None] * len(texts)))
+            missing_counts = [known_counts[text] for text in missing_texts]
+            computed = dict(zip(missing_texts, await self.compute_embeddings(missing_texts, missing_counts)))
+            await self.cache.put_many(
+                self.open_ai_model_name, self.open_ai_dimensions, missing_texts, list(computed.values())
+            )
+        return [computed[text] if embedding is None else embedding for text, embedding in zip(texts, cached)]
+
+    async def compute_embeddings(
+        self, texts: list[str], token_counts: Optional[list[Optional[int]]] = None
+    ) -> list[list[float]]:
 
         dimensions_args: ExtraArgs = (
             {"dimensions": self.open_ai_dimensions}
@@ -147,7 +359,7 @@ class OpenAIEmbeddings(ABC):
         )
 
         if not self.disable_batch and self.open_ai_model_name in OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL:
-            return await self.create_embedding_batch(texts, dimensions_args)
+            return await self.create_embedding_batch(texts, dimensions_args, token_counts)
 
         return [await self.create_embedding_single(text, dimensions_args) for text in texts]
 
@@ -168,8 +380,10 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         open_ai_custom_url: Union[str, None] = None,
         disable_batch: bool = False,
+        batch_concurrency: int = 1,
+        cache: Optional[EmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch, batch_concurrency, cache)
         self.open_ai_service = open_ai_service
         if open_ai_service:
             self.open_ai_endpoint = f"https://{open_ai_service}.openai.azure.com"
@@ -217,8 +431,10 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         credential: str,
         organization: Optional[str] = None,
         disable_batch: bool = False,
+        batch_concurrency: int = 1,
+        cache: Optional[EmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch, batch_concurrency, cache)
         self.credential = credential
         self.organization = organization
 
@@ -226,38 +442,124 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         return AsyncOpenAI(api_key=self.credential, organization=self.organization)
 
 
+# Status codes of the Vision API that may succeed if the request is sent again
+RETRIABLE_VISION_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class RetriableVisionError(Exception):
+    """A request to the Vision API that failed with a retriable status code"""
+
+    def __init__(self, status: int, headers: Mapping[str, str]):
+        super().__init__(f"Vision API request failed with status {status}")
+        self.status = status
+        self.headers = headers
+
+
 class ImageEmbeddings:
     """
     Class for using image embeddings from Azure AI Vision
     To learn more, please visit https://learn.microsoft.com/azure/ai-services/computer-vision/how-to/image-retrieval#call-the-vectorize-image-api
     """
 
-    def __init__(self, endpoint: str, token_provider: Callable[[], Awaitable[str]]):
+    MODEL_VERSION = "2023-04-15"
+    # Dimensions of the embeddings of the multimodal model, part of the cache key
+    DIMENSIONS = 1024
+
+    def __init__(
+        self,
+        endpoint: str,
+        token_provider: Callable[[], Awaitable[str]],
+        concurrency: int = 4,
+        cache: Optional[EmbeddingCache] = None,
+        http_session: Optional[SharedHttpSession] = None,
+    ):
         self.token_provider = token_provider
         self.endpoint = endpoint
-
-    async def create_embeddings(self, blob_urls: list[str]) -> list[list[float]]:
+        self.concurrency = concurrency
+        self.cache = cache
+        self.cache_model = f"azure-ai-vision-{ImageEmbeddings.MODEL_VERSION}"
+        # The session is shared by all the requests, so connections to the Vision endpoint are reused across files.
+        # A session given by the caller is also shared with other services, and is closed by the caller.
+        self.owns_http_session = http_session is None
+        self.http_session = http_session or SharedHttpSession()
+        self.rate_limiter = EmbeddingRateLimiter()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        return self.http_session.get()
+
+    async def close(self):
+        if self.owns_http_session:
+            await self.http_session.close()
+
+    async def create_embeddings(
+        self, blob_urls: list[str], content_hashes: Optional[list[str]] = None
+    ) -> list[list[float]]:
+        """
+        Returns the embedding of the image at each URL. When the SHA-256 hashes of the images are given,
+        the embeddings of images that were embedded before are taken from the cache instead.
+        """
+        if self.cache is None or content_hashes is None:
+            return await self.compute_embeddings(blob_urls)
+
+        cached = await self.cache.get_many_by_hash(self.cache_model, ImageEmbeddings.DIMENSIONS, content_hashes)
+        # Only embed each missing image once, even if several pages look the same
+        missing_urls: dict[str, str] = {}
+        for blob_url, content_hash, embedding in zip(blob_urls, content_hashes, cached):
+            if embedding is None:
+                missing_urls.setdefault(content_hash, blob_url)
+        computed: dict[str, list[float]] = {}
+        if missing_urls:
+            computed = dict(zip(missing_urls, await self.compute_embeddings(list(missing_urls.values()))))
+            await self.cache.put_many_by_hash(
+                self.cache_model, ImageEmbeddings.DIMENSIONS, list(computed), list(computed.values())
+            )
+        return [
+            computed[content_hash] if embedding is None else embedding
+            for content_hash, embedding in zip(content_hashes, cached)
+        ]
+
+    async def compute_embeddings(self, blob_urls: list[str]) -> list[list[float]]:
+        """
+        Sends up to concurrency requests at the same time, returning the embeddings in the same order as the URLs.
+        All the requests pause for the time given by the retry-after header whenever one of them is rate limited.
+        """
         endpoint = urljoin(self.endpoint, "computervision/retrieval:vectorizeImage")
-        headers = {"Content-Type": "application/json"}
-        params = {"api-version": "2024-02-01", "model-version": "2023-04-15"}
-        headers["Authorization"] = "Bearer " + await self.token_provider()
+        params = {"api-version": "2024-02-01", "model-version": ImageEmbeddings.MODEL_VERSION}
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer " + await self.token_provider()}
+        session = self.get_session()
+        rate_limiter = self.rate_limiter
+        semaphore = asyncio.Semaphore(self.concurrency)
+        default_wait = wait_random_exponential(min=15, max=60)
+
+        def before_retry_sleep(retry_state):
+            exception = retry_state.outcome.exception()
+            retry_after = (
+                retry_after_seconds(exception.headers) if isinstance(exception, RetriableVisionError) else None
+            )
+            rate_limiter.back_off(default_wait(retry_state) if retry_after is None else retry_after)
+            self.before_retry_sleep(retry_state)
 
-        embeddings: list[list[float]] = []
-        async with aiohttp.ClientSession(headers=headers) as session:
-            for blob_url in blob_urls:
+        async def embed_image(blob_url: str) -> list[float]:
+            async with semaphore:
                 async for attempt in AsyncRetrying(
-                    retry=retry_if_exception_type(Exception),
-                    wait=wait_random_exponential(min=15, max=60),
+                    retry=retry_if_exception_type(
+                        (RetriableVisionError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+                    ),
                     stop=stop_after_attempt(15),
-                    before_sleep=self.before_retry_sleep,
+                    before_sleep=before_retry_sleep,
                 ):
                     with attempt:
-                        body = {"url": blob_url}
-                        async with session.post(url=endpoint, params=params, json=body) as resp:
+                        await rate_limiter.acquire(0)
+                        async with session.post(
+                            url=endpoint, params=params, headers=headers, json={"url": blob_url}
+                        ) as resp:
+                            if resp.status in RETRIABLE_VISION_STATUS_CODES:
+                                raise RetriableVisionError(resp.status, resp.headers)
+                            resp.raise_for_status()
                             resp_json = await resp.json()
-                            embeddings.append(resp_json["vector"])
+                return resp_json["vector"]
 
-        return embeddings
+        return list(await asyncio.gather(*(embed_image(blob_url) for blob_url in blob_urls)))
 
     def before_retry_sleep(self, retry_state):
         logger.info("Rate limited on the Vision embeddings API, sleeping before retrying...")
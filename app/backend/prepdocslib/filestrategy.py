@@ -1,39 +1,63 @@
 import logging
-from typing import Optional
+from collections.abc import AsyncGenerator
+from typing import Any, Optional
 
 from azure.core.credentials import AzureKeyCredential
 
-from .blobmanager import BlobManager
+from .blobmanager import BlobManager, PageImage
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
 from .fileprocessor import FileProcessor
+from .httpsession import SharedHttpSession
+from .ingestionpipeline import PipelineConfig, run_pipeline
 from .listfilestrategy import File, ListFileStrategy
 from .mediadescriber import ContentUnderstandingDescriber
-from .searchmanager import SearchManager, Section
+from .searchmanager import IndexedChunks, SearchManager, Section, batch_sections
 from .strategy import DocumentAction, SearchInfo, Strategy
 
 logger = logging.getLogger("scripts")
 
 
-async def parse_file(
+async def parse_file_sections(
     file: File,
     file_processors: dict[str, FileProcessor],
     category: Optional[str] = None,
     image_embeddings: Optional[ImageEmbeddings] = None,
-) -> list[Section]:
+) -> AsyncGenerator[Section, None]:
+    """
+    Yields the sections of a file while it is being parsed, so the whole document never needs to be held in memory
+    """
     key = file.file_extension().lower()
     processor = file_processors.get(key)
     if processor is None:
         logger.info("Skipping '%s', no parser found.", file.filename())
-        return []
+        return
     logger.info("Ingesting '%s'", file.filename())
-    pages = [page async for page in processor.parser.parse(content=file.content)]
-    logger.info("Splitting '%s' into sections", file.filename())
     if image_embeddings:
         logger.warning("Each page will be split into smaller chunks of text, but images will be of the entire page.")
-    sections = [
-        Section(split_page, content=file, category=category) for split_page in processor.splitter.split_pages(pages)
-    ]
-    return sections
+    async for split_page in processor.splitter.split_pages_stream(processor.parser.parse(content=file.content)):
+        yield Section(split_page, content=file, category=category)
+
+
+async def parse_file(
+    file: File,
+    file_processors: dict[str, FileProcessor],
+    category: Optional[str] = None,
+    image_embeddings: Optional[ImageEmbeddings] = None,
+) -> list[Section]:
+    return [section async for section in parse_file_sections(file, file_processors, category, image_embeddings)]
+
+
+class IngestionItem:
+    """
+    A file moving through the ingestion pipeline, along with everything computed for it by earlier stages
+    """
+
+    def __init__(self, file: File):
+        self.file = file
+        self.sections: list[Section] = []
+        self.page_images: Optional[list[PageImage]] = None
+        self.documents: list[dict[str, Any]] = []
+        self.indexed_chunks: Optional[IndexedChunks] = None
 
 
 class FileStrategy(Strategy):
@@ -56,6 +80,9 @@ class FileStrategy(Strategy):
         category: Optional[str] = None,
         use_content_understanding: bool = False,
         content_understanding_endpoint: Optional[str] = None,
+        pipeline_config: Optional[PipelineConfig] = None,
+        use_content_hash_ids: bool = False,
+        http_session: Optional[SharedHttpSession] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -70,6 +97,9 @@ class FileStrategy(Strategy):
         self.category = category
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        self.pipeline_config = pipeline_config
+        self.use_content_hash_ids = use_content_hash_ids
+        self.http_session = http_session
 
     def setup_search_manager(self):
         self.search_manager = SearchManager(
@@ -80,6 +110,7 @@ class FileStrategy(Strategy):
             self.embeddings,
             field_name_embedding=self.search_field_name_embedding,
             search_images=self.image_embeddings is not None,
+            use_content_hash_ids=self.use_content_hash_ids,
         )
 
     async def setup(self):
@@ -93,33 +124,151 @@ class FileStrategy(Strategy):
                 raise ValueError(
                     "AzureKeyCredential is not supported for Content Understanding, use keyless auth instead"
                 )
-            cu_manager = ContentUnderstandingDescriber(self.content_understanding_endpoint, self.search_info.credential)
+            cu_manager = ContentUnderstandingDescriber(
+                self.content_understanding_endpoint, self.search_info.credential, self.http_session
+            )
             await cu_manager.create_analyzer()
 
     async def run(self):
         self.setup_search_manager()
-        if self.document_action == DocumentAction.Add:
+        if self.document_action == DocumentAction.Add and self.pipeline_config:
+            await self.run_with_pipeline(self.pipeline_config)
+        elif self.document_action == DocumentAction.Add:
             files = self.list_file_strategy.list()
             async for file in files:
                 try:
-                    sections = await parse_file(file, self.file_processors, self.category, self.image_embeddings)
-                    if sections:
-                        blob_sas_uris = await self.blob_manager.upload_blob(file)
-                        blob_image_embeddings: Optional[list[list[float]]] = None
-                        if self.image_embeddings and blob_sas_uris:
-                            blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
-                        await self.search_manager.update_content(sections, blob_image_embeddings, url=file.url)
+                    sections = parse_file_sections(file, self.file_processors, self.category, self.image_embeddings)
+                    section_offset = 0
+                    blob_image_embeddings: Optional[list[list[float]]] = None
+                    image_hashes: Optional[list[str]] = None
+                    indexed_chunks = await self.search_manager.get_indexed_chunks(file)
+                    async for batch in batch_sections(sections):
+                        # Only upload the blob once the file is known to have sections
+                        if section_offset == 0:
+                            page_images = await self.blob_manager.upload_blob(file)
+                            if self.image_embeddings and page_images:
+                                image_hashes = [image.content_hash for image in page_images]
+                                blob_image_embeddings = await self.image_embeddings.create_embeddings(
+                                    [image.url for image in page_images], image_hashes
+                                )
+                        await self.search_manager.update_content(
+                            batch,
+                            blob_image_embeddings,
+                            url=file.url,
+                            section_offset=section_offset,
+                            indexed_chunks=indexed_chunks,
+                            image_hashes=image_hashes,
+                        )
+                        section_offset += len(batch)
+                    # A file that no longer has any sections leaves all of its previous chunks stale
+                    if indexed_chunks:
+                        await self.search_manager.remove_stale_chunks(indexed_chunks)
+                    self.list_file_strategy.record_ingested(file)
                 finally:
                     if file:
                         file.close()
+            await self.remove_deleted_files()
         elif self.document_action == DocumentAction.Remove:
             paths = self.list_file_strategy.list_paths()
             async for path in paths:
                 await self.blob_manager.remove_blob(path)
                 await self.search_manager.remove_content(path)
+                self.list_file_strategy.forget(path)
         elif self.document_action == DocumentAction.RemoveAll:
             await self.blob_manager.remove_blob()
             await self.search_manager.remove_content()
+            self.list_file_strategy.forget_all()
+
+    async def remove_deleted_files(self):
+        """
+        Removes the files that were ingested by a previous run but that are no longer listed,
+        if the list strategy records the ingested files in a manifest
+        """
+        if self.list_file_strategy.manifest is None:
+            return
+        listed_paths = {path async for path in self.list_file_strategy.list_paths()}
+        for path in sorted(self.list_file_strategy.removed_paths(listed_paths)):
+            logger.info("Removing '%s', it was deleted since it was ingested", path)
+            await self.blob_manager.remove_blob(path)
+            await self.search_manager.remove_content(path)
+            self.list_file_strategy.forget(path)
+
+    async def run_with_pipeline(self, config: PipelineConfig):
+        """
+        Ingests files through concurrent parse, blob upload, embedding and index upload stages,
+        so that many files are in flight at once while each stage is limited to its own worker count.
+        """
+        in_flight: set[File] = set()
+
+        async def list_files() -> AsyncGenerator[IngestionItem, None]:
+            async for file in self.list_file_strategy.list():
+                in_flight.add(file)
+                yield IngestionItem(file)
+
+        def close(item: IngestionItem):
+            item.file.close()
+            in_flight.discard(item.file)
+
+        async def parse(item: IngestionItem) -> Optional[IngestionItem]:
+            item.sections = await parse_file(item.file, self.file_processors, self.category, self.image_embeddings)
+            if not item.sections:
+                # The file skips the later stages, so the chunks of its previous version are removed here
+                try:
+                    indexed_chunks = await self.search_manager.get_indexed_chunks(item.file)
+                    if indexed_chunks:
+                        await self.search_manager.remove_stale_chunks(indexed_chunks)
+                    self.list_file_strategy.record_ingested(item.file)
+                finally:
+                    close(item)
+                return None
+            return item
+
+        async def upload_blob(item: IngestionItem) -> IngestionItem:
+            item.page_images = await self.blob_manager.upload_blob(item.file)
+            return item
+
+        async def embed(item: IngestionItem) -> IngestionItem:
+            blob_image_embeddings: Optional[list[list[float]]] = None
+            image_hashes: Optional[list[str]] = None
+            if self.image_embeddings and item.page_images:
+                image_hashes = [image.content_hash for image in item.page_images]
+                blob_image_embeddings = await self.image_embeddings.create_embeddings(
+                    [image.url for image in item.page_images], image_hashes
+                )
+            item.indexed_chunks = await self.search_manager.get_indexed_chunks(item.file)
+            item.documents = await self.search_manager.create_documents(
+                item.sections,
+                blob_image_embeddings,
+                url=item.file.url,
+                indexed_chunks=item.indexed_chunks,
+                image_hashes=image_hashes,
+            )
+            item.sections = []
+            return item
+
+        async def index(item: IngestionItem) -> None:
+            try:
+                await self.search_manager.upload_documents(item.documents)
+                if item.indexed_chunks:
+                    await self.search_manager.remove_stale_chunks(item.indexed_chunks)
+                self.list_file_strategy.record_ingested(item.file)
+            finally:
+                close(item)
+
+        try:
+            await run_pipeline(
+                list_files(),
+                [
+                    (config.parse, parse),
+                    (config.blob, upload_blob),
+                    (config.embed, embed),
+                    (config.index, index),
+                ],
+            )
+        finally:
+            for file in in_flight:
+                file.close()
+        await self.remove_deleted_files()
 
 
 class UploadUserFileStrategy:
@@ -153,9 +302,10 @@ class UploadUserFileStrategy:
     async def add_file(self, file: File):
         if self.image_embeddings:
             logging.warning("Image embeddings are not currently supported for the user upload feature")
-        sections = await parse_file(file, self.file_processors)
-        if sections:
-            await self.search_manager.update_content(sections, url=file.url)
+        section_offset = 0
+        async for batch in batch_sections(parse_file_sections(file, self.file_processors)):
+            await self.search_manager.update_content(batch, url=file.url, section_offset=section_offset)
+            section_offset += len(batch)
 
     async def remove_file(self, filename: str, oid: str):
         if filename is None or filename == "":
@@ -1,12 +1,13 @@
 import logging
 import re
 from collections.abc import AsyncGenerator
-from typing import IO
+from concurrent.futures import Executor
+from typing import IO, Optional, Union
 
 from bs4 import BeautifulSoup
 
 from .page import Page
-from .parser import Parser
+from .parser import Parser, run_in_executor
 
 logger = logging.getLogger("scripts")
 
@@ -28,8 +29,22 @@ def cleanup_data(data: str) -> str:
     return output.strip()
 
 
+def html_to_text(data: Union[str, bytes]) -> str:
+    soup = BeautifulSoup(data, "html.parser")
+
+    # Get text only from html file
+    result = soup.get_text()
+
+    return cleanup_data(result)
+
+
 class LocalHTMLParser(Parser):
-    """Parses HTML text into Page objects."""
+    """Parses HTML text into Page objects.
+    With an executor, BeautifulSoup runs in it instead of on the event loop.
+    """
+
+    def __init__(self, executor: Optional[Executor] = None):
+        self.executor = executor
 
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         """Parses the given content.
@@ -42,9 +57,6 @@ class LocalHTMLParser(Parser):
         logger.info("Extracting text from '%s' using local HTML parser (BeautifulSoup)", content.name)
 
         data = content.read()
-        soup = BeautifulSoup(data, "html.parser")
-
-        # Get text only from html file
-        result = soup.get_text()
+        text = await run_in_executor(self.executor, html_to_text, data)
 
-        yield Page(0, 0, text=cleanup_data(result))
+        yield Page(0, 0, text=text)
@@ -0,0 +1,71 @@
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import aiohttp
+
+# Most requests go to a handful of Azure endpoints, so their connections and DNS records are worth keeping around
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 32
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+
+
+def create_http_session(
+    connection_limit: int = CONNECTION_LIMIT,
+    connection_limit_per_host: int = CONNECTION_LIMIT_PER_HOST,
+    keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+    dns_cache_ttl: int = DNS_CACHE_TTL,
+) -> aiohttp.ClientSession:
+    """
+    Creates a session whose connections are kept alive between requests, so that they skip the TCP and TLS handshakes.
+    Must be called from a running event loop, and closed once it is no longer needed.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        limit_per_host=connection_limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=dns_cache_ttl,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+@asynccontextmanager
+async def use_http_session(session: Optional[aiohttp.ClientSession]) -> AsyncGenerator[aiohttp.ClientSession, None]:
+    """Yields the given session, or a new session that is closed on exit when none is given"""
+    if session is not None:
+        yield session
+    else:
+        async with aiohttp.ClientSession() as new_session:
+            yield new_session
+
+
+class SharedHttpSession:
+    """
+    Session shared by the ingestion services, created on first use so that it belongs to the event loop that runs them
+    """
+
+    def __init__(
+        self,
+        connection_limit: int = CONNECTION_LIMIT,
+        connection_limit_per_host: int = CONNECTION_LIMIT_PER_HOST,
+        keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+        dns_cache_ttl: int = DNS_CACHE_TTL,
+    ):
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def get(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = create_http_session(
+                self.connection_limit, self.connection_limit_per_host, self.keepalive_timeout, self.dns_cache_ttl
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
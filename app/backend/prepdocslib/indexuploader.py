@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+from typing import Any
+
+from azure.search.documents.aio import SearchClient
+
+logger = logging.getLogger("scripts")
+
+# Azure AI Search accepts at most 1000 documents and 16 MB per indexing request
+MAX_UPLOAD_BATCH_SIZE = 1000
+MAX_UPLOAD_BATCH_BYTES = 14 * 1024 * 1024
+# Status codes of the documents that failed to index but may succeed if they are sent again
+# https://learn.microsoft.com/rest/api/searchservice/addupdate-or-delete-documents#response
+RETRIABLE_STATUS_CODES = {409, 422, 429, 503}
+
+
+def batch_documents_by_size(
+    documents: list[dict[str, Any]],
+    max_batch_size: int = MAX_UPLOAD_BATCH_SIZE,
+    max_batch_bytes: int = MAX_UPLOAD_BATCH_BYTES,
+) -> list[list[dict[str, Any]]]:
+    """
+    Splits documents into batches of at most max_batch_size documents, whose JSON serialization
+    stays under max_batch_bytes. A document that is larger than max_batch_bytes on its own gets its own batch.
+    """
+    batches: list[list[dict[str, Any]]] = []
+    batch: list[dict[str, Any]] = []
+    batch_bytes = 0
+    for document in documents:
+        # Each document is followed by a comma in the request body
+        document_bytes = len(json.dumps(document, separators=(",", ":")).encode("utf-8")) + 1
+        if batch and (len(batch) >= max_batch_size or batch_bytes + document_bytes > max_batch_bytes):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(document)
+        batch_bytes += document_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class IndexingError(Exception):
+    """Documents that could not be indexed, even after retrying them"""
+
+    def __init__(self, keys: list[str]):
+        super().__init__(f"Failed to index {len(keys)} documents: {', '.join(keys)}")
+        self.keys = keys
+
+
+class IndexUploader:
+    """
+    Uploads documents to a search index in batches that fit in a request, several batches at a time.
+    Uploads run in the background, so the caller can prepare the next documents in the meantime,
+    and documents that failed with a retriable status code are sent again, without the rest of their batch.
+    """
+
+    def __init__(
+        self,
+        search_client: SearchClient,
+        concurrency: int = 4,
+        max_batch_size: int = MAX_UPLOAD_BATCH_SIZE,
+        max_batch_bytes: int = MAX_UPLOAD_BATCH_BYTES,
+        max_retries: int = 3,
+        retry_delay: float = 1.0,
+    ):
+        self.search_client = search_client
+        self.concurrency = concurrency
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks: set[asyncio.Task[None]] = set()
+        self.failed_keys: list[str] = []
+
+    async def add(self, documents: list[dict[str, Any]]):
+        """
+        Starts uploading the documents. Waits first if too many batches are already waiting for an upload,
+        so that the documents held in memory stay bounded.
+        """
+        for batch in batch_documents_by_size(documents, self.max_batch_size, self.max_batch_bytes):
+            while len(self.tasks) >= 2 * self.concurrency:
+                done, _ = await asyncio.wait(self.tasks, return_when=asyncio.FIRST_COMPLETED)
+                self.tasks -= done
+                for task in done:
+                    task.result()
+            self.tasks.add(asyncio.create_task(self.upload_batch(batch)))
+
+    async def flush(self):
+        """
+        Waits for all the uploads to complete, and raises the first upload error if any,
+        or an IndexingError if some documents could not be indexed, so that their file isn't recorded as ingested
+        """
+        try:
+            await asyncio.gather(*self.tasks)
+        finally:
+            self.cancel()
+        if self.failed_keys:
+            raise IndexingError(self.failed_keys)
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = set()
+
+    async def upload_batch(self, documents: list[dict[str, Any]]):
+        for attempt in range(self.max_retries + 1):
+            async with self.semaphore:
+                results = await self.search_client.upload_documents(documents)
+            failed = {result.key: result for result in results or [] if not result.succeeded and result.key}
+            if not failed:
+                return
+            retriable_keys = {key for key, result in failed.items() if result.status_code in RETRIABLE_STATUS_CODES}
+            for key, result in failed.items():
+                if key not in retriable_keys:
+                    logger.error(
+                        "Failed to index document '%s' (%s): %s", key, result.status_code, result.error_message
+                    )
+                    self.failed_keys.append(key)
+            if not retriable_keys:
+                return
+            if attempt == self.max_retries:
+                logger.error("Failed to index %d documents after %d retries", len(retriable_keys), self.max_retries)
+                self.failed_keys.extend(sorted(retriable_keys))
+                return
+            logger.info("Retrying %d documents that failed to index", len(retriable_keys))
+            documents = [document for document in documents if document["id"] in retriable_keys]
+            await asyncio.sleep(self.retry_delay * 2**attempt)
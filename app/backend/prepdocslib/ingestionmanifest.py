@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import IO, Optional
+
+logger = logging.getLogger("scripts")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file: IO) -> str:
+    """Computes the SHA-256 hash of a binary file, reading it in chunks so it is never fully loaded in memory"""
+    file_hash = hashlib.sha256()
+    while chunk := file.read(HASH_CHUNK_SIZE):
+        file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    """
+    State of a file when it was ingested
+
+    Attributes:
+        source (str): Listing that the file was found in, such as a local path pattern or a data lake path
+        path (str): Path of the file within that listing
+        size (int): Size of the file in bytes
+        mtime (float): Last modification time of a local file
+        etag (str): ETag of a data lake file
+        content_hash (str): SHA-256 hash of the content of a local file
+        acls (str): Access control lists of the file, serialized as JSON
+    """
+
+    source: str
+    path: str
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+    etag: Optional[str] = None
+    content_hash: Optional[str] = None
+    acls: Optional[str] = None
+
+
+class IngestionManifest:
+    """
+    Record of the files that were ingested, stored in a SQLite database.
+    List strategies use it to skip unchanged files, and to find files that were deleted since they were ingested.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "source TEXT NOT NULL, path TEXT NOT NULL, size INTEGER, mtime REAL, etag TEXT, content_hash TEXT, "
+            "acls TEXT, ingested_at REAL NOT NULL, PRIMARY KEY (source, path))"
+        )
+        self.connection.commit()
+
+    def get(self, source: str, path: str) -> Optional[ManifestEntry]:
+        row = self.connection.execute(
+            "SELECT size, mtime, etag, content_hash, acls FROM files WHERE source = ? AND path = ?", (source, path)
+        ).fetchone()
+        if row is None:
+            return None
+        size, mtime, etag, content_hash, acls = row
+        return ManifestEntry(source, path, size, mtime, etag, content_hash, acls)
+
+    def record(self, entry: ManifestEntry):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (source, path, size, mtime, etag, content_hash, acls, ingested_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                entry.source,
+                entry.path,
+                entry.size,
+                entry.mtime,
+                entry.etag,
+                entry.content_hash,
+                entry.acls,
+                time.time(),
+            ),
+        )
+        self.connection.commit()
+
+    def remove(self, source: str, path: str):
+        self.connection.execute("DELETE FROM files WHERE source = ? AND path = ?", (source, path))
+        self.connection.commit()
+
+    def clear(self, source: str):
+        """Removes the files of a listing, the files of other listings that share the manifest are kept"""
+        self.connection.execute("DELETE FROM files WHERE source = ?", (source,))
+        self.connection.commit()
+
+    def paths(self, source: str) -> list[str]:
+        return [row[0] for row in self.connection.execute("SELECT path FROM files WHERE source = ?", (source,))]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,113 @@
+import asyncio
+import dataclasses
+from collections.abc import AsyncIterator, Awaitable, Sequence
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+# A stage handler receives an item and returns the item to pass on to the next stage, or None to drop it
+StageHandler = Callable[[Any], Awaitable[Optional[Any]]]
+
+
+@dataclass(frozen=True)
+class PipelineStage:
+    """
+    Concurrency settings for a single stage of the ingestion pipeline
+
+    Attributes:
+        workers (int): Number of items the stage processes concurrently
+        queue_size (int): Maximum number of items waiting for the stage. Full queues make earlier stages wait, which keeps memory bounded
+    """
+
+    workers: int = 1
+    queue_size: int = 2
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+    """
+    Concurrency settings for every stage of the ingestion pipeline.
+    Files are listed by a single producer, which feeds the parse stage.
+    """
+
+    parse: PipelineStage = PipelineStage(workers=4, queue_size=8)
+    blob: PipelineStage = PipelineStage(workers=4, queue_size=8)
+    embed: PipelineStage = PipelineStage(workers=2, queue_size=4)
+    index: PipelineStage = PipelineStage(workers=2, queue_size=4)
+
+    @classmethod
+    def from_spec(cls, spec: str) -> "PipelineConfig":
+        """
+        Parses a comma-separated list of STAGE=WORKERS[:QUEUE_SIZE] settings, for example "parse=8,embed=2:8".
+        Stages that are not listed keep their default settings, and the queue size defaults to twice the workers.
+        """
+        stage_names = [field.name for field in dataclasses.fields(cls)]
+        stages: dict[str, PipelineStage] = {}
+        for setting in spec.split(","):
+            if not setting.strip():
+                continue
+            name, _, value = setting.partition("=")
+            name = name.strip()
+            workers_value, _, queue_size_value = value.partition(":")
+            try:
+                workers = int(workers_value)
+                queue_size = int(queue_size_value) if queue_size_value else 2 * workers
+            except ValueError:
+                workers = queue_size = 0
+            if name not in stage_names or workers < 1 or queue_size < 1:
+                raise ValueError(
+                    f"Invalid pipeline setting '{setting}', expected STAGE=WORKERS[:QUEUE_SIZE] "
+                    f"with STAGE one of {', '.join(stage_names)}"
+                )
+            stages[name] = PipelineStage(workers=workers, queue_size=queue_size)
+        return dataclasses.replace(cls(), **stages)
+
+
+class _Done:
+    """Sentinel telling a stage worker that no more items are coming"""
+
+
+async def run_pipeline(source: AsyncIterator[Any], stages: Sequence[tuple[PipelineStage, StageHandler]]):
+    """
+    Feeds every item from source through the stages in order. Each stage has its own bounded queue and its own
+    workers, so all stages run concurrently while a slow stage holds back the stages before it.
+    If any handler raises, the remaining work is cancelled and the exception is re-raised.
+    """
+    queues: list[asyncio.Queue] = [asyncio.Queue(maxsize=stage.queue_size) for stage, _ in stages]
+
+    async def finish_stage(index: int):
+        if index < len(stages):
+            for _ in range(stages[index][0].workers):
+                await queues[index].put(_Done)
+
+    async def produce():
+        async for item in source:
+            await queues[0].put(item)
+        await finish_stage(0)
+
+    async def work(index: int, handler: StageHandler):
+        while (item := await queues[index].get()) is not _Done:
+            result = await handler(item)
+            if result is not None and index + 1 < len(stages):
+                await queues[index + 1].put(result)
+
+    workers = [
+        [asyncio.ensure_future(work(index, handler)) for _ in range(stage.workers)]
+        for index, (stage, handler) in enumerate(stages)
+    ]
+
+    async def close_stage(index: int):
+        await asyncio.gather(*workers[index])
+        await finish_stage(index + 1)
+
+    tasks = [asyncio.ensure_future(produce())]
+    tasks += [task for stage_workers in workers for task in stage_workers]
+    tasks += [asyncio.ensure_future(close_stage(index)) for index in range(len(stages))]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in done:
+        if not task.cancelled() and (exception := task.exception()) is not None:
+            raise exception
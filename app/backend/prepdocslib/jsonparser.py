@@ -1,24 +1,36 @@
 import json
 from collections.abc import AsyncGenerator
-from typing import IO
+from concurrent.futures import Executor
+from typing import IO, Optional, Union
 
 from .page import Page
-from .parser import Parser
+from .parser import Parser, run_in_executor
+
+
+def json_to_pages(content: Union[str, bytes]) -> list[Page]:
+    pages = []
+    offset = 0
+    data = json.loads(content)
+    if isinstance(data, list):
+        for i, obj in enumerate(data):
+            offset += 1  # For opening bracket or comma before object
+            page_text = json.dumps(obj)
+            pages.append(Page(i, offset, page_text))
+            offset += len(page_text)
+    elif isinstance(data, dict):
+        pages.append(Page(0, 0, json.dumps(data)))
+    return pages
 
 
 class JsonParser(Parser):
     """
     Concrete parser that can parse JSON into Page objects. A top-level object becomes a single Page, while a top-level array becomes multiple Page objects.
+    With an executor, the JSON is parsed in it instead of on the event loop.
     """
 
+    def __init__(self, executor: Optional[Executor] = None):
+        self.executor = executor
+
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
-        offset = 0
-        data = json.loads(content.read())
-        if isinstance(data, list):
-            for i, obj in enumerate(data):
-                offset += 1  # For opening bracket or comma before object
-                page_text = json.dumps(obj)
-                yield Page(i, offset, page_text)
-                offset += len(page_text)
-        elif isinstance(data, dict):
-            yield Page(0, 0, json.dumps(data))
+        for page in await run_in_executor(self.executor, json_to_pages, content.read()):
+            yield page
@@ -1,21 +1,35 @@
+import asyncio
 import base64
+import functools
 import hashlib
+import io
+import json
 import logging
 import os
 import re
+import shutil
 import tempfile
 from abc import ABC
-from collections.abc import AsyncGenerator
+from collections import deque
+from collections.abc import AsyncGenerator, Callable
 from glob import glob
 from typing import IO, Optional, Union
 
 from azure.core.credentials_async import AsyncTokenCredential
+from azure.storage.filedatalake import PathProperties
 from azure.storage.filedatalake.aio import (
+    DataLakeFileClient,
     DataLakeServiceClient,
+    FileSystemClient,
 )
 
+from .ingestionmanifest import IngestionManifest, ManifestEntry, hash_file
+
 logger = logging.getLogger("scripts")
 
+DEFAULT_MAX_PREFETCH_BYTES = 1024 * 1024 * 1024
+DEFAULT_MAX_MEMORY_FILE_BYTES = 4 * 1024 * 1024
+
 
 class File:
     """
@@ -23,10 +37,24 @@ class File:
     This file might contain access control information about which users or groups can access it
     """
 
-    def __init__(self, content: IO, acls: Optional[dict[str, list]] = None, url: Optional[str] = None):
+    def __init__(
+        self,
+        content: IO,
+        acls: Optional[dict[str, list]] = None,
+        url: Optional[str] = None,
+        manifest_entry: Optional[ManifestEntry] = None,
+        temp_dir: Optional[str] = None,
+        on_close: Optional[Callable[[], None]] = None,
+    ):
         self.content = content
         self.acls = acls or {}
         self.url = url
+        # State of the file to record in the ingestion manifest once it is ingested
+        self.manifest_entry = manifest_entry
+        # Temporary directory holding a downloaded copy of the file, removed once the file is closed
+        self.temp_dir = temp_dir
+        # Called once when the file is closed, such as to release the disk space it was counted for
+        self.on_close = on_close
 
     def filename(self):
         return os.path.basename(self.content.name)
@@ -45,13 +73,23 @@ class File:
     def close(self):
         if self.content:
             self.content.close()
+        if self.temp_dir:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+        if self.on_close:
+            on_close, self.on_close = self.on_close, None
+            on_close()
 
 
 class ListFileStrategy(ABC):
     """
     Abstract strategy for listing files that are located somewhere. For example, on a local computer or remotely in a storage account
+    With an ingestion manifest, list only yields the files that changed since they were ingested,
+    and removed_paths returns the ingested files that the listing no longer finds.
     """
 
+    manifest: Optional[IngestionManifest] = None
+
     async def list(self) -> AsyncGenerator[File, None]:
         if False:  # pragma: no cover - this is necessary for mypy to type check
             yield
@@ -60,14 +98,39 @@ class ListFileStrategy(ABC):
         if False:  # pragma: no cover - this is necessary for mypy to type check
             yield
 
+    def manifest_source(self) -> str:
+        """Identifies this listing in the manifest, so that listings of other locations don't see its files"""
+        raise NotImplementedError
+
+    def record_ingested(self, file: File):
+        if self.manifest is not None and file.manifest_entry is not None:
+            self.manifest.record(file.manifest_entry)
+
+    def removed_paths(self, listed_paths: set[str]) -> set[str]:
+        """Returns the paths recorded in the manifest that are not among the paths found by a complete listing"""
+        if self.manifest is None:
+            return set()
+        return set(self.manifest.paths(self.manifest_source())) - listed_paths
+
+    def forget(self, path: str):
+        if self.manifest is not None:
+            self.manifest.remove(self.manifest_source(), path)
+
+    def forget_all(self):
+        """Clears the files of this listing from the manifest, so that they are all ingested again"""
+        if self.manifest is not None:
+            self.manifest.clear(self.manifest_source())
+
 
 class LocalListFileStrategy(ListFileStrategy):
     """
     Concrete strategy for listing files that are located in a local filesystem
+    Without an ingestion manifest, the MD5 hash of each file is stored in a .md5 file next to it
     """
 
-    def __init__(self, path_pattern: str):
+    def __init__(self, path_pattern: str, manifest: Optional[IngestionManifest] = None):
         self.path_pattern = path_pattern
+        self.manifest = manifest
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
         async for p in self._list_paths(self.path_pattern):
@@ -84,9 +147,38 @@ class LocalListFileStrategy(ListFileStrategy):
 
     async def list(self) -> AsyncGenerator[File, None]:
         async for path in self.list_paths():
-            if not self.check_md5(path):
+            if self.manifest is not None:
+                manifest_entry = self.check_manifest(path, self.manifest)
+                if manifest_entry is not None:
+                    yield File(content=open(path, mode="rb"), manifest_entry=manifest_entry)
+            elif not self.check_md5(path):
                 yield File(content=open(path, mode="rb"))
 
+    def manifest_source(self) -> str:
+        return self.path_pattern
+
+    def check_manifest(self, path: str, manifest: IngestionManifest) -> Optional[ManifestEntry]:
+        """
+        Returns the entry to record once the file is ingested, or None if the file didn't change since it was ingested.
+        The content is only hashed when the size or the modification time changed.
+        """
+        stat = os.stat(path)
+        stored = manifest.get(self.manifest_source(), path)
+        if stored is not None and stored.size == stat.st_size and stored.mtime == stat.st_mtime:
+            logger.info("Skipping %s, no changes detected.", path)
+            return None
+        with open(path, "rb") as file:
+            content_hash = hash_file(file)
+        entry = ManifestEntry(
+            source=self.manifest_source(), path=path, size=stat.st_size, mtime=stat.st_mtime, content_hash=content_hash
+        )
+        if stored is not None and stored.content_hash == content_hash:
+            logger.info("Skipping %s, no changes detected.", path)
+            # Only the modification time changed, record it so the file isn't hashed again
+            manifest.record(entry)
+            return None
+        return entry
+
     def check_md5(self, path: str) -> bool:
         # if filename ends in .md5 skip
         if path.endswith(".md5"):
@@ -123,13 +215,26 @@ class ADLSGen2ListFileStrategy(ListFileStrategy):
         data_lake_filesystem: str,
         data_lake_path: str,
         credential: Union[AsyncTokenCredential, str],
+        manifest: Optional[IngestionManifest] = None,
+        download_concurrency: int = 4,
+        max_prefetch_bytes: int = DEFAULT_MAX_PREFETCH_BYTES,
+        max_memory_file_bytes: int = DEFAULT_MAX_MEMORY_FILE_BYTES,
     ):
         self.data_lake_storage_account = data_lake_storage_account
         self.data_lake_filesystem = data_lake_filesystem
         self.data_lake_path = data_lake_path
         self.credential = credential
+        self.manifest = manifest
+        self.download_concurrency = download_concurrency
+        self.max_prefetch_bytes = max_prefetch_bytes
+        # Files up to this size are kept in memory instead of being written to a temporary file
+        self.max_memory_file_bytes = max_memory_file_bytes
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
+        async for path in self.list_path_properties():
+            yield path.name
+
+    async def list_path_properties(self) -> AsyncGenerator[PathProperties, None]:
         async with DataLakeServiceClient(
             account_url=f"https://{self.data_lake_storage_account}.dfs.core.windows.net", credential=self.credential
         ) as service_client, service_client.get_file_system_client(self.data_lake_filesystem) as filesystem_client:
@@ -137,42 +242,156 @@ class ADLSGen2ListFileStrategy(ListFileStrategy):
                 if path.is_directory:
                     continue
 
-                yield path.name
+                yield path
+
+    def manifest_source(self) -> str:
+        return f"{self.data_lake_storage_account}/{self.data_lake_filesystem}/{self.data_lake_path}"
+
+    async def get_acls(self, file_client: DataLakeFileClient) -> dict[str, list[str]]:
+        # Parse out user ids and group ids
+        acls: dict[str, list[str]] = {"oids": [], "groups": []}
+        # https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
+        # Request ACLs as GUIDs
+        access_control = await file_client.get_access_control(upn=False)
+        acl_list = access_control["acl"]
+        # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
+        # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
+        acl_list = acl_list.split(",")
+        for acl in acl_list:
+            acl_parts: list = acl.split(":")
+            if len(acl_parts) != 3:
+                continue
+            if len(acl_parts[1]) == 0:
+                continue
+            if acl_parts[0] == "user" and "r" in acl_parts[2]:
+                acls["oids"].append(acl_parts[1])
+            if acl_parts[0] == "group" and "r" in acl_parts[2]:
+                acls["groups"].append(acl_parts[1])
+        return acls
 
     async def list(self) -> AsyncGenerator[File, None]:
+        """
+        Yields the files in listing order, while the next files and their ACLs are downloaded in the background.
+        At most download_concurrency files are downloaded or waiting to be yielded at a time, and the files
+        that are written to disk take at most max_prefetch_bytes until they are closed, unless a single file is larger.
+        Files must be closed for the next files to be downloaded once that limit is reached.
+        """
         async with DataLakeServiceClient(
             account_url=f"https://{self.data_lake_storage_account}.dfs.core.windows.net", credential=self.credential
         ) as service_client, service_client.get_file_system_client(self.data_lake_filesystem) as filesystem_client:
-            async for path in self.list_paths():
-                temp_file_path = os.path.join(tempfile.gettempdir(), os.path.basename(path))
-                try:
-                    async with filesystem_client.get_file_client(path) as file_client:
-                        with open(temp_file_path, "wb") as temp_file:
-                            downloader = await file_client.download_file()
-                            await downloader.readinto(temp_file)
-                    # Parse out user ids and group ids
-                    acls: dict[str, list[str]] = {"oids": [], "groups": []}
-                    # https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
-                    # Request ACLs as GUIDs
-                    access_control = await file_client.get_access_control(upn=False)
-                    acl_list = access_control["acl"]
-                    # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
-                    # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
-                    acl_list = acl_list.split(",")
-                    for acl in acl_list:
-                        acl_parts: list = acl.split(":")
-                        if len(acl_parts) != 3:
-                            continue
-                        if len(acl_parts[1]) == 0:
+            paths = self.list_path_properties().__aiter__()
+            next_path: Optional[PathProperties] = None
+            listed_all = False
+            pending: deque[tuple[asyncio.Task[Optional[File]], int]] = deque()
+            # Bytes on disk of the files being downloaded, waiting to be yielded, or yielded but not closed yet
+            prefetch_bytes = 0
+            released = asyncio.Event()
+
+            def release(disk_bytes: int):
+                nonlocal prefetch_bytes
+                prefetch_bytes -= disk_bytes
+                released.set()
+
+            try:
+                while True:
+                    while not listed_all and len(pending) < self.download_concurrency:
+                        if next_path is None:
+                            try:
+                                next_path = await paths.__anext__()
+                            except StopAsyncIteration:
+                                listed_all = True
+                                break
+                        disk_bytes = 0 if self.fits_in_memory(next_path) else next_path.content_length or 0
+                        if prefetch_bytes and prefetch_bytes + disk_bytes > self.max_prefetch_bytes:
+                            if pending:
+                                break
+                            # Only files that were yielded hold the disk space, wait until one of them is closed
+                            released.clear()
+                            await released.wait()
                             continue
-                        if acl_parts[0] == "user" and "r" in acl_parts[2]:
-                            acls["oids"].append(acl_parts[1])
-                        if acl_parts[0] == "group" and "r" in acl_parts[2]:
-                            acls["groups"].append(acl_parts[1])
-                    yield File(content=open(temp_file_path, "rb"), acls=acls, url=file_client.url)
-                except Exception as data_lake_exception:
-                    logger.error(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
+                        pending.append((asyncio.create_task(self.download(filesystem_client, next_path)), disk_bytes))
+                        prefetch_bytes += disk_bytes
+                        next_path = None
+                    if not pending:
+                        break
+                    task, disk_bytes = pending.popleft()
                     try:
-                        os.remove(temp_file_path)
-                    except Exception as file_delete_exception:
-                        logger.error(f"\tGot an error while deleting {temp_file_path} -> {file_delete_exception}")
+                        file = await task
+                    except BaseException:
+                        release(disk_bytes)
+                        raise
+                    if file is None:
+                        release(disk_bytes)
+                        continue
+                    file.on_close = functools.partial(release, disk_bytes)
+                    yield file
+            finally:
+                for task, _ in pending:
+                    task.cancel()
+                for task, _ in pending:
+                    try:
+                        file = await task
+                    except asyncio.CancelledError:
+                        continue
+                    if file is not None:
+                        file.close()
+
+    def fits_in_memory(self, path_properties: PathProperties) -> bool:
+        return (
+            path_properties.content_length is not None and path_properties.content_length <= self.max_memory_file_bytes
+        )
+
+    async def download(self, filesystem_client: FileSystemClient, path_properties: PathProperties) -> Optional[File]:
+        """
+        Downloads a file along with its ACLs, or returns None if it didn't change since it was ingested.
+        Small files are kept in memory, larger ones are written to their own temporary directory,
+        so that files with the same name in different directories don't overwrite each other.
+        """
+        path = path_properties.name
+        temp_dir: Optional[str] = None
+        file: Optional[File] = None
+        try:
+            async with filesystem_client.get_file_client(path) as file_client:
+                acls = await self.get_acls(file_client)
+                manifest_entry = None
+                if self.manifest is not None:
+                    # The ETag changes whenever the content changes, but not when the ACLs change
+                    manifest_entry = ManifestEntry(
+                        source=self.manifest_source(),
+                        path=path,
+                        size=path_properties.content_length,
+                        etag=path_properties.etag,
+                        acls=json.dumps(acls, sort_keys=True),
+                    )
+                    stored = self.manifest.get(self.manifest_source(), path)
+                    if (
+                        stored is not None
+                        and stored.etag is not None
+                        and (stored.etag, stored.acls) == (manifest_entry.etag, manifest_entry.acls)
+                    ):
+                        logger.info("Skipping %s, no changes detected.", path)
+                        return None
+                downloader = await file_client.download_file()
+                content: IO
+                if self.fits_in_memory(path_properties):
+                    content = io.BytesIO()
+                    # Parsers and the blob manager use the name to find out the file type
+                    content.name = path
+                    await downloader.readinto(content)
+                    content.seek(0)
+                else:
+                    temp_dir = tempfile.mkdtemp(prefix="prepdocs-")
+                    temp_file_path = os.path.join(temp_dir, os.path.basename(path))
+                    with open(temp_file_path, "wb") as temp_file:
+                        await downloader.readinto(temp_file)
+                    content = open(temp_file_path, "rb")
+            file = File(
+                content=content, acls=acls, url=file_client.url, manifest_entry=manifest_entry, temp_dir=temp_dir
+            )
+            return file
+        except Exception as data_lake_exception:
+            logger.error(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
+            return None
+        finally:
+            if file is None and temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
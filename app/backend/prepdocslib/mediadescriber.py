@@ -1,12 +1,14 @@
 import logging
 from abc import ABC
+from typing import Optional
 
-import aiohttp
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import get_bearer_token_provider
 from rich.progress import Progress
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
 
+from .httpsession import SharedHttpSession, use_http_session
+
 logger = logging.getLogger("scripts")
 
 
@@ -38,9 +40,15 @@ class ContentUnderstandingDescriber:
         },
     }
 
-    def __init__(self, endpoint: str, credential: AsyncTokenCredential):
+    def __init__(
+        self, endpoint: str, credential: AsyncTokenCredential, http_session: Optional[SharedHttpSession] = None
+    ):
         self.endpoint = endpoint
         self.credential = credential
+        self.http_session = http_session
+
+    def use_session(self):
+        return use_http_session(self.http_session.get() if self.http_session else None)
 
     async def poll_api(self, session, poll_url, headers):
 
@@ -66,7 +74,7 @@ class ContentUnderstandingDescriber:
         params = {"api-version": self.CU_API_VERSION}
         analyzer_id = self.analyzer_schema["analyzerId"]
         cu_endpoint = f"{self.endpoint}/contentunderstanding/analyzers/{analyzer_id}"
-        async with aiohttp.ClientSession() as session:
+        async with self.use_session() as session:
             async with session.put(
                 url=cu_endpoint, params=params, headers=headers, json=self.analyzer_schema
             ) as response:
@@ -85,7 +93,7 @@ class ContentUnderstandingDescriber:
 
     async def describe_image(self, image_bytes: bytes) -> str:
         logger.info("Sending image to Azure Content Understanding service...")
-        async with aiohttp.ClientSession() as session:
+        async with self.use_session() as session:
             token = await self.credential.get_token("https://cognitiveservices.azure.com/.default")
             headers = {"Authorization": "Bearer " + token.token}
             params = {"api-version": self.CU_API_VERSION}
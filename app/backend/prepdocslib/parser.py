@@ -1,9 +1,14 @@
+import asyncio
+import math
 from abc import ABC
 from collections.abc import AsyncGenerator
-from typing import IO
+from concurrent.futures import Executor
+from typing import IO, Any, Callable, Optional, TypeVar
 
 from .page import Page
 
+T = TypeVar("T")
+
 
 class Parser(ABC):
     """
@@ -13,3 +18,23 @@ class Parser(ABC):
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         if False:
             yield  # pragma: no cover - this is necessary for mypy to type check
+
+
+async def run_in_executor(executor: Optional[Executor], func: Callable[..., T], *args: Any) -> T:
+    """
+    Runs CPU-bound parsing work in an executor, typically a ProcessPoolExecutor, so it doesn't block the event loop.
+    The function and its arguments must be picklable to run in a process pool.
+    Without an executor, the work runs directly on the event loop.
+    """
+    if executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def split_page_ranges(page_count: int, range_count: int) -> list[range]:
+    """
+    Splits the pages of a document into at most range_count consecutive ranges of similar sizes,
+    typically one range per worker of an executor so that each worker loads the document once
+    """
+    pages_per_range = max(1, math.ceil(page_count / max(1, range_count)))
+    return [range(start, min(start + pages_per_range, page_count)) for start in range(0, page_count, pages_per_range)]
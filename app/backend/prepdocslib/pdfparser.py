@@ -1,9 +1,13 @@
+import asyncio
+import heapq
 import html
 import io
 import logging
+from collections import defaultdict
 from collections.abc import AsyncGenerator
+from concurrent.futures import Executor
 from enum import Enum
-from typing import IO, Union
+from typing import IO, Optional, Union
 
 import pymupdf
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
@@ -19,22 +23,47 @@ from azure.core.exceptions import HttpResponseError
 from PIL import Image
 from pypdf import PdfReader
 
+from .httpsession import SharedHttpSession
 from .mediadescriber import ContentUnderstandingDescriber
 from .page import Page
-from .parser import Parser
+from .parser import Parser, split_page_ranges
 
 logger = logging.getLogger("scripts")
 
 
+class ObjectType(Enum):
+    NONE = -1
+    TABLE = 0
+    FIGURE = 1
+
+
+def extract_pdf_texts(data: bytes, start: int, end: int) -> list[str]:
+    """Extracts the text of the pages from start (included) to end (excluded) of a PDF"""
+    reader = PdfReader(io.BytesIO(data))
+    return [reader.pages[page_num].extract_text() for page_num in range(start, end)]
+
+
 class LocalPdfParser(Parser):
     """
     Concrete parser backed by PyPDF that can parse PDFs into pages
     To learn more, please visit https://pypi.org/project/pypdf/
+    With an executor, the pages are split into one range per worker of the executor and their text is extracted
+    in the executor, and the pages are yielded in order as their ranges complete.
     """
 
+    def __init__(self, executor: Optional[Executor] = None, executor_workers: int = 1):
+        self.executor = executor
+        # Number of workers of the executor, each of them extracts the text of one range of pages
+        self.executor_workers = executor_workers
+
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         logger.info("Extracting text from '%s' using local PDF parser (pypdf)", content.name)
 
+        if self.executor is not None:
+            async for page in self.parse_in_executor(content, self.executor):
+                yield page
+            return
+
         reader = PdfReader(content)
         pages = reader.pages
         offset = 0
@@ -43,6 +72,26 @@ class LocalPdfParser(Parser):
             yield Page(page_num=page_num, offset=offset, text=page_text)
             offset += len(page_text)
 
+    async def parse_in_executor(self, content: IO, executor: Executor) -> AsyncGenerator[Page, None]:
+        data = content.read()
+        page_count = len(PdfReader(io.BytesIO(data)).pages)
+        loop = asyncio.get_running_loop()
+        futures = [
+            loop.run_in_executor(executor, extract_pdf_texts, data, page_range.start, page_range.stop)
+            for page_range in split_page_ranges(page_count, self.executor_workers)
+        ]
+        try:
+            page_num = 0
+            offset = 0
+            for future in futures:
+                for page_text in await future:
+                    yield Page(page_num=page_num, offset=offset, text=page_text)
+                    page_num += 1
+                    offset += len(page_text)
+        finally:
+            for future in futures:
+                future.cancel()
+
 
 class DocumentAnalysisParser(Parser):
     """
@@ -57,12 +106,17 @@ class DocumentAnalysisParser(Parser):
         model_id="prebuilt-layout",
         use_content_understanding=True,
         content_understanding_endpoint: Union[str, None] = None,
+        figure_concurrency: int = 4,
+        http_session: Optional[SharedHttpSession] = None,
     ):
         self.model_id = model_id
         self.endpoint = endpoint
         self.credential = credential
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        # Maximum number of figures of a document that are described at the same time
+        self.figure_concurrency = figure_concurrency
+        self.http_session = http_session
 
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         logger.info("Extracting text from '%s' using Azure Document Intelligence", content.name)
@@ -71,6 +125,8 @@ class DocumentAnalysisParser(Parser):
             endpoint=self.endpoint, credential=self.credential
         ) as document_intelligence_client:
             file_analyzed = False
+            doc_for_pymupdf: Optional[pymupdf.Document] = None
+            cu_describer: Optional[ContentUnderstandingDescriber] = None
             if self.use_content_understanding:
                 if self.content_understanding_endpoint is None:
                     raise ValueError("Content Understanding is enabled but no endpoint was provided")
@@ -78,7 +134,9 @@ class DocumentAnalysisParser(Parser):
                     raise ValueError(
                         "AzureKeyCredential is not supported for Content Understanding, use keyless auth instead"
                     )
-                cu_describer = ContentUnderstandingDescriber(self.content_understanding_endpoint, self.credential)
+                cu_describer = ContentUnderstandingDescriber(
+                    self.content_understanding_endpoint, self.credential, self.http_session
+                )
                 content_bytes = content.read()
                 try:
                     poller = await document_intelligence_client.begin_analyze_document(
@@ -108,76 +166,125 @@ class DocumentAnalysisParser(Parser):
                 )
             analyze_result: AnalyzeResult = await poller.result()
 
-            offset = 0
-            for page in analyze_result.pages:
-                tables_on_page = [
-                    table
-                    for table in (analyze_result.tables or [])
-                    if table.bounding_regions and table.bounding_regions[0].page_number == page.page_number
-                ]
-                figures_on_page = []
-                if self.use_content_understanding:
-                    figures_on_page = [
-                        figure
-                        for figure in (analyze_result.figures or [])
-                        if figure.bounding_regions and figure.bounding_regions[0].page_number == page.page_number
-                    ]
-
-                class ObjectType(Enum):
-                    NONE = -1
-                    TABLE = 0
-                    FIGURE = 1
+            async for page in self.analyze_result_to_pages(analyze_result, doc_for_pymupdf, cu_describer):
+                yield page
+
+    async def analyze_result_to_pages(
+        self,
+        analyze_result: AnalyzeResult,
+        doc_for_pymupdf: Optional[pymupdf.Document] = None,
+        cu_describer: Optional[ContentUnderstandingDescriber] = None,
+    ) -> AsyncGenerator[Page, None]:
+        tables_by_page: dict[int, list[DocumentTable]] = defaultdict(list)
+        for table in analyze_result.tables or []:
+            if table.bounding_regions:
+                tables_by_page[table.bounding_regions[0].page_number].append(table)
+        figures_by_page: dict[int, list[DocumentFigure]] = defaultdict(list)
+        if self.use_content_understanding:
+            for figure in analyze_result.figures or []:
+                if figure.bounding_regions:
+                    figures_by_page[figure.bounding_regions[0].page_number].append(figure)
+
+        page_intervals = [
+            DocumentAnalysisParser.mask_spans(
+                page.spans[0].offset,
+                page.spans[0].length,
+                tables_by_page.get(page.page_number, []),
+                figures_by_page.get(page.page_number, []),
+            )
+            for page in analyze_result.pages
+        ]
+        # Describe all the figures of the document concurrently, their descriptions are spliced in page by page
+        figure_tasks: dict[tuple[int, int], asyncio.Task[str]] = {}
+        semaphore = asyncio.Semaphore(self.figure_concurrency)
 
+        async def describe_figure(figure: DocumentFigure) -> str:
+            if cu_describer is None or doc_for_pymupdf is None:
+                raise ValueError("cu_describer should not be None, unable to describe figure")
+            async with semaphore:
+                return await DocumentAnalysisParser.figure_to_html(doc_for_pymupdf, figure, cu_describer)
+
+        for page, intervals in zip(analyze_result.pages, page_intervals):
+            for _, _, object_type, object_idx in intervals:
+                if object_type == ObjectType.FIGURE and (page.page_number, object_idx) not in figure_tasks:
+                    figure = figures_by_page[page.page_number][object_idx]
+                    figure_tasks[(page.page_number, object_idx)] = asyncio.create_task(describe_figure(figure))
+
+        try:
+            offset = 0
+            for page, intervals in zip(analyze_result.pages, page_intervals):
+                tables_on_page = tables_by_page.get(page.page_number, [])
                 page_offset = page.spans[0].offset
-                page_length = page.spans[0].length
-                mask_chars: list[tuple[ObjectType, Union[int, None]]] = [(ObjectType.NONE, None)] * page_length
-                # mark all positions of the table spans in the page
-                for table_idx, table in enumerate(tables_on_page):
-                    for span in table.spans:
-                        # replace all table spans with "table_id" in table_chars array
-                        for i in range(span.length):
-                            idx = span.offset - page_offset + i
-                            if idx >= 0 and idx < page_length:
-                                mask_chars[idx] = (ObjectType.TABLE, table_idx)
-                # mark all positions of the figure spans in the page
-                for figure_idx, figure in enumerate(figures_on_page):
-                    for span in figure.spans:
-                        # replace all figure spans with "figure_id" in figure_chars array
-                        for i in range(span.length):
-                            idx = span.offset - page_offset + i
-                            if idx >= 0 and idx < page_length:
-                                mask_chars[idx] = (ObjectType.FIGURE, figure_idx)
-
-                # build page text by replacing characters in table spans with table html
-                page_text = ""
-                added_objects = set()  # set of object types todo mypy
-                for idx, mask_char in enumerate(mask_chars):
-                    object_type, object_idx = mask_char
+
+                # build page text by replacing the table and figure spans with their html
+                page_parts: list[str] = []
+                added_objects: set[tuple[ObjectType, int]] = set()
+                for start, end, object_type, object_idx in intervals:
                     if object_type == ObjectType.NONE:
-                        page_text += analyze_result.content[page_offset + idx]
+                        page_parts.append(analyze_result.content[page_offset + start : page_offset + end])
+                    elif (object_type, object_idx) in added_objects:
+                        continue
                     elif object_type == ObjectType.TABLE:
-                        if object_idx is None:
-                            raise ValueError("Expected object_idx to be set")
-                        if mask_char not in added_objects:
-                            page_text += DocumentAnalysisParser.table_to_html(tables_on_page[object_idx])
-                            added_objects.add(mask_char)
+                        page_parts.append(DocumentAnalysisParser.table_to_html(tables_on_page[object_idx]))
+                        added_objects.add((object_type, object_idx))
                     elif object_type == ObjectType.FIGURE:
-                        if cu_describer is None:
-                            raise ValueError("cu_describer should not be None, unable to describe figure")
-                        if object_idx is None:
-                            raise ValueError("Expected object_idx to be set")
-                        if mask_char not in added_objects:
-                            figure_html = await DocumentAnalysisParser.figure_to_html(
-                                doc_for_pymupdf, figures_on_page[object_idx], cu_describer
-                            )
-                            page_text += figure_html
-                            added_objects.add(mask_char)
+                        page_parts.append(await figure_tasks[(page.page_number, object_idx)])
+                        added_objects.add((object_type, object_idx))
+                page_text = "".join(page_parts)
                 # We remove these comments since they are not needed and skew the page numbers
                 page_text = page_text.replace("<!-- PageBreak -->", "")
                 # We remove excess newlines at the beginning and end of the page
                 page_text = page_text.strip()
                 yield Page(page_num=page.page_number - 1, offset=offset, text=page_text)
                 offset += len(page_text)
+        finally:
+            for task in figure_tasks.values():
+                task.cancel()
+            # Wait for the other figures to stop, and retrieve their errors so they aren't reported as never retrieved
+            await asyncio.gather(*figure_tasks.values(), return_exceptions=True)
+
+    @staticmethod
+    def mask_spans(
+        page_offset: int, page_length: int, tables: list[DocumentTable], figures: list[DocumentFigure]
+    ) -> list[tuple[int, int, ObjectType, int]]:
+        """
+        Splits a page into consecutive (start, end, object type, object index) intervals, relative to the page offset.
+        Where spans overlap, figures win over tables and later objects win over earlier ones.
+        Text outside of any table or figure has the object type NONE.
+        """
+        # (start, end, priority, object type, object index) of every span, clipped to the page
+        spans: list[tuple[int, int, int, ObjectType, int]] = []
+        objects = [(ObjectType.TABLE, table) for table in tables] + [(ObjectType.FIGURE, figure) for figure in figures]
+        object_indexes = {ObjectType.TABLE: 0, ObjectType.FIGURE: 0}
+        for priority, (object_type, obj) in enumerate(objects):
+            object_idx = object_indexes[object_type]
+            object_indexes[object_type] += 1
+            for span in obj.spans:
+                start = max(span.offset - page_offset, 0)
+                end = min(span.offset - page_offset + span.length, page_length)
+                if start < end:
+                    spans.append((start, end, priority, object_type, object_idx))
+        spans.sort(key=lambda span: span[0])
+        boundaries = sorted({0, page_length, *(span[0] for span in spans), *(span[1] for span in spans)})
+
+        intervals: list[tuple[int, int, ObjectType, int]] = []
+        # Spans covering the current position, with the highest priority first.
+        # Spans that have ended are only removed once they reach the top of the heap.
+        active: list[tuple[int, int, int, ObjectType, int]] = []
+        next_span = 0
+        for start, end in zip(boundaries, boundaries[1:]):
+            while next_span < len(spans) and spans[next_span][0] <= start:
+                _, span_end, priority, object_type, object_idx = spans[next_span]
+                heapq.heappush(active, (-priority, next_span, span_end, object_type, object_idx))
+                next_span += 1
+            while active and active[0][2] <= start:
+                heapq.heappop(active)
+            object_type, object_idx = (active[0][3], active[0][4]) if active else (ObjectType.NONE, -1)
+            if intervals and intervals[-1][1] == start and intervals[-1][2:] == (object_type, object_idx):
+                intervals[-1] = (intervals[-1][0], end, object_type, object_idx)
+            else:
+                intervals.append((start, end, object_type, object_idx))
+        return intervals
 
     @staticmethod
     async def figure_to_html(
@@ -1,8 +1,12 @@
 import asyncio
+import hashlib
+import json
 import logging
 import os
-from typing import Optional
+from collections.abc import AsyncGenerator, AsyncIterable
+from typing import Any, Optional
 
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
     AzureOpenAIVectorizerParameters,
@@ -33,12 +37,19 @@ from azure.search.documents.indexes.models import (
 
 from .blobmanager import BlobManager
 from .embeddings import AzureOpenAIEmbeddingService, OpenAIEmbeddings
+from .indexuploader import IndexUploader
 from .listfilestrategy import File
 from .strategy import SearchInfo
 from .textsplitter import SplitPage
 
 logger = logging.getLogger("scripts")
 
+MAX_BATCH_SIZE = 1000
+# Maximum number of results of a single search, the service doesn't return results past a skip of 100000
+MAX_REMOVE_SEARCH_RESULTS = 100000
+# Sections are embedded in smaller batches, so that embedding a batch overlaps with uploading the previous ones
+EMBEDDING_BATCH_SIZE = 250
+
 
 class Section:
     """
@@ -51,6 +62,37 @@ class Section:
         self.category = category
 
 
+class IndexedChunks:
+    """
+    Ids of the chunks of a file that were in the search index before the file was indexed again, when chunk ids
+    are content hashes. Chunks that are already indexed are neither embedded nor uploaded again, and the chunks
+    that the file no longer produces are removed once the whole file is indexed.
+    """
+
+    def __init__(self, existing_ids: set[str]):
+        self.existing_ids = existing_ids
+        self.produced_ids: set[str] = set()
+
+    def stale_ids(self) -> list[str]:
+        return sorted(self.existing_ids - self.produced_ids)
+
+
+async def batch_sections(
+    sections: AsyncIterable[Section], batch_size: int = MAX_BATCH_SIZE
+) -> AsyncGenerator[list[Section], None]:
+    """
+    Groups sections into lists of at most batch_size sections, as they are produced
+    """
+    batch: list[Section] = []
+    async for section in sections:
+        batch.append(section)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class SearchManager:
     """
     Class to manage a search service. It can create indexes, and update or remove sections stored in these indexes
@@ -66,11 +108,18 @@ class SearchManager:
         embeddings: Optional[OpenAIEmbeddings] = None,
         field_name_embedding: Optional[str] = None,
         search_images: bool = False,
+        upload_concurrency: int = 4,
+        use_content_hash_ids: bool = False,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
         self.use_acls = use_acls
         self.use_int_vectorization = use_int_vectorization
+        # Maximum number of batches of documents uploaded to or deleted from the index at the same time
+        self.upload_concurrency = upload_concurrency
+        # Derive chunk ids from the chunk content instead of the chunk position, so that a file can be re-indexed
+        # by only embedding and uploading the chunks that changed
+        self.use_content_hash_ids = use_content_hash_ids
         self.embeddings = embeddings
         self.embedding_dimensions = self.embeddings.open_ai_dimensions if self.embeddings else None
         self.field_name_embedding = field_name_embedding
@@ -411,81 +460,224 @@ class SearchManager:
             logger.info("Agent %s created successfully", self.search_info.agent_name)
 
     async def update_content(
-        self, sections: list[Section], image_embeddings: Optional[list[list[float]]] = None, url: Optional[str] = None
+        self,
+        sections: list[Section],
+        image_embeddings: Optional[list[list[float]]] = None,
+        url: Optional[str] = None,
+        section_offset: int = 0,
+        indexed_chunks: Optional[IndexedChunks] = None,
+        image_hashes: Optional[list[str]] = None,
     ):
-        MAX_BATCH_SIZE = 1000
-        section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
+        """
+        Indexes sections of a file. When a file is indexed in several calls, section_offset is the position
+        of the first section within the file, and indexed_chunks is shared by all the calls.
+        image_hashes are the content hashes of the page images that image_embeddings were computed from.
+        """
+        section_batches = [
+            sections[i : i + EMBEDDING_BATCH_SIZE] for i in range(0, len(sections), EMBEDDING_BATCH_SIZE)
+        ]
 
         async with self.search_info.create_search_client() as search_client:
-            for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{section.content.filename_to_id()}-page-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section.split_page.text,
-                        "category": section.category,
-                        "sourcepage": (
-                            BlobManager.blob_image_name_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                            if image_embeddings
-                            else BlobManager.sourcepage_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                        ),
-                        "sourcefile": section.content.filename(),
-                        **section.content.acls,
-                    }
-                    for section_index, section in enumerate(batch)
-                ]
-                if url:
-                    for document in documents:
-                        document["storageUrl"] = url
-                if self.embeddings:
-                    if self.field_name_embedding is None:
-                        raise ValueError("Embedding field name must be set")
-                    embeddings = await self.embeddings.create_embeddings(
-                        texts=[section.split_page.text for section in batch]
+            uploader = IndexUploader(search_client, concurrency=self.upload_concurrency)
+            try:
+                for batch_index, batch in enumerate(section_batches):
+                    # The previous batches keep uploading while this one is embedded
+                    documents = await self.create_documents(
+                        batch,
+                        image_embeddings,
+                        url=url,
+                        section_offset=section_offset + batch_index * EMBEDDING_BATCH_SIZE,
+                        indexed_chunks=indexed_chunks,
+                        image_hashes=image_hashes,
                     )
-                    for i, document in enumerate(documents):
-                        document[self.field_name_embedding] = embeddings[i]
-                if image_embeddings:
-                    for i, (document, section) in enumerate(zip(documents, batch)):
-                        document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
-
-                await search_client.upload_documents(documents)
+                    await uploader.add(documents)
+                await uploader.flush()
+            finally:
+                uploader.cancel()
+
+    def content_hash_id(self, file: File, document: dict[str, Any], image_hash: Optional[str] = None) -> str:
+        """
+        Builds the id of a chunk from its file and a hash of its fields, along with the embedding model
+        and the hash of the page image behind its image embedding, so that a chunk keeps its id for as long
+        as its content and its embeddings stay the same
+        """
+        hashed_fields: dict[str, Any] = {
+            "document": document,
+            "embedding_model": self.embeddings.open_ai_model_name if self.embeddings else None,
+            "embedding_dimensions": self.embedding_dimensions,
+        }
+        if image_hash is not None:
+            hashed_fields["image_hash"] = image_hash
+        chunk_hash = hashlib.sha256(json.dumps(hashed_fields, sort_keys=True).encode("utf-8")).hexdigest()
+        return f"{file.filename_to_id()}-{chunk_hash[:32]}"
+
+    async def create_documents(
+        self,
+        sections: list[Section],
+        image_embeddings: Optional[list[list[float]]] = None,
+        url: Optional[str] = None,
+        section_offset: int = 0,
+        indexed_chunks: Optional[IndexedChunks] = None,
+        image_hashes: Optional[list[str]] = None,
+    ) -> list[dict[str, Any]]:
+        """
+        Builds the search documents for a list of sections, computing text embeddings if enabled.
+        The section_offset is the position of the first section within its file, and is used to build unique ids.
+        With content hash ids, sections that are already in indexed_chunks, or that repeat an earlier section
+        of the file, are left out.
+        """
+        documents = [
+            {
+                "content": section.split_page.text,
+                "category": section.category,
+                "sourcepage": (
+                    BlobManager.blob_image_name_from_file_page(
+                        filename=section.content.filename(),
+                        page=section.split_page.page_num,
+                    )
+                    if image_embeddings
+                    else BlobManager.sourcepage_from_file_page(
+                        filename=section.content.filename(),
+                        page=section.split_page.page_num,
+                    )
+                ),
+                "sourcefile": section.content.filename(),
+                **section.content.acls,
+            }
+            for section in sections
+        ]
+        if url:
+            for document in documents:
+                document["storageUrl"] = url
+        if self.use_content_hash_ids:
+            produced_ids = indexed_chunks.produced_ids if indexed_chunks else set()
+            new_sections = []
+            new_documents = []
+            for section, document in zip(sections, documents):
+                image_hash = image_hashes[section.split_page.page_num] if image_embeddings and image_hashes else None
+                document_id = self.content_hash_id(section.content, document, image_hash)
+                # Identical chunks of a file share an id, only the first one is indexed
+                if document_id in produced_ids:
+                    continue
+                produced_ids.add(document_id)
+                if indexed_chunks and document_id in indexed_chunks.existing_ids:
+                    continue
+                new_sections.append(section)
+                new_documents.append({"id": document_id, **document})
+            sections, documents = new_sections, new_documents
+        else:
+            documents = [
+                {"id": f"{section.content.filename_to_id()}-page-{section_index + section_offset}", **document}
+                for section_index, (section, document) in enumerate(zip(sections, documents))
+            ]
+        if self.embeddings and sections:
+            if self.field_name_embedding is None:
+                raise ValueError("Embedding field name must be set")
+            embeddings = await self.embeddings.create_embeddings(
+                texts=[section.split_page.text for section in sections],
+                token_counts=[section.split_page.token_count for section in sections],
+            )
+            for i, document in enumerate(documents):
+                document[self.field_name_embedding] = embeddings[i]
+        if image_embeddings:
+            for document, section in zip(documents, sections):
+                document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
+        return documents
+
+    async def upload_documents(self, documents: list[dict[str, Any]]):
+        async with self.search_info.create_search_client() as search_client:
+            uploader = IndexUploader(search_client, concurrency=self.upload_concurrency)
+            await uploader.add(documents)
+            await uploader.flush()
 
     async def remove_content(self, path: Optional[str] = None, only_oid: Optional[str] = None):
         logger.info(
             "Removing sections from '{%s or '<all>'}' from search index '%s'", path, self.search_info.index_name
         )
+        filter = None
+        if path is not None:
+            # Replace ' with '' to escape the single quote for the filter
+            # https://learn.microsoft.com/azure/search/query-odata-filter-orderby-syntax#escaping-special-characters-in-string-constants
+            path_for_filter = os.path.basename(path).replace("'", "''")
+            filter = f"sourcefile eq '{path_for_filter}'"
         async with self.search_info.create_search_client() as search_client:
+            # Deletes are eventually consistent, so a new search can return sections that were already seen
+            seen_keys: set[str] = set()
             while True:
-                filter = None
-                if path is not None:
-                    # Replace ' with '' to escape the single quote for the filter
-                    # https://learn.microsoft.com/azure/search/query-odata-filter-orderby-syntax#escaping-special-characters-in-string-constants
-                    path_for_filter = os.path.basename(path).replace("'", "''")
-                    filter = f"sourcefile eq '{path_for_filter}'"
-                max_results = 1000
-                result = await search_client.search(
-                    search_text="", filter=filter, top=max_results, include_total_count=True
+                # Collect the keys of all the matching sections first, since deleting them would shift the pages
+                keys = []
+                new_results = False
+                result_count = 0
+                results = await search_client.search(
+                    search_text="",
+                    filter=filter,
+                    select=["id", "oids"] if only_oid else ["id"],
+                    top=MAX_REMOVE_SEARCH_RESULTS,
                 )
-                result_count = await result.get_count()
-                if result_count == 0:
-                    break
-                documents_to_remove = []
-                async for document in result:
+                async for document in results:
+                    result_count += 1
+                    if document["id"] in seen_keys:
+                        continue
+                    seen_keys.add(document["id"])
+                    new_results = True
                     # If only_oid is set, only remove documents that have only this oid
                     if not only_oid or document.get("oids") == [only_oid]:
-                        documents_to_remove.append({"id": document["id"]})
-                if len(documents_to_remove) == 0:
-                    if result_count < max_results:
-                        break
-                    else:
-                        continue
-                removed_docs = await search_client.delete_documents(documents_to_remove)
-                logger.info("Removed %d sections from index", len(removed_docs))
-                # It can take a few seconds for search results to reflect changes, so wait a bit
-                await asyncio.sleep(2)
+                        keys.append(document["id"])
+                if keys:
+                    await self.remove_documents(search_client, keys)
+                # A search can't page past MAX_REMOVE_SEARCH_RESULTS, search again if there may be more sections
+                if not new_results or result_count < MAX_REMOVE_SEARCH_RESULTS:
+                    break
+
+    async def get_indexed_chunks(self, file: File) -> Optional[IndexedChunks]:
+        """
+        Returns the ids of the chunks of a file that are in the index, if chunk ids are content hashes
+        """
+        if not self.use_content_hash_ids:
+            return None
+        filename_for_filter = file.filename().replace("'", "''")
+        # Files with the same name but other access control lists have other ids, and are left alone
+        id_prefix = f"{file.filename_to_id()}-"
+        existing_ids = set()
+        async with self.search_info.create_search_client() as search_client:
+            results = await search_client.search(
+                search_text="",
+                filter=f"sourcefile eq '{filename_for_filter}'",
+                select=["id"],
+                top=MAX_REMOVE_SEARCH_RESULTS,
+            )
+            async for document in results:
+                if document["id"].startswith(id_prefix):
+                    existing_ids.add(document["id"])
+        return IndexedChunks(existing_ids)
+
+    async def remove_stale_chunks(self, indexed_chunks: IndexedChunks):
+        """
+        Removes the chunks that were indexed for a previous version of a file, once its current version is indexed
+        """
+        stale_ids = indexed_chunks.stale_ids()
+        logger.info(
+            "%d chunks were already indexed, %d chunks were indexed and %d stale chunks are removed",
+            len(indexed_chunks.existing_ids & indexed_chunks.produced_ids),
+            len(indexed_chunks.produced_ids - indexed_chunks.existing_ids),
+            len(stale_ids),
+        )
+        if stale_ids:
+            async with self.search_info.create_search_client() as search_client:
+                await self.remove_documents(search_client, stale_ids)
+
+    async def remove_documents(self, search_client: SearchClient, keys: list[str]):
+        """
+        Deletes the documents with the given keys, in batches of MAX_BATCH_SIZE that are sent concurrently
+        """
+        semaphore = asyncio.Semaphore(self.upload_concurrency)
+
+        async def remove_batch(batch: list[str]) -> int:
+            async with semaphore:
+                removed_docs = await search_client.delete_documents([{"id": key} for key in batch])
+                return len(removed_docs)
+
+        removed = await asyncio.gather(
+            *(remove_batch(keys[i : i + MAX_BATCH_SIZE]) for i in range(0, len(keys), MAX_BATCH_SIZE))
+        )
+        logger.info("Removed %d sections from index", sum(removed))
@@ -1,6 +1,8 @@
+import bisect
 import logging
+import re
 from abc import ABC
-from collections.abc import Generator
+from collections.abc import AsyncGenerator, AsyncIterable, Generator
 
 import tiktoken
 
@@ -20,6 +22,14 @@ class TextSplitter(ABC):
         if False:
             yield  # pragma: no cover - this is necessary for mypy to type check
 
+    async def split_pages_stream(self, pages: AsyncIterable[Page]) -> AsyncGenerator[SplitPage, None]:
+        """
+        Splits pages as they arrive. By default, this waits for all the pages and then splits them together,
+        splitters that can split incrementally override it to yield sections as soon as they are final.
+        """
+        for split_page in self.split_pages([page async for page in pages]):
+            yield split_page
+
 
 ENCODING_MODEL = "text-embedding-ada-002"
 
@@ -102,7 +112,7 @@ class SentenceTextSplitter(TextSplitter):
         tokens = bpe.encode(text)
         if len(tokens) <= self.max_tokens_per_section:
             # Section is already within max tokens, return
-            yield SplitPage(page_num=page_num, text=text)
+            yield SplitPage(page_num=page_num, text=text, token_count=len(tokens))
         else:
             # Start from the center and try and find the closest sentence ending by spiralling outward.
             # IF we get to the outer thirds, then just split in half with a 5% overlap
@@ -207,6 +217,216 @@ class SentenceTextSplitter(TextSplitter):
             yield from self.split_page_by_max_tokens(page_num=find_page(start), text=all_text[start:end])
 
 
+def first_position_in_range(positions: list[int], low: int, high: int) -> int:
+    """Returns the first position in [low, high), or -1 if there is none"""
+    index = bisect.bisect_left(positions, low)
+    if index < len(positions) and positions[index] < high:
+        return positions[index]
+    return -1
+
+
+def last_position_in_range(positions: list[int], low: int, high: int) -> int:
+    """Returns the last position in [low, high), or -1 if there is none"""
+    index = bisect.bisect_left(positions, high) - 1
+    if index >= 0 and positions[index] >= low:
+        return positions[index]
+    return -1
+
+
+class TextWindow:
+    """
+    The part of a document's text that the splitter still needs, along with the positions of its sentence endings
+    and word breaks. Positions are offsets into the whole document, so text that was already split can be dropped
+    while more pages are appended.
+    """
+
+    def __init__(self, sentence_ending_pattern: re.Pattern, word_break_pattern: re.Pattern):
+        self.sentence_ending_pattern = sentence_ending_pattern
+        self.word_break_pattern = word_break_pattern
+        self.text = ""
+        self.offset = 0
+        self.length = 0
+        self.has_content = False
+        self.sentence_endings: list[int] = []
+        self.word_breaks: list[int] = []
+        self.page_offsets: list[int] = []
+        self.page_nums: list[int] = []
+        # Splitting state, kept between appended pages
+        self.started = False
+        self.start = 0
+        self.end = 0
+
+    def append(self, page: Page):
+        self.page_offsets.append(page.offset)
+        self.page_nums.append(page.page_num)
+        self.sentence_endings.extend(
+            self.length + match.start() for match in self.sentence_ending_pattern.finditer(page.text)
+        )
+        self.word_breaks.extend(self.length + match.start() for match in self.word_break_pattern.finditer(page.text))
+        self.text += page.text
+        self.length += len(page.text)
+        self.has_content = self.has_content or not page.text.isspace() and page.text != ""
+
+    def slice(self, start: int, end: int) -> str:
+        return self.text[start - self.offset : end - self.offset]
+
+    def drop_before(self, position: int):
+        # Only drop text once it is at least half of the window, so a long page isn't copied for every section
+        dropped = position - self.offset
+        if dropped <= 0 or dropped < len(self.text) - dropped:
+            return
+        self.text = self.text[position - self.offset :]
+        self.offset = position
+        del self.sentence_endings[: bisect.bisect_left(self.sentence_endings, position)]
+        del self.word_breaks[: bisect.bisect_left(self.word_breaks, position)]
+
+    def is_sentence_ending(self, position: int) -> bool:
+        index = bisect.bisect_left(self.sentence_endings, position)
+        return index < len(self.sentence_endings) and self.sentence_endings[index] == position
+
+    def find_page(self, offset: int) -> int:
+        index = bisect.bisect_right(self.page_offsets, offset) - 1
+        return self.page_nums[index] if index >= 0 else self.page_nums[-1]
+
+
+class IndexedSentenceTextSplitter(SentenceTextSplitter):
+    """
+    Splits pages into the same sections as SentenceTextSplitter in linear time.
+    The positions of sentence endings, word breaks and pages are computed once per document,
+    and split points are found with binary searches instead of checking characters one at a time.
+    Pages can also be streamed in, in which case only a sliding window of the text is kept in memory.
+    """
+
+    def __init__(self, max_tokens_per_section: int = 500):
+        super().__init__(max_tokens_per_section)
+        self.sentence_ending_pattern = re.compile(f"[{re.escape(''.join(self.sentence_endings))}]")
+        self.word_break_pattern = re.compile(f"[{re.escape(''.join(self.word_breaks))}]")
+
+    def split_range_by_max_tokens(
+        self, page_num: int, window: TextWindow, start: int, end: int
+    ) -> Generator[SplitPage, None, None]:
+        """
+        Splits the text between start and end like split_page_by_max_tokens, using the positions in the window
+        """
+        section_text = window.slice(start, end)
+        tokens = bpe.encode(section_text)
+        if len(tokens) <= self.max_tokens_per_section:
+            yield SplitPage(page_num=page_num, text=section_text, token_count=len(tokens))
+            return
+
+        # Find the sentence ending closest to the center, preferring the one before it, within the middle third
+        length = end - start
+        middle = start + length // 2
+        boundary = start + length // 3
+        max_distance = middle - boundary
+        split_position = -1
+        before = last_position_in_range(window.sentence_endings, boundary + 1, middle + 1)
+        after = first_position_in_range(window.sentence_endings, middle, middle + max_distance)
+        if before >= 0 and (after < 0 or middle - before <= after - middle):
+            split_position = before
+        elif after >= 0:
+            split_position = after
+
+        if split_position > start:
+            yield from self.split_range_by_max_tokens(page_num, window, start, split_position + 1)
+            yield from self.split_range_by_max_tokens(page_num, window, split_position + 1, end)
+        else:
+            # Split in half with an overlap of DEFAULT_OVERLAP_PERCENT%
+            overlap = int(length * (DEFAULT_OVERLAP_PERCENT / 100))
+            yield from self.split_range_by_max_tokens(page_num, window, start, middle + overlap)
+            yield from self.split_range_by_max_tokens(page_num, window, middle - overlap, end)
+
+    def split_window(self, window: TextWindow, finished: bool) -> Generator[SplitPage, None, None]:
+        """
+        Yields every section of the window that can't change anymore. Until the document is finished,
+        a section is only split once the text after it is long enough to cover the search for its end.
+        """
+        if not window.has_content:
+            # Documents with only whitespace have no sections
+            return
+        if not window.started:
+            if window.length <= self.max_section_length:
+                if finished:
+                    yield from self.split_range_by_max_tokens(window.find_page(0), window, 0, window.length)
+                return
+            window.started = True
+            window.end = window.length
+
+        start = window.start
+        end = window.end
+        while start + self.section_overlap < window.length:
+            if not finished and window.length <= start + self.max_section_length + self.sentence_search_limit:
+                break
+            end = start + self.max_section_length
+
+            if end > window.length:
+                end = window.length
+            else:
+                # Try to find the end of the sentence within the search limit
+                search_end = min(window.length, end + self.sentence_search_limit)
+                sentence_end = first_position_in_range(window.sentence_endings, end, search_end)
+                if sentence_end >= 0:
+                    end = sentence_end
+                else:
+                    last_word = last_position_in_range(window.word_breaks, end, search_end)
+                    end = search_end
+                    if end < window.length and not window.is_sentence_ending(end) and last_word > 0:
+                        end = last_word  # Fall back to at least keeping a whole word
+            if end < window.length:
+                end += 1
+
+            # Try to find the start of the sentence or at least a whole word boundary
+            search_start = max(0, end - self.max_section_length - 2 * self.sentence_search_limit)
+            sentence_start = last_position_in_range(window.sentence_endings, search_start + 1, start + 1)
+            if sentence_start >= 0:
+                start = sentence_start
+            else:
+                first_word = first_position_in_range(window.word_breaks, search_start + 1, start + 1)
+                start = min(start, search_start)
+                if not window.is_sentence_ending(start) and first_word > 0:
+                    start = first_word
+            if start > 0:
+                start += 1
+
+            yield from self.split_range_by_max_tokens(window.find_page(start), window, start, end)
+
+            section_text = window.slice(start, end)
+            last_figure_start = section_text.rfind("<figure")
+            if last_figure_start > 2 * self.sentence_search_limit and last_figure_start > section_text.rfind(
+                "</figure"
+            ):
+                # If the section ends with an unclosed figure, we need to start the next section with the figure.
+                start = min(end - self.section_overlap, start + last_figure_start)
+                logger.info(
+                    f"Section ends with unclosed figure, starting next section with the figure at page {window.find_page(start)} offset {start} figure start {last_figure_start}"
+                )
+            else:
+                start = end - self.section_overlap
+            # The search for the start of the next section never looks further back than this
+            window.drop_before(max(0, start - self.max_section_length - 2 * self.sentence_search_limit))
+        window.start = start
+        window.end = end
+
+        if finished and start + self.section_overlap < end:
+            yield from self.split_range_by_max_tokens(window.find_page(start), window, start, end)
+
+    def split_pages(self, pages: list[Page]) -> Generator[SplitPage, None, None]:
+        window = TextWindow(self.sentence_ending_pattern, self.word_break_pattern)
+        for page in pages:
+            window.append(page)
+            yield from self.split_window(window, finished=False)
+        yield from self.split_window(window, finished=True)
+
+    async def split_pages_stream(self, pages: AsyncIterable[Page]) -> AsyncGenerator[SplitPage, None]:
+        window = TextWindow(self.sentence_ending_pattern, self.word_break_pattern)
+        async for page in pages:
+            window.append(page)
+            for split_page in self.split_window(window, finished=False):
+                yield split_page
+        for split_page in self.split_window(window, finished=True):
+            yield split_page
+
+
 class SimpleTextSplitter(TextSplitter):
     """
     Class that splits pages into smaller chunks based on a max object length. It is not aware of the content of the page.
@@ -0,0 +1,133 @@
+"""
+Microbenchmark of the page text assembly in DocumentAnalysisParser, on AnalyzeResult JSON files recorded
+from Azure AI Document Intelligence, for example with json.dump(analyze_result.as_dict(), f).
+It compares the parser with the previous per-character masking and checks that both produce the same pages.
+
+Run it from the root of the repository, with the backend on the path:
+    PYTHONPATH=app/backend python scripts/benchmarks/pdfparser.py "tests/test-data/Simple Table_analyzeresult.json" --tile 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Union
+
+from azure.ai.documentintelligence.models import AnalyzeResult
+from azure.core.credentials import AzureKeyCredential
+
+from prepdocslib.page import Page
+from prepdocslib.pdfparser import DocumentAnalysisParser, ObjectType
+
+
+def load_analyze_result(path: str) -> AnalyzeResult:
+    with open(path) as f:
+        return AnalyzeResult(json.load(f))
+
+
+def tile(analyze_result: AnalyzeResult, count: int) -> AnalyzeResult:
+    """Repeats the pages, tables and figures of a result, to measure how the parsers scale with long documents"""
+    content = analyze_result.content
+    data = analyze_result.as_dict()
+    pages: list[dict] = []
+    tables: list[dict] = []
+    figures: list[dict] = []
+    last_page = max((page["pageNumber"] for page in data["pages"]), default=0)
+    for copy in range(count):
+        shift = copy * len(content)
+
+        def shifted(item: dict) -> dict:
+            item = json.loads(json.dumps(item))
+            for span in item.get("spans", []):
+                span["offset"] += shift
+            for cell in item.get("cells", []):
+                for span in cell.get("spans", []):
+                    span["offset"] += shift
+            for region in item.get("boundingRegions", []):
+                region["pageNumber"] += copy * last_page
+            if "pageNumber" in item:
+                item["pageNumber"] += copy * last_page
+            return item
+
+        pages.extend(shifted(page) for page in data["pages"])
+        tables.extend(shifted(table) for table in data.get("tables") or [])
+        figures.extend(shifted(figure) for figure in data.get("figures") or [])
+    return AnalyzeResult({**data, "content": content * count, "pages": pages, "tables": tables, "figures": figures})
+
+
+def per_character_pages(analyze_result: AnalyzeResult) -> list[Page]:
+    """The previous implementation, which masks every character of a page"""
+    result = []
+    offset = 0
+    for page in analyze_result.pages:
+        tables_on_page = [
+            table
+            for table in (analyze_result.tables or [])
+            if table.bounding_regions and table.bounding_regions[0].page_number == page.page_number
+        ]
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        mask_chars: list[tuple[ObjectType, Union[int, None]]] = [(ObjectType.NONE, None)] * page_length
+        for table_idx, table in enumerate(tables_on_page):
+            for span in table.spans:
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if idx >= 0 and idx < page_length:
+                        mask_chars[idx] = (ObjectType.TABLE, table_idx)
+        page_text = ""
+        added_objects = set()
+        for idx, mask_char in enumerate(mask_chars):
+            object_type, object_idx = mask_char
+            if object_type == ObjectType.NONE:
+                page_text += analyze_result.content[page_offset + idx]
+            elif object_idx is not None and mask_char not in added_objects:
+                page_text += DocumentAnalysisParser.table_to_html(tables_on_page[object_idx])
+                added_objects.add(mask_char)
+        page_text = page_text.replace("<!-- PageBreak -->", "").strip()
+        result.append(Page(page_num=page.page_number - 1, offset=offset, text=page_text))
+        offset += len(page_text)
+    return result
+
+
+async def interval_pages(parser: DocumentAnalysisParser, analyze_result: AnalyzeResult) -> list[Page]:
+    return [page async for page in parser.analyze_result_to_pages(analyze_result)]
+
+
+async def main(paths: list[str], repeat: int, tile_count: int):
+    # Figures need the Content Understanding service to be described, so only tables are benchmarked
+    parser = DocumentAnalysisParser(
+        endpoint="https://localhost", credential=AzureKeyCredential("unused"), use_content_understanding=False
+    )
+    print(f"{'analyze result':<50} {'pages':>6} {'tables':>7} {'chars':>10} {'per-char ms':>12} {'interval ms':>12}")
+    for path in paths:
+        analyze_result = load_analyze_result(path)
+        if tile_count > 1:
+            analyze_result = tile(analyze_result, tile_count)
+        per_character_time = interval_time = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            expected = per_character_pages(analyze_result)
+            per_character_time = min(per_character_time, time.perf_counter() - started)
+            started = time.perf_counter()
+            actual = await interval_pages(parser, analyze_result)
+            interval_time = min(interval_time, time.perf_counter() - started)
+        if [(page.page_num, page.offset, page.text) for page in actual] != [
+            (page.page_num, page.offset, page.text) for page in expected
+        ]:
+            raise AssertionError(f"The parsers produced different pages for {path}")
+        pages = analyze_result.pages
+        chars = sum(page.spans[0].length for page in pages)
+        print(
+            f"{os.path.basename(path)[:50]:<50} {len(pages):>6} {len(analyze_result.tables or []):>7} {chars:>10} "
+            f"{per_character_time * 1000:>12.1f} {interval_time * 1000:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the page text assembly on recorded AnalyzeResult files.")
+    parser.add_argument("paths", nargs="+", help="AnalyzeResult JSON files")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per file, the fastest one is kept")
+    parser.add_argument("--tile", type=int, default=1, help="Repeat the pages of each file to simulate longer files")
+    args = parser.parse_args()
+    asyncio.run(main(args.paths, args.repeat, args.tile))
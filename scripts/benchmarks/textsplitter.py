@@ -0,0 +1,88 @@
+"""
+Microbenchmark comparing SentenceTextSplitter with IndexedSentenceTextSplitter on local PDFs.
+Both splitters must produce the same sections, so the benchmark also checks that their outputs match.
+
+Run it from the root of the repository, with the backend on the path:
+    PYTHONPATH=app/backend python scripts/benchmarks/textsplitter.py data --repeat 3 --combine
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import time
+
+from prepdocslib.page import Page
+from prepdocslib.pdfparser import LocalPdfParser
+from prepdocslib.textsplitter import (
+    IndexedSentenceTextSplitter,
+    SentenceTextSplitter,
+    TextSplitter,
+)
+
+
+async def load_pages(path: str) -> list[Page]:
+    with open(path, "rb") as f:
+        return [page async for page in LocalPdfParser().parse(content=f)]
+
+
+def time_splitter(splitter: TextSplitter, pages: list[Page], repeat: int) -> tuple[float, list[tuple[int, str]]]:
+    best = float("inf")
+    sections: list[tuple[int, str]] = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        sections = [(split_page.page_num, split_page.text) for split_page in splitter.split_pages(pages)]
+        best = min(best, time.perf_counter() - started)
+    return best, sections
+
+
+def combine(documents: list[list[Page]]) -> list[Page]:
+    """Concatenates the documents into a single long document, to measure how the splitters scale"""
+    pages: list[Page] = []
+    offset = 0
+    for document in documents:
+        for page in document:
+            pages.append(Page(page_num=len(pages), offset=offset, text=page.text))
+            offset += len(page.text)
+    return pages
+
+
+async def main(directory: str, repeat: int, combine_documents: bool):
+    current = SentenceTextSplitter()
+    indexed = IndexedSentenceTextSplitter()
+    documents = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.pdf"))):
+        documents[os.path.basename(path)] = await load_pages(path)
+    if combine_documents:
+        documents["(all documents combined)"] = combine(list(documents.values()))
+
+    total_current = total_indexed = 0.0
+    print(f"{'document':<60} {'chars':>10} {'sections':>9} {'current ms':>11} {'indexed ms':>11} {'speedup':>8}")
+    for name, pages in documents.items():
+        current_time, current_sections = time_splitter(current, pages, repeat)
+        indexed_time, indexed_sections = time_splitter(indexed, pages, repeat)
+        if current_sections != indexed_sections:
+            raise AssertionError(f"The splitters produced different sections for {name}")
+        if name != "(all documents combined)":
+            total_current += current_time
+            total_indexed += indexed_time
+        chars = sum(len(page.text) for page in pages)
+        print(
+            f"{name[:60]:<60} {chars:>10} {len(current_sections):>9} {current_time * 1000:>11.1f} "
+            f"{indexed_time * 1000:>11.1f} {current_time / max(indexed_time, 1e-9):>7.1f}x"
+        )
+    print(
+        f"{'total':<60} {'':>10} {'':>9} {total_current * 1000:>11.1f} {total_indexed * 1000:>11.1f} "
+        f"{total_current / max(total_indexed, 1e-9):>7.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the sentence text splitters on a folder of PDFs.")
+    parser.add_argument("directory", help="Folder with the PDFs to split, for example data")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per document, the fastest one is kept")
+    parser.add_argument(
+        "--combine", action="store_true", help="Also split all the documents concatenated into one long document"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.directory, args.repeat, args.combine))
@@ -46,7 +46,7 @@ class MockAzureCredentialExpired(AsyncTokenCredential):
 
 
 class MockBlobClient:
-    async def download_blob(self):
+    async def download_blob(self, **kwargs):
         return MockBlob()
 
 
@@ -55,6 +55,7 @@ class MockBlob:
         self.properties = BlobProperties(
             name="Financial Market Analysis Report 2023-7.png", content_settings={"content_type": "image/png"}
         )
+        self.size = 4
 
     async def readall(self):
         return b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\xdac\xfc\xcf\xf0\xbf\x1e\x00\x06\x83\x02\x7f\x94\xad\xd0\xeb\x00\x00\x00\x00IEND\xaeB`\x82"
@@ -62,6 +63,9 @@ class MockBlob:
     async def readinto(self, buffer: BytesIO):
         buffer.write(b"test")
 
+    async def chunks(self):
+        yield b"test"
+
 
 class MockAsyncPageIterator:
     def __init__(self, data):
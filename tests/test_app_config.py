@@ -5,6 +5,7 @@ import pytest
 import quart
 
 import app
+from core.embeddingcache import InMemoryEmbeddingCacheBackend
 
 
 @pytest.fixture
@@ -55,6 +56,15 @@ async def test_app_azure_custom_identity(monkeypatch, minimal_env):
         assert quart_app.config[app.CONFIG_OPENAI_CLIENT].base_url == "http://azureapi.com/api/v1/openai/"
 
 
+@pytest.mark.asyncio
+async def test_app_query_embedding_cache_backend(monkeypatch, minimal_env):
+    backend = InMemoryEmbeddingCacheBackend()
+    quart_app = app.create_app()
+    quart_app.config[app.CONFIG_QUERY_EMBEDDING_CACHE_BACKEND] = backend
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_QUERY_EMBEDDING_CACHE].backend is backend
+
+
 @pytest.mark.asyncio
 async def test_app_user_upload_processors(monkeypatch, minimal_env):
     monkeypatch.setenv("AZURE_USERSTORAGE_ACCOUNT", "test-user-storage-account")
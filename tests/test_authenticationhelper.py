@@ -11,6 +11,7 @@ from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchField, SearchIndex
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
+from msal import ConfidentialClientApplication
 
 from core.authentication import AuthenticationHelper, AuthError
 
@@ -111,6 +112,48 @@ async def test_get_auth_claims_overage_unauthorized(
     assert len(auth_claims.keys()) == 0
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached(
+    monkeypatch, mock_confidential_client_overage, mock_list_groups_success, mock_validate_token_success
+):
+    on_behalf_of_calls = []
+    acquire_token_on_behalf_of = ConfidentialClientApplication.acquire_token_on_behalf_of
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        on_behalf_of_calls.append(kwargs["user_assertion"])
+        return acquire_token_on_behalf_of(self, *args, **kwargs)
+
+    list_groups_calls = []
+    list_groups = AuthenticationHelper.list_groups
+
+    async def mock_list_groups(graph_resource_access_token, session=None):
+        list_groups_calls.append(graph_resource_access_token)
+        return await list_groups(graph_resource_access_token, session)
+
+    monkeypatch.setattr(ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of)
+    monkeypatch.setattr(AuthenticationHelper, "list_groups", mock_list_groups)
+    helper = create_authentication_helper()
+    token, _, _ = create_mock_jwt()
+    other_token, _, _ = create_mock_jwt()
+
+    for _ in range(2):
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+        assert auth_claims == {"oid": "OID_X", "groups": ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]}
+    # The claims are reused for the same access token, until it expires
+    assert on_behalf_of_calls == [token]
+
+    # A new access token of the same user is exchanged again, but the groups of the user are reused
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {other_token}"})
+    assert auth_claims == {"oid": "OID_X", "groups": ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]}
+    assert on_behalf_of_calls == [token, other_token]
+    assert len(list_groups_calls) == 1
+
+    # Tokens without an expiry are not cached
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert on_behalf_of_calls == [token, other_token, "Token", "Token"]
+
+
 @pytest.mark.asyncio
 async def test_list_groups_success(mock_list_groups_success, mock_validate_token_success):
     groups = await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
@@ -458,6 +501,38 @@ async def test_check_path_auth_allowed_fragment(
     )
 
 
+@pytest.mark.asyncio
+async def test_check_path_auth_cached(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
+    filters = []
+    allowed = False
+
+    async def mock_search(self, *args, **kwargs):
+        filters.append(kwargs.get("filter"))
+        return MockAsyncPageIterator(data=[{"sourcefile": "Benefit_Options.pdf"}] if allowed else [])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    async def check_path_auth(path: str, groups: list[str]) -> bool:
+        return await auth_helper_require_access_control.check_path_auth(
+            path=path, auth_claims={"oid": "OID_X", "groups": groups}, search_client=create_search_client()
+        )
+
+    assert await check_path_auth("Benefit_Options.pdf", ["GROUP_Y", "GROUP_Z"]) is False
+    allowed = True
+    # The denied decision is reused for the same path, even with a fragment and the groups in another order
+    assert await check_path_auth("Benefit_Options.pdf#page=2", ["GROUP_Z", "GROUP_Y"]) is False
+    assert len(filters) == 1
+    # Other groups get their own decision
+    assert await check_path_auth("Benefit_Options.pdf", ["GROUP_Y"]) is True
+    assert len(filters) == 2
+
+    # Uploading or deleting a file forgets the decisions of the user
+    auth_helper_require_access_control.invalidate_path_auth("OID_X")
+    assert await check_path_auth("Benefit_Options.pdf", ["GROUP_Y", "GROUP_Z"]) is True
+    assert len(filters) == 3
+
+
 @pytest.mark.asyncio
 async def test_check_path_auth_allowed_without_access_control(
     monkeypatch, mock_confidential_client_success, mock_validate_token_success
@@ -649,3 +724,67 @@ async def test_validate_access_token(monkeypatch, mock_confidential_client_succe
 
     helper = create_authentication_helper()
     await helper.validate_access_token(mock_token)
+
+
+def create_jwk(public_key: rsa.RSAPublicKey, kid: str) -> dict[str, str]:
+    def encode(value: int) -> str:
+        return (
+            base64.urlsafe_b64encode(value.to_bytes((value.bit_length() + 7) // 8, byteorder="big"))
+            .decode()
+            .rstrip("=")
+        )
+
+    numbers = public_key.public_numbers()
+    return {"kty": "RSA", "use": "sig", "kid": kid, "n": encode(numbers.n), "e": encode(numbers.e)}
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_caches_keys_and_tokens(monkeypatch, mock_confidential_client_success):
+    now = 1000.0
+    monkeypatch.setattr("core.authentication.time.monotonic", lambda: now)
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    new_private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    _, _, payload = create_mock_jwt()
+    jwks = {"keys": [create_jwk(private_key.public_key(), "mock_kid")]}
+    fetches = 0
+
+    def mock_get(*args, **kwargs):
+        nonlocal fetches
+        fetches += 1
+        return MockResponse(status=200, text=json.dumps(jwks))
+
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+    decodes = 0
+    original_decode = jwt.decode
+
+    def mock_decode(*args, **kwargs):
+        nonlocal decodes
+        decodes += 1
+        return original_decode(*args, **kwargs)
+
+    monkeypatch.setattr(jwt, "decode", mock_decode)
+
+    def sign(oid: str, key: rsa.RSAPrivateKey, kid: str) -> str:
+        return jwt.encode({**payload, "oid": oid}, key, algorithm="RS256", headers={"kid": kid})
+
+    helper = create_authentication_helper()
+    token = sign("OID_X", private_key, "mock_kid")
+    await helper.validate_access_token(token)
+    assert fetches == 1
+    # A verified token isn't decoded again until it expires
+    decodes = 0
+    await helper.validate_access_token(token)
+    assert decodes == 0
+    # The keys are reused for other tokens
+    await helper.validate_access_token(sign("OID_Y", private_key, "mock_kid"))
+    assert fetches == 1
+
+    # A token signed with an unknown key only fetches the keys again after the minimum refresh interval
+    jwks["keys"].append(create_jwk(new_private_key.public_key(), "new_kid"))
+    new_token = sign("OID_X", new_private_key, "new_kid")
+    with pytest.raises(AuthError):
+        await helper.validate_access_token(new_token)
+    assert fetches == 1
+    now += 5 * 60
+    await helper.validate_access_token(new_token)
+    assert fetches == 2
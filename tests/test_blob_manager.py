@@ -1,14 +1,29 @@
+import asyncio
+import contextlib
+import hashlib
+import io
 import os
+import pathlib
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
+from urllib.parse import quote
 
 import azure.storage.blob.aio
 import pytest
+from azure.storage.blob import UserDelegationKey
 
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.listfilestrategy import File
 
-from .mocks import MockAzureCredential
+from .mocks import MockAsyncPageIterator, MockAzureCredential
+
+TEST_DATA_DIR = pathlib.Path(__file__).parent / "test-data"
+
+
+class MockResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
 
 
 @pytest.fixture
@@ -67,13 +82,15 @@ async def test_upload_and_remove(monkeypatch, mock_env, blob_manager):
 
         monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.list_blob_names", mock_list_blob_names)
 
-        async def mock_delete_blob(self, name, *args, **kwargs):
-            assert name == filename
-            return True
+        async def mock_delete_blobs(self, *names, **kwargs):
+            assert names == (filename,)
+            return MockAsyncPageIterator([MockResponse(202)])
 
-        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blob", mock_delete_blob)
+        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blobs", mock_delete_blobs)
 
-        await blob_manager.remove_blob(f.content.name)
+        summary = await blob_manager.remove_blob(f.content.name)
+        assert summary.deleted == [filename]
+        assert summary.failed == []
 
 
 @pytest.mark.asyncio
@@ -120,13 +137,14 @@ async def test_upload_and_remove_all(monkeypatch, mock_env, blob_manager):
 
         monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.list_blob_names", mock_list_blob_names)
 
-        async def mock_delete_blob(self, name, *args, **kwargs):
-            assert name == filename
-            return True
+        async def mock_delete_blobs(self, *names, **kwargs):
+            assert names == (filename,)
+            return MockAsyncPageIterator([MockResponse(202)])
 
-        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blob", mock_delete_blob)
+        monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blobs", mock_delete_blobs)
 
-        await blob_manager.remove_blob()
+        summary = await blob_manager.remove_blob()
+        assert summary.deleted == [filename]
 
 
 @pytest.mark.asyncio
@@ -159,6 +177,49 @@ async def test_create_container_upon_upload(monkeypatch, mock_env, blob_manager)
         assert f.url == "https://test.blob.core.windows.net/test/test.pdf"
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_upload_blobs_share_client(monkeypatch, mock_env, blob_manager):
+    exists_calls = 0
+
+    async def mock_exists(*args, **kwargs):
+        nonlocal exists_calls
+        exists_calls += 1
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    uploads = []
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        uploads.append((name, data.read(), kwargs.get("max_concurrency")))
+        return azure.storage.blob.aio.BlobClient.from_blob_url(
+            f"https://test.blob.core.windows.net/test/{name}", credential=MockAzureCredential()
+        )
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    files = []
+    for name in ["a.txt", "b.txt"]:
+        content = io.BytesIO(b"content of " + name.encode())
+        content.name = f"tmp/{name}"
+        # A parser may be in the middle of reading the file
+        content.seek(3)
+        files.append(File(content))
+
+    await blob_manager.upload_blob(files[0])
+    service_client = blob_manager.service_client
+    await blob_manager.upload_blob(files[1])
+
+    assert blob_manager.service_client is service_client
+    assert exists_calls == 1
+    assert uploads == [("a.txt", b"content of a.txt", 4), ("b.txt", b"content of b.txt", 4)]
+    assert [f.content.tell() for f in files] == [3, 3]
+
+    await blob_manager.close()
+    assert blob_manager.service_client is None
+
+
 @pytest.mark.asyncio
 @pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
 async def test_upload_blob_no_image(monkeypatch, mock_env, caplog):
@@ -204,10 +265,10 @@ async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
 
     monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
 
-    async def mock_delete_blob(*args, **kwargs):
-        assert False, "delete_blob() shouldn't have been called"
+    async def mock_delete_blobs(*args, **kwargs):
+        assert False, "delete_blobs() shouldn't have been called"
 
-    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blob", mock_delete_blob)
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blobs", mock_delete_blobs)
 
     await blob_manager.remove_blob()
 
@@ -227,3 +288,151 @@ def test_sourcepage_from_file_page():
 def test_blob_name_from_file_name():
     assert BlobManager.blob_name_from_file_name("tmp/test.pdf") == "test.pdf"
     assert BlobManager.blob_name_from_file_name("tmp/test.html") == "test.html"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "image_format,magic,use_executor",
+    [("png", b"\x89PNG", False), ("jpeg", b"\xff\xd8\xff", True), ("webp", b"RIFF", False)],
+)
+async def test_upload_pdf_blob_images(monkeypatch, mock_env, image_format, magic, use_executor):
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    async def mock_get_user_delegation_key(self, *args, **kwargs):
+        return UserDelegationKey()
+
+    monkeypatch.setattr(
+        "azure.storage.blob.aio.BlobServiceClient.get_user_delegation_key", mock_get_user_delegation_key
+    )
+    monkeypatch.setattr("prepdocslib.blobmanager.generate_blob_sas", lambda **kwargs: "sas")
+
+    uploaded = {}
+    uploading = 0
+    max_uploading = 0
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        nonlocal uploading, max_uploading
+        uploading += 1
+        max_uploading = max(max_uploading, uploading)
+        await asyncio.sleep(0.01)
+        uploading -= 1
+        if isinstance(data, bytes):
+            uploaded[name] = (data, kwargs["content_settings"].content_type)
+        return azure.storage.blob.aio.BlobClient.from_blob_url(
+            f"https://test.blob.core.windows.net/test/{name}", credential=MockAzureCredential()
+        )
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    with ThreadPoolExecutor(max_workers=2) if use_executor else contextlib.nullcontext() as executor:
+        blob_manager = BlobManager(
+            endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            container=os.environ["AZURE_STORAGE_CONTAINER"],
+            account=os.environ["AZURE_STORAGE_ACCOUNT"],
+            resourceGroup=os.environ["AZURE_STORAGE_RESOURCE_GROUP"],
+            subscriptionId=os.environ["AZURE_SUBSCRIPTION_ID"],
+            store_page_images=True,
+            upload_concurrency=3,
+            image_format=image_format,
+            executor=executor,
+            executor_workers=2,
+        )
+        with open(TEST_DATA_DIR / "Financial Market Analysis Report 2023.pdf", "rb") as f:
+            page_images = await blob_manager.upload_blob(File(f))
+
+    # The images keep their .png names whatever their format, and are returned in page order
+    image_names = [f"Financial Market Analysis Report 2023-{page}.png" for page in range(1, 11)]
+    assert page_images is not None
+    assert [image.url for image in page_images] == [
+        f"https://test.blob.core.windows.net/test/{quote(name)}?sas" for name in image_names
+    ]
+    assert [image.content_hash for image in page_images] == [
+        hashlib.sha256(uploaded[name][0]).hexdigest() for name in image_names
+    ]
+    assert sorted(uploaded) == sorted(image_names)
+    for data, content_type in uploaded.values():
+        assert data.startswith(magic)
+        assert content_type == f"image/{image_format}"
+    assert max_uploading == 3
+
+
+def test_blob_manager_unsupported_image_format():
+    with pytest.raises(ValueError):
+        BlobManager(
+            endpoint="https://test.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            container="test",
+            account="test",
+            resourceGroup="test",
+            subscriptionId="test",
+            image_format="gif",
+        )
+
+
+@pytest.mark.asyncio
+async def test_remove_blob_in_batches(monkeypatch, mock_env, blob_manager):
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    page_blobs = [f"report-{page}.png" for page in range(1, 601)]
+    listed_blobs = [
+        "report.pdf",
+        "report-summary.pdf",
+        "report-1.txt",
+        "reports-1.png",
+        # Other source files whose name looks like a page of report.pdf
+        "report-2.pdf",
+        "report-2025.pdf",
+        *page_blobs,
+    ]
+
+    def mock_list_blob_names(*args, **kwargs):
+        assert kwargs.get("name_starts_with") == "report"
+        return MockAsyncPageIterator(list(listed_blobs))
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.list_blob_names", mock_list_blob_names)
+
+    batches = []
+    deleting = 0
+    max_deleting = 0
+
+    async def mock_delete_blobs(self, *names, **kwargs):
+        nonlocal deleting, max_deleting
+        assert kwargs.get("raise_on_any_failure") is False
+        deleting += 1
+        max_deleting = max(max_deleting, deleting)
+        await asyncio.sleep(0.01)
+        deleting -= 1
+        batches.append(names)
+        return MockAsyncPageIterator([MockResponse(403 if name == "report-7.png" else 202) for name in names])
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.delete_blobs", mock_delete_blobs)
+
+    summary = await blob_manager.remove_blob("data/report.pdf")
+
+    assert sorted(len(batch) for batch in batches) == [89, 256, 256]
+    assert max_deleting == 3
+    # Only the blob of the file and the blobs of its pages are removed
+    assert sorted(summary.deleted) == sorted(["report.pdf", *page_blobs[:6], *page_blobs[7:]])
+    assert summary.failed == ["report-7.png"]
+
+
+def test_is_blob_of_file():
+    assert BlobManager.is_blob_of_file("report.pdf", "data/report.pdf")
+    assert BlobManager.is_blob_of_file("report-12.png", "data/report.pdf")
+    assert not BlobManager.is_blob_of_file("report-2.pdf", "data/report.pdf")
+    assert not BlobManager.is_blob_of_file("report-2-1.png", "data/report.pdf")
+    assert not BlobManager.is_blob_of_file("notes-1.png", "data/notes.txt")
+    assert BlobManager.is_blob_of_file("my-report-2.png", "my-report.pdf")
+    assert not BlobManager.is_blob_of_file("report-2.txt", "data/report.pdf")
+    assert not BlobManager.is_blob_of_file("report-summary.png", "data/report.pdf")
+    assert not BlobManager.is_blob_of_file("reports-2.png", "data/report.pdf")
+    # Characters that have a meaning in regular expressions are matched as they are
+    assert BlobManager.is_blob_of_file("report (1)-2.png", "report (1).pdf")
+    assert not BlobManager.is_blob_of_file("report 1-2.png", "report.1.pdf")
@@ -28,15 +28,67 @@ class MockAiohttpClientResponse404(aiohttp.ClientResponse):
 
 
 class MockAiohttpClientResponse(aiohttp.ClientResponse):
-    def __init__(self, url, body_bytes, headers=None):
+    def __init__(self, url, body_bytes, headers=None, status=200, reason="OK"):
         self._body = body_bytes
         self._headers = headers
         self._cache = {}
-        self.status = 200
-        self.reason = "OK"
+        self.status = status
+        self.reason = reason
         self._url = url
 
 
+class MockRangeTransport(AsyncHttpTransport):
+    """Serves a single blob, honoring the range and If-None-Match headers of the requests"""
+
+    def __init__(self, content: bytes, etag: str):
+        self.content = content
+        self.etag = etag
+        self.requests: list[HttpRequest] = []
+
+    async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+        self.requests.append(request)
+        headers = {
+            "Content-Type": "application/pdf",
+            "ETag": self.etag,
+            "Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT",
+        }
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match and self.etag in [etag.strip() for etag in if_none_match.split(",")]:
+            return AioHttpTransportResponse(
+                request, MockAiohttpClientResponse(request.url, b"", headers, status=304, reason="Not Modified")
+            )
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(self.content))
+            return AioHttpTransportResponse(request, MockAiohttpClientResponse(request.url, b"", headers))
+        start, end = (int(value) for value in request.headers["x-ms-range"][len("bytes=") :].split("-"))
+        if start >= len(self.content):
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(request.url, b"", headers, status=416, reason="Range Not Satisfiable"),
+            )
+        end = min(end, len(self.content) - 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(self.content)}"
+        headers["Content-Length"] = str(end - start + 1)
+        return AioHttpTransportResponse(
+            request,
+            MockAiohttpClientResponse(
+                request.url, self.content[start : end + 1], headers, status=206, reason="Partial Content"
+            ),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
 @pytest.mark.asyncio
 async def test_content_file(monkeypatch, mock_env, mock_acs_search):
 
@@ -52,8 +104,8 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
                         b"test content",
                         {
                             "Content-Type": "application/octet-stream",
-                            "Content-Range": "bytes 0-27/28",
-                            "Content-Length": "28",
+                            "Content-Range": "bytes 0-11/12",
+                            "Content-Length": "12",
                         },
                     ),
                 )
@@ -101,7 +153,7 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
 async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_blob_container_client):
 
     class MockBlobClient:
-        async def download_blob(self):
+        async def download_blob(self, **kwargs):
             raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
     monkeypatch.setattr(
@@ -110,7 +162,7 @@ async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_bl
 
     downloaded_files = []
 
-    async def mock_download_file(self):
+    async def mock_download_file(self, **kwargs):
         downloaded_files.append(self.path_name)
         return MockBlob()
 
@@ -125,17 +177,79 @@ async def test_content_file_useruploaded_found(monkeypatch, auth_client, mock_bl
 async def test_content_file_useruploaded_notfound(monkeypatch, auth_client, mock_blob_container_client):
 
     class MockBlobClient:
-        async def download_blob(self):
+        async def download_blob(self, **kwargs):
             raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
     monkeypatch.setattr(
         azure.storage.blob.aio.ContainerClient, "get_blob_client", lambda *args, **kwargs: MockBlobClient()
     )
 
-    async def mock_download_file(self):
+    async def mock_download_file(self, **kwargs):
         raise ResourceNotFoundError(MockAiohttpClientResponse404("userdoc.pdf", b""))
 
     monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "download_file", mock_download_file)
 
     response = await auth_client.get("/content/userdoc.pdf", headers={"Authorization": "Bearer test"})
     assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_content_file_range_and_etag(mock_env, mock_acs_search):
+    content = bytes(range(256)) * 40
+    transport = MockRangeTransport(content, '"0x8DC"')
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=transport,
+        retry_total=0,
+        max_single_get_size=4096,
+        max_chunk_get_size=4096,
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": blob_container_client})
+        client = test_app.test_client()
+
+        # The whole file is streamed in chunks
+        response = await client.get("/content/large.pdf")
+        assert response.status_code == 200
+        assert response.headers["ETag"] == '"0x8DC"'
+        assert response.headers["Last-Modified"] == "Wed, 01 Jan 2025 00:00:00 GMT"
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert response.headers["Content-Length"] == str(len(content))
+        assert await response.get_data() == content
+        assert len(transport.requests) == 3
+
+        response = await client.get("/content/large.pdf", headers={"Range": "bytes=5000-5099"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 5000-5099/{len(content)}"
+        assert await response.get_data() == content[5000:5100]
+
+        response = await client.get("/content/large.pdf", headers={"Range": "bytes=10000-"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 10000-{len(content) - 1}/{len(content)}"
+        assert await response.get_data() == content[10000:]
+
+        # A range past the end of the file is served up to the last byte
+        response = await client.get("/content/large.pdf", headers={"Range": "bytes=10000-99999999"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 10000-{len(content) - 1}/{len(content)}"
+        assert response.headers["Content-Length"] == str(len(content) - 10000)
+        assert await response.get_data() == content[10000:]
+
+        response = await client.get("/content/large.pdf", headers={"If-None-Match": '"0x8DC"'})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == '"0x8DC"'
+        assert await response.get_data() == b""
+
+        # The 304 carries the ETag of the file, not the list of ETags sent by the client
+        response = await client.get("/content/large.pdf", headers={"If-None-Match": '"0x8DA", "0x8DC"'})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == '"0x8DC"'
+
+        # A range that starts past the end of the file reports the size of the file
+        response = await client.get("/content/large.pdf", headers={"Range": "bytes=20000-"})
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == f"bytes */{len(content)}"
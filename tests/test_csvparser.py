@@ -1,4 +1,5 @@
 import io
+from concurrent.futures import ProcessPoolExecutor
 
 import pytest
 
@@ -55,3 +56,15 @@ async def test_csvparser_empty_file():
 
     # Assertions
     assert len(pages) == 0  # No rows should be parsed from an empty file
+
+
+@pytest.mark.asyncio
+async def test_csvparser_executor():
+    file = io.BytesIO(b"col1,col2,col3\nvalue1,value2,value3\nvalue4,value5,value6")
+    file.name = "test.csv"
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        pages = [page async for page in CsvParser(executor=executor).parse(file)]
+    assert [(page.page_num, page.offset, page.text) for page in pages] == [
+        (0, 0, "value1,value2,value3"),
+        (1, 21, "value4,value5,value6"),
+    ]
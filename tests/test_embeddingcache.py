@@ -0,0 +1,111 @@
+import pytest
+
+from prepdocslib.embeddingcache import EmbeddingCache
+from prepdocslib.embeddings import ImageEmbeddings, OpenAIEmbeddingService
+
+from .mocks import (
+    MOCK_EMBEDDING_DIMENSIONS,
+    MOCK_EMBEDDING_MODEL_NAME,
+    MockAzureCredential,
+)
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_get_put(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    assert await cache.get_many("model", 3, ["foo", "bar"]) == [None, None]
+    await cache.put_many("model", 3, ["foo"], [[0.0023064255, -0.009327292, -0.0028842222]])
+    assert await cache.get_many("model", 3, ["foo", "bar", "foo"]) == [
+        [0.0023064255, -0.009327292, -0.0028842222],
+        None,
+        [0.0023064255, -0.009327292, -0.0028842222],
+    ]
+    # The model and the dimensions are part of the key
+    assert await cache.get_many("model", 2, ["foo"]) == [None]
+    assert await cache.get_many("other-model", 3, ["foo"]) == [None]
+    assert cache.hits == 2
+    assert cache.misses == 5
+    cache.close()
+
+    # The embeddings are kept across runs
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    assert cache.size_bytes == 3 * 8
+    assert await cache.get_many("model", 3, ["foo"]) == [[0.0023064255, -0.009327292, -0.0028842222]]
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_eviction(tmp_path, monkeypatch):
+    now = 0.0
+
+    def mock_time():
+        return now
+
+    monkeypatch.setattr("prepdocslib.embeddingcache.time.time", mock_time)
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_size_bytes=2 * 3 * 8)
+    await cache.put_many("model", 3, ["a"], [[1.0, 1.0, 1.0]])
+    now = 1
+    await cache.put_many("model", 3, ["b"], [[2.0, 2.0, 2.0]])
+    now = 2
+    # Reading "a" makes "b" the least recently used embedding
+    await cache.get_many("model", 3, ["a"])
+    now = 3
+    await cache.put_many("model", 3, ["c"], [[3.0, 3.0, 3.0]])
+    assert cache.size_bytes == 2 * 3 * 8
+    assert await cache.get_many("model", 3, ["a", "b", "c"]) == [[1.0, 1.0, 1.0], None, [3.0, 3.0, 3.0]]
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_create_embeddings_with_cache(tmp_path, monkeypatch):
+    computed_texts = []
+
+    async def mock_compute_embeddings(texts, token_counts=None):
+        computed_texts.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+        cache=cache,
+    )
+    monkeypatch.setattr(embeddings, "compute_embeddings", mock_compute_embeddings)
+
+    assert await embeddings.create_embeddings(["a", "bb", "a"]) == [[1.0], [2.0], [1.0]]
+    assert await embeddings.create_embeddings(["bb", "ccc", "a"]) == [[2.0], [3.0], [1.0]]
+    assert await embeddings.create_embeddings(["a", "ccc"]) == [[1.0], [3.0]]
+    assert computed_texts == [["a", "bb"], ["ccc"]]
+    assert cache.hits == 4
+    assert cache.misses == 4
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_create_image_embeddings_with_cache(tmp_path, monkeypatch):
+    computed_urls = []
+
+    async def mock_compute_embeddings(blob_urls):
+        computed_urls.append(blob_urls)
+        return [[float(blob_url[-1])] for blob_url in blob_urls]
+
+    async def mock_token_provider():
+        return "token"
+
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    image_embeddings = ImageEmbeddings("https://vision.example.com", mock_token_provider, cache=cache)
+    monkeypatch.setattr(image_embeddings, "compute_embeddings", mock_compute_embeddings)
+
+    assert await image_embeddings.create_embeddings(["a-1", "a-2", "a-3"], ["hash1", "hash2", "hash1"]) == [
+        [1.0],
+        [2.0],
+        [1.0],
+    ]
+    # Pages are found by the hash of their image, whatever their URL
+    assert await image_embeddings.create_embeddings(["b-4", "b-5"], ["hash2", "hash3"]) == [[2.0], [5.0]]
+    assert computed_urls == [["a-1", "a-2"], ["b-5"]]
+    # Without the hashes, the images are always embedded
+    assert await image_embeddings.create_embeddings(["c-6"]) == [[6.0]]
+    assert computed_urls[-1] == ["c-6"]
+    cache.close()
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 
 import aiohttp
 import pytest
@@ -11,7 +12,7 @@ from azure.core.pipeline.transport import (
 from azure.storage.blob.aio import BlobServiceClient
 
 from approaches.approach import Document
-from core.imageshelper import fetch_image
+from core.imageshelper import PageImageCache, fetch_image, fetch_images
 
 from .mocks import MockAzureCredential
 
@@ -95,3 +96,97 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
     test_document.sourcepage = ""
     image_url = await fetch_image(blob_container_client, test_document)
     assert image_url is None
+
+
+def test_page_image_cache():
+    cache = PageImageCache(max_size_bytes=10)
+    cache.put("a.png", "etag-a", "aaaa")
+    cache.put("b.png", "etag-b", "bbbb")
+    assert cache.get("a.png") == ("etag-a", "aaaa")
+    # Adding c evicts b, the least recently used image
+    cache.put("c.png", "etag-c", "cccc")
+    assert cache.get("b.png") is None
+    assert len(cache) == 2 and cache.size_bytes == 8
+    # A new version of an image replaces the previous one
+    cache.put("a.png", "etag-a2", "aa")
+    assert cache.get("a.png") == ("etag-a2", "aa")
+    assert cache.size_bytes == 6
+    # Images larger than the cache are not kept
+    cache.put("d.png", "etag-d", "d" * 11)
+    assert cache.get("d.png") is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_cached(mock_env):
+    class MockAiohttpClientResponse(aiohttp.ClientResponse):
+        def __init__(self, url, status, body_bytes, headers):
+            self._body = body_bytes
+            self._headers = headers
+            self._cache = {}
+            self.status = status
+            self.reason = "OK" if status == 200 else "Not Modified"
+            self._url = url
+
+    class MockTransport(AsyncHttpTransport):
+        def __init__(self):
+            self.requests: list[tuple[str, Optional[str]]] = []
+
+        async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+            if_none_match = request.headers.get("If-None-Match")
+            self.requests.append((request.url.split("?")[0].rsplit("/", 1)[-1], if_none_match))
+            if if_none_match == '"etag"':
+                return AioHttpTransportResponse(
+                    request, MockAiohttpClientResponse(request.url, 304, b"", {"ETag": '"etag"'})
+                )
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(
+                    request.url,
+                    200,
+                    b"test content",
+                    {
+                        "Content-Type": "image/png",
+                        "Content-Range": "bytes 0-11/12",
+                        "Content-Length": "12",
+                        "ETag": '"etag"',
+                    },
+                ),
+            )
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def open(self):
+            pass
+
+        async def close(self):
+            pass
+
+    transport = MockTransport()
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=transport,
+        retry_total=0,
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
+    def create_document(sourcepage: str) -> Document:
+        return Document(id=sourcepage, content="test content", sourcefile="test.pdf", sourcepage=sourcepage)
+
+    results = [create_document("test-1.pdf"), create_document("test-2.pdf"), create_document("test-1.pdf")]
+    cache = PageImageCache()
+    image_url = "data:image/png;base64,dGVzdCBjb250ZW50"
+
+    # Each page image is downloaded once, and kept in the order of the results
+    assert await fetch_images(blob_container_client, results, cache) == [image_url] * 3
+    assert sorted(transport.requests) == [("test-1.png", None), ("test-2.png", None)]
+    assert len(cache) == 2
+
+    # Cached images are only revalidated with their ETag
+    transport.requests.clear()
+    assert await fetch_images(blob_container_client, results[:1], cache) == [image_url]
+    assert transport.requests == [("test-1.png", '"etag"')]
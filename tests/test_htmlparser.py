@@ -1,4 +1,5 @@
 import io
+from concurrent.futures import ProcessPoolExecutor
 
 import pytest
 
@@ -74,3 +75,13 @@ async def test_htmlparser_full():
         pages[0].text
         == "Test title\nTest header\n Test paragraph one\n Test paragraph two\n Test paragraph three\n -- Test hyphens --"
     )
+
+
+@pytest.mark.asyncio
+async def test_htmlparser_executor():
+    file = io.StringIO("<p>              Test multiple white spaces <br><br><br> and new lines </p>")
+    file.name = "test.html"
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        pages = [page async for page in LocalHTMLParser(executor=executor).parse(file)]
+    assert len(pages) == 1
+    assert pages[0].text == "Test multiple white spaces and new lines"
@@ -0,0 +1,44 @@
+import pytest
+
+from prepdocslib.httpsession import (
+    SharedHttpSession,
+    create_http_session,
+    use_http_session,
+)
+
+
+@pytest.mark.asyncio
+async def test_create_http_session():
+    session = create_http_session(connection_limit=10, connection_limit_per_host=5, dns_cache_ttl=60)
+    assert session.connector.limit == 10
+    assert session.connector.limit_per_host == 5
+    assert session.connector.use_dns_cache
+    await session.close()
+
+
+@pytest.mark.asyncio
+async def test_shared_http_session():
+    shared_session = SharedHttpSession()
+    session = shared_session.get()
+    assert shared_session.get() is session
+
+    # A session that was closed is replaced on next use
+    await session.close()
+    new_session = shared_session.get()
+    assert new_session is not session
+    await shared_session.close()
+    assert new_session.closed
+
+
+@pytest.mark.asyncio
+async def test_use_http_session():
+    session = create_http_session()
+    async with use_http_session(session) as used_session:
+        assert used_session is session
+    # The caller's session stays open
+    assert not session.closed
+    await session.close()
+
+    async with use_http_session(None) as new_session:
+        assert not new_session.closed
+    assert new_session.closed
@@ -0,0 +1,94 @@
+import asyncio
+import json
+from typing import Optional
+
+import pytest
+from azure.search.documents.models import IndexingResult
+
+from prepdocslib.indexuploader import (
+    IndexingError,
+    IndexUploader,
+    batch_documents_by_size,
+)
+
+
+def indexing_result(key: str, status_code: int) -> IndexingResult:
+    result = IndexingResult()
+    result.key = key
+    result.status_code = status_code
+    result.succeeded = status_code in (200, 201)
+    result.error_message = None if result.succeeded else "error"
+    return result
+
+
+class MockSearchClient:
+    def __init__(self, status_codes: Optional[dict[str, list[int]]] = None, delay: float = 0):
+        # Status codes returned for each key on successive attempts, documents succeed once these are used up
+        self.status_codes = {key: list(codes) for key, codes in (status_codes or {}).items()}
+        self.delay = delay
+        self.uploads: list[list[str]] = []
+        self.running = 0
+        self.max_running = 0
+
+    async def upload_documents(self, documents):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        self.uploads.append([document["id"] for document in documents])
+        results = []
+        for document in documents:
+            codes = self.status_codes.get(document["id"])
+            results.append(indexing_result(document["id"], codes.pop(0) if codes else 201))
+        return results
+
+
+def test_batch_documents_by_size():
+    documents = [{"id": str(i), "embedding": [0.123456789] * 100} for i in range(10)]
+    document_bytes = len(json.dumps(documents[0], separators=(",", ":"))) + 1
+
+    batches = batch_documents_by_size(documents, max_batch_size=1000, max_batch_bytes=3 * document_bytes)
+    assert [len(batch) for batch in batches] == [3, 3, 3, 1]
+    assert [document for batch in batches for document in batch] == documents
+
+    assert [len(batch) for batch in batch_documents_by_size(documents, max_batch_size=4)] == [4, 4, 2]
+    # A document larger than the limit is still sent, on its own
+    assert [len(batch) for batch in batch_documents_by_size(documents, max_batch_bytes=10)] == [1] * 10
+
+
+@pytest.mark.asyncio
+async def test_index_uploader_concurrency():
+    search_client = MockSearchClient(delay=0.01)
+    uploader = IndexUploader(search_client, concurrency=2, max_batch_size=2)
+    await uploader.add([{"id": str(i)} for i in range(10)])
+    await uploader.flush()
+
+    assert search_client.max_running == 2
+    assert sorted(key for upload in search_client.uploads for key in upload) == sorted(str(i) for i in range(10))
+    assert uploader.failed_keys == []
+
+
+@pytest.mark.asyncio
+async def test_index_uploader_retries_failed_keys():
+    search_client = MockSearchClient(status_codes={"1": [503, 503], "2": [400], "3": [429]})
+    uploader = IndexUploader(search_client, retry_delay=0)
+    await uploader.add([{"id": str(i)} for i in range(5)])
+    with pytest.raises(IndexingError) as exc_info:
+        await uploader.flush()
+
+    # Only the documents that failed with a retriable status code are sent again
+    assert search_client.uploads == [["0", "1", "2", "3", "4"], ["1", "3"], ["1"]]
+    assert uploader.failed_keys == ["2"]
+    assert exc_info.value.keys == ["2"]
+
+
+@pytest.mark.asyncio
+async def test_index_uploader_gives_up_after_max_retries():
+    search_client = MockSearchClient(status_codes={"0": [503] * 5})
+    uploader = IndexUploader(search_client, max_retries=2, retry_delay=0)
+    await uploader.add([{"id": "0"}, {"id": "1"}])
+    with pytest.raises(IndexingError):
+        await uploader.flush()
+
+    assert search_client.uploads == [["0", "1"], ["0"], ["0"]]
+    assert uploader.failed_keys == ["0"]
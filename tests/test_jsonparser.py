@@ -1,4 +1,5 @@
 import io
+from concurrent.futures import ProcessPoolExecutor
 
 import pytest
 
@@ -30,3 +31,15 @@ async def test_jsonparser_array_multiple_obj():
     assert pages[1].page_num == 1
     assert pages[1].offset == 19
     assert pages[1].text == '{"test2": "test"}'
+
+
+@pytest.mark.asyncio
+async def test_jsonparser_executor():
+    file = io.StringIO('[{"test1": "test"},{"test2": "test"}]')
+    file.name = "test.json"
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        pages = [page async for page in JsonParser(executor=executor).parse(file)]
+    assert [(page.page_num, page.offset, page.text) for page in pages] == [
+        (0, 1, '{"test1": "test"}'),
+        (1, 19, '{"test2": "test"}'),
+    ]
@@ -1,17 +1,21 @@
+import asyncio
 import hashlib
 import io
 import os
 import tempfile
 
+import azure.storage.filedatalake.aio
 import pytest
+from azure.storage.filedatalake import PathProperties
 
+from prepdocslib.ingestionmanifest import IngestionManifest
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
     File,
     LocalListFileStrategy,
 )
 
-from .mocks import MockAzureCredential
+from .mocks import MockAsyncPageIterator, MockAzureCredential
 
 
 def test_file_filename():
@@ -145,3 +149,169 @@ async def test_read_adls_gen2_files(monkeypatch, mock_data_lake_service_client):
     assert files[1].acls == {"oids": ["B-USER-ID"], "groups": ["B-GROUP-ID"]}
     assert files[2].filename() == "c.txt"
     assert files[2].acls == {"oids": ["C-USER-ID"], "groups": ["C-GROUP-ID"]}
+
+
+@pytest.mark.asyncio
+async def test_locallistfilestrategy_manifest(tmp_path):
+    for filename in ["a.txt", "b.txt"]:
+        (tmp_path / filename).write_text("test")
+    manifest = IngestionManifest(str(tmp_path / "manifest" / "manifest.db"))
+    local_list_strategy = LocalListFileStrategy(path_pattern=f"{tmp_path}/*.txt", manifest=manifest)
+
+    files = [file async for file in local_list_strategy.list()]
+    assert sorted(file.filename() for file in files) == ["a.txt", "b.txt"]
+    for file in files:
+        assert file.manifest_entry.content_hash == hashlib.sha256(b"test").hexdigest()
+        local_list_strategy.record_ingested(file)
+        file.close()
+    # No .md5 files are written next to the files
+    assert sorted(os.listdir(tmp_path)) == ["a.txt", "b.txt", "manifest"]
+
+    # Unchanged files are skipped
+    assert [file async for file in local_list_strategy.list()] == []
+
+    # A file that is touched but keeps the same content is skipped, and its new modification time is recorded
+    os.utime(tmp_path / "a.txt", (0, 0))
+    assert [file async for file in local_list_strategy.list()] == []
+    assert manifest.get(f"{tmp_path}/*.txt", str(tmp_path / "a.txt")).mtime == 0
+
+    (tmp_path / "b.txt").write_text("test2")
+    files = [file async for file in local_list_strategy.list()]
+    assert [file.filename() for file in files] == ["b.txt"]
+    files[0].close()
+
+    os.remove(tmp_path / "a.txt")
+    listed_paths = {path async for path in local_list_strategy.list_paths()}
+    assert local_list_strategy.removed_paths(listed_paths) == {str(tmp_path / "a.txt")}
+    # Other listings don't see the files of this one
+    other_list_strategy = LocalListFileStrategy(path_pattern=f"{tmp_path}/other/*", manifest=manifest)
+    assert other_list_strategy.removed_paths(set()) == set()
+    manifest.close()
+
+
+@pytest.mark.asyncio
+async def test_forget_all_keeps_other_listings(tmp_path):
+    for folder in ["one", "two"]:
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "a.txt").write_text("test")
+    manifest = IngestionManifest(str(tmp_path / "manifest.db"))
+    list_strategies = [
+        LocalListFileStrategy(path_pattern=f"{tmp_path}/{folder}/*.txt", manifest=manifest) for folder in ["one", "two"]
+    ]
+    for list_strategy in list_strategies:
+        async for file in list_strategy.list():
+            list_strategy.record_ingested(file)
+            file.close()
+
+    list_strategies[0].forget_all()
+    assert manifest.paths(f"{tmp_path}/one/*.txt") == []
+    assert manifest.paths(f"{tmp_path}/two/*.txt") == [str(tmp_path / "two" / "a.txt")]
+    # Only the files of the forgotten listing are ingested again
+    files = [file async for file in list_strategies[0].list()]
+    assert [file.filename() for file in files] == ["a.txt"]
+    files[0].close()
+    assert [file async for file in list_strategies[1].list()] == []
+    manifest.close()
+
+
+@pytest.mark.asyncio
+async def test_read_adls_gen2_files_manifest(monkeypatch, mock_data_lake_service_client, tmp_path):
+    etags = {"a.txt": "etag-a", "b.txt": "etag-b", "c.txt": "etag-c"}
+
+    def mock_get_paths(self, *args, **kwargs):
+        return MockAsyncPageIterator(
+            [PathProperties(name=name, etag=etag, content_length=8) for name, etag in etags.items()]
+        )
+
+    monkeypatch.setattr(azure.storage.filedatalake.aio.FileSystemClient, "get_paths", mock_get_paths)
+
+    manifest = IngestionManifest(str(tmp_path / "manifest.db"))
+    adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a",
+        data_lake_filesystem="a",
+        data_lake_path="a",
+        credential=MockAzureCredential(),
+        manifest=manifest,
+    )
+
+    files = [file async for file in adlsgen2_list_strategy.list()]
+    assert len(files) == 3
+    assert files[0].manifest_entry.etag == "etag-a"
+    for file in files:
+        adlsgen2_list_strategy.record_ingested(file)
+        file.close()
+
+    etags["b.txt"] = "etag-b2"
+    files = [file async for file in adlsgen2_list_strategy.list()]
+    assert [file.filename() for file in files] == ["b.txt"]
+    files[0].close()
+    manifest.close()
+
+
+@pytest.mark.asyncio
+async def test_read_adls_gen2_files_prefetch(monkeypatch, mock_data_lake_service_client):
+    sizes = {"small.txt": 8, "dir1/large.txt": 8000, "dir2/large.txt": 8000, "dir3/large.txt": 8000}
+
+    def mock_get_paths(self, *args, **kwargs):
+        return MockAsyncPageIterator([PathProperties(name=name, content_length=size) for name, size in sizes.items()])
+
+    async def mock_get_access_control(self, *args, **kwargs):
+        return {"acl": "user:A-USER-ID:r-x"}
+
+    downloading = []
+    max_downloading = 0
+
+    async def mock_readinto(self, stream):
+        nonlocal max_downloading
+        downloading.append(stream)
+        max_downloading = max(max_downloading, len(downloading))
+        await asyncio.sleep(0.01)
+        downloading.remove(stream)
+        stream.write(b"texttext")
+
+    monkeypatch.setattr(azure.storage.filedatalake.aio.FileSystemClient, "get_paths", mock_get_paths)
+    monkeypatch.setattr(
+        azure.storage.filedatalake.aio.DataLakeFileClient, "get_access_control", mock_get_access_control
+    )
+    monkeypatch.setattr(azure.storage.filedatalake.aio.StorageStreamDownloader, "readinto", mock_readinto)
+
+    adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a",
+        data_lake_filesystem="a",
+        data_lake_path="a",
+        credential=MockAzureCredential(),
+        download_concurrency=4,
+        max_memory_file_bytes=100,
+    )
+    files = [file async for file in adlsgen2_list_strategy.list()]
+    assert max_downloading == 4
+    # Files are yielded in listing order, and files with the same name don't overwrite each other
+    assert [file.url for file in files] == [f"https://test.blob.core.windows.net/{name}" for name in sizes]
+    assert [file.filename() for file in files] == ["small.txt", "large.txt", "large.txt", "large.txt"]
+    assert all(file.content.read() == b"texttext" for file in files)
+    # Small files stay in memory, larger ones are removed from the disk once closed
+    assert files[0].temp_dir is None
+    temp_dirs = [file.temp_dir for file in files[1:]]
+    assert len(set(temp_dirs)) == 3
+    for file in files:
+        file.close()
+    assert not any(os.path.exists(temp_dir) for temp_dir in temp_dirs)
+
+    # The files waiting on the disk take at most max_prefetch_bytes, small files don't count
+    max_downloading = 0
+    adlsgen2_list_strategy.max_prefetch_bytes = 10000
+    async for file in adlsgen2_list_strategy.list():
+        file.close()
+    assert max_downloading == 2
+
+    # Files that were yielded keep their disk space until they are closed
+    adlsgen2_list_strategy.max_prefetch_bytes = 10000
+    files_iterator = adlsgen2_list_strategy.list().__aiter__()
+    assert (await files_iterator.__anext__()).filename() == "small.txt"
+    large_file = await files_iterator.__anext__()
+    next_file = asyncio.create_task(files_iterator.__anext__())
+    await asyncio.sleep(0.05)
+    assert not next_file.done()
+    large_file.close()
+    (await next_file).close()
+    await files_iterator.aclose()
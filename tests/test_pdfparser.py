@@ -1,8 +1,12 @@
+import asyncio
+import gc
 import io
 import json
 import logging
 import math
 import pathlib
+import random
+from concurrent.futures import ProcessPoolExecutor
 from unittest.mock import AsyncMock, MagicMock, Mock
 
 import pymupdf
@@ -22,7 +26,8 @@ from azure.core.exceptions import HttpResponseError
 from PIL import Image, ImageChops
 
 from prepdocslib.mediadescriber import ContentUnderstandingDescriber
-from prepdocslib.pdfparser import DocumentAnalysisParser
+from prepdocslib.parser import split_page_ranges
+from prepdocslib.pdfparser import DocumentAnalysisParser, LocalPdfParser, ObjectType
 
 from .mocks import MockAzureCredential
 
@@ -370,3 +375,201 @@ async def test_parse_unsupportedformat(monkeypatch, caplog):
     assert pages[0].page_num == 0
     assert pages[0].offset == 0
     assert pages[0].text == "Page content"
+
+
+def mask_spans_per_character(page_offset, page_length, tables, figures):
+    mask_chars = [(ObjectType.NONE, -1)] * page_length
+    for object_type, objects in ((ObjectType.TABLE, tables), (ObjectType.FIGURE, figures)):
+        for object_idx, obj in enumerate(objects):
+            for span in obj.spans:
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if idx >= 0 and idx < page_length:
+                        mask_chars[idx] = (object_type, object_idx)
+    return mask_chars
+
+
+def test_mask_spans_matches_per_character_masking():
+    rng = random.Random(0)
+    for _ in range(500):
+        page_offset = rng.randint(0, 50)
+        page_length = rng.randint(0, 80)
+
+        def random_spans():
+            return [
+                DocumentSpan(offset=rng.randint(0, page_offset + page_length + 20), length=rng.randint(0, 30))
+                for _ in range(rng.randint(0, 3))
+            ]
+
+        tables = [DocumentTable(row_count=0, column_count=0, cells=[], spans=random_spans()) for _ in range(3)]
+        figures = [DocumentFigure(id=str(i), spans=random_spans()) for i in range(rng.randint(0, 2))]
+        intervals = DocumentAnalysisParser.mask_spans(page_offset, page_length, tables, figures)
+
+        mask_chars = []
+        for start, end, object_type, object_idx in intervals:
+            mask_chars.extend([(object_type, object_idx)] * (end - start))
+        assert mask_chars == mask_spans_per_character(page_offset, page_length, tables, figures)
+        # Adjacent intervals always belong to different objects
+        assert all(a[2:] != b[2:] for a, b in zip(intervals, intervals[1:]))
+
+
+@pytest.mark.asyncio
+async def test_analyze_result_to_pages_recorded():
+    with open(TEST_DATA_DIR / "Simple Table_analyzeresult.json") as f:
+        analyze_result = AnalyzeResult(json.load(f))
+    parser = DocumentAnalysisParser(
+        endpoint="https://example.com", credential=MockAzureCredential(), use_content_understanding=False
+    )
+    pages = [page async for page in parser.analyze_result_to_pages(analyze_result)]
+
+    assert len(pages) == 1
+    assert (
+        pages[0].text
+        == "# Simple HTML Table\n\n\n<figure><table><tr><th>Header 1</th><th>Header 2</th></tr><tr><td>Cell 1</td><td>Cell 2</td></tr><tr><td>Cell 3</td><td>Cell 4</td></tr></table></figure>"
+    )
+
+
+def analyze_result_with_figures(figure_count: int) -> AnalyzeResult:
+    content = "Intro\n" + "".join(f"<figure>{i}</figure>\ntext {i}\n" for i in range(figure_count))
+    figure_offsets = [content.index(f"<figure>{i}</figure>") for i in range(figure_count)]
+    return AnalyzeResult(
+        content=content,
+        pages=[DocumentPage(page_number=1, spans=[DocumentSpan(offset=0, length=len(content))])],
+        figures=[
+            DocumentFigure(
+                id=f"1.{i}",
+                caption=DocumentCaption(content=f"Figure {i}"),
+                bounding_regions=[
+                    BoundingRegion(
+                        page_number=1, polygon=[0.4295, 1.3072, 1.7071, 1.3076, 1.7067, 2.6088, 0.4291, 2.6085]
+                    )
+                ],
+                spans=[DocumentSpan(offset=figure_offsets[i], length=len(f"<figure>{i}</figure>"))],
+            )
+            for i in range(figure_count)
+        ],
+    )
+
+
+@pytest.mark.asyncio
+async def test_parse_doc_with_figures_concurrently(monkeypatch):
+    mock_poller = MagicMock()
+
+    async def mock_begin_analyze_document(self, model_id, analyze_request, **kwargs):
+        return mock_poller
+
+    async def mock_poller_result():
+        return analyze_result_with_figures(5)
+
+    monkeypatch.setattr(DocumentIntelligenceClient, "begin_analyze_document", mock_begin_analyze_document)
+    monkeypatch.setattr(mock_poller, "result", mock_poller_result)
+
+    running = 0
+    max_running = 0
+    calls = 0
+
+    async def mock_describe_image(self, image_bytes):
+        nonlocal running, max_running, calls
+        running += 1
+        max_running = max(max_running, running)
+        call = calls
+        calls += 1
+        # Later figures finish first, their descriptions must still be spliced in order
+        await asyncio.sleep(0.01 * (5 - call))
+        running -= 1
+        return f"Description {call}"
+
+    monkeypatch.setattr(ContentUnderstandingDescriber, "describe_image", mock_describe_image)
+
+    parser = DocumentAnalysisParser(
+        endpoint="https://example.com",
+        credential=MockAzureCredential(),
+        use_content_understanding=True,
+        content_understanding_endpoint="https://example.com",
+        figure_concurrency=2,
+    )
+
+    with open(TEST_DATA_DIR / "Simple Figure.pdf", "rb") as f:
+        content_io = io.BytesIO(f.read())
+        content_io.name = "Simple Figure.pdf"
+
+    pages = [page async for page in parser.parse(content_io)]
+
+    assert max_running == 2
+    assert pages[0].text == "Intro\n" + "\n".join(
+        f"<figure><figcaption>Figure {i}<br>Description {i}</figcaption></figure>\ntext {i}" for i in range(5)
+    )
+
+
+@pytest.mark.asyncio
+async def test_parse_doc_with_failing_figures(monkeypatch):
+    mock_poller = MagicMock()
+
+    async def mock_begin_analyze_document(self, model_id, analyze_request, **kwargs):
+        return mock_poller
+
+    async def mock_poller_result():
+        return analyze_result_with_figures(3)
+
+    monkeypatch.setattr(DocumentIntelligenceClient, "begin_analyze_document", mock_begin_analyze_document)
+    monkeypatch.setattr(mock_poller, "result", mock_poller_result)
+
+    calls = 0
+
+    async def mock_describe_image(self, image_bytes):
+        nonlocal calls
+        call = calls
+        calls += 1
+        if call == 0:
+            raise ValueError("Figure 0 failed")
+        # The other figures are still being described, and fail once they are cancelled
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            raise ValueError(f"Figure {call} failed")
+        return f"Description {call}"
+
+    monkeypatch.setattr(ContentUnderstandingDescriber, "describe_image", mock_describe_image)
+
+    parser = DocumentAnalysisParser(
+        endpoint="https://example.com",
+        credential=MockAzureCredential(),
+        use_content_understanding=True,
+        content_understanding_endpoint="https://example.com",
+    )
+
+    with open(TEST_DATA_DIR / "Simple Figure.pdf", "rb") as f:
+        content_io = io.BytesIO(f.read())
+        content_io.name = "Simple Figure.pdf"
+
+    loop_errors = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: loop_errors.append(context))
+    with pytest.raises(ValueError, match="Figure 0 failed"):
+        [page async for page in parser.parse(content_io)]
+    await asyncio.sleep(0.01)
+    gc.collect()
+
+    # The errors of the other figures are retrieved, instead of being reported as never retrieved
+    assert calls == 3
+    assert loop_errors == []
+
+
+@pytest.mark.asyncio
+async def test_local_pdf_parser_executor():
+    with open(TEST_DATA_DIR / "en_An Occurrence at Owl Creek Bridge.pdf", "rb") as f:
+        pages = [page async for page in LocalPdfParser().parse(f)]
+        f.seek(0)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            executor_pages = [page async for page in LocalPdfParser(executor=executor, executor_workers=2).parse(f)]
+
+    assert len(pages) > 1
+    assert [(page.page_num, page.offset, page.text) for page in executor_pages] == [
+        (page.page_num, page.offset, page.text) for page in pages
+    ]
+
+
+def test_split_page_ranges():
+    assert split_page_ranges(10, 4) == [range(0, 3), range(3, 6), range(6, 9), range(9, 10)]
+    assert split_page_ranges(3, 8) == [range(0, 1), range(1, 2), range(2, 3)]
+    assert split_page_ranges(5, 1) == [range(0, 5)]
+    assert split_page_ranges(0, 4) == []
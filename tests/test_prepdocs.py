@@ -1,5 +1,7 @@
+import asyncio
 import logging
 
+import aiohttp
 import openai
 import openai.types
 import pytest
@@ -9,6 +11,8 @@ from openai.types.create_embedding_response import Usage
 
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
+    EmbeddingRateLimiter,
+    ImageEmbeddings,
     OpenAIEmbeddingService,
 )
 
@@ -216,3 +220,214 @@ async def test_compute_embedding_autherror(monkeypatch, capsys):
         )
         monkeypatch.setattr(embeddings, "create_client", create_auth_error_limit_client)
         await embeddings.create_embeddings(texts=["foo"])
+
+
+class MockRawEmbeddingResponse:
+    def __init__(self, texts: list[str], headers: dict[str, str]):
+        self.texts = texts
+        self.headers = headers
+
+    def parse(self) -> openai.types.CreateEmbeddingResponse:
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[
+                openai.types.Embedding(embedding=[float(text)], index=index, object="embedding")
+                for index, text in enumerate(self.texts)
+            ],
+            model="text-embedding-3-large",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+class ConcurrentMockEmbeddingsClient:
+    def __init__(self):
+        self.with_raw_response = self
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+
+    async def create(self, *args, **kwargs) -> MockRawEmbeddingResponse:
+        self.calls += 1
+        call = self.calls
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # Let later batches finish first, to check that the results keep the input order
+        await asyncio.sleep(0.01 if call == 1 else 0)
+        self.in_flight -= 1
+        if call == 2:
+            raise openai.RateLimitError(
+                message="Rate limited on the OpenAI embeddings API",
+                response=Response(
+                    429, headers={"retry-after-ms": "10"}, request=Request(method="get", url="https://foo.bar/")
+                ),
+                body=None,
+            )
+        return MockRawEmbeddingResponse(
+            kwargs["input"],
+            headers={
+                "x-ratelimit-limit-tokens": "120000",
+                "x-ratelimit-remaining-tokens": "119000",
+                "x-ratelimit-remaining-requests": "700",
+            },
+        )
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_concurrent_batches(monkeypatch, caplog):
+    client = ConcurrentMockEmbeddingsClient()
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=client)
+
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        open_ai_api_version="test-api-version",
+        credential=MockAzureCredential(),
+        batch_concurrency=3,
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    texts = [str(number) for number in range(50)]
+    with caplog.at_level(logging.INFO):
+        assert await embeddings.create_embeddings(texts=texts) == [[float(text)] for text in texts]
+    assert caplog.text.count("Rate limited on the OpenAI embeddings API") == 1
+    assert client.max_in_flight == 3
+    assert embeddings.rate_limiter is not None
+    assert embeddings.rate_limiter.tokens.capacity == 120000
+    assert embeddings.rate_limiter.requests.capacity == 700
+
+
+@pytest.mark.asyncio
+async def test_embedding_rate_limiter(monkeypatch):
+    sleeps = []
+
+    async def mock_sleep(delay):
+        sleeps.append(delay)
+        rate_limiter.tokens.available = rate_limiter.tokens.capacity
+
+    monkeypatch.setattr(asyncio, "sleep", mock_sleep)
+    rate_limiter = EmbeddingRateLimiter()
+    # Nothing is held back until the limits are known
+    await rate_limiter.acquire(1000000)
+    assert sleeps == []
+
+    rate_limiter.update({"x-ratelimit-limit-tokens": "6000", "x-ratelimit-remaining-tokens": "100"})
+    await rate_limiter.acquire(50)
+    assert sleeps == []
+    await rate_limiter.acquire(150)
+    # 100 tokens are missing, and the bucket refills at 100 tokens per second
+    assert len(sleeps) == 1
+    assert sleeps[0] == pytest.approx(1, abs=0.01)
+
+
+def test_split_text_into_batches_reuses_token_counts(monkeypatch):
+    encoded_batches = []
+
+    class MockEncoding:
+        def encode(self, text):
+            return text.split()
+
+        def encode_batch(self, texts):
+            encoded_batches.append(texts)
+            return [text.split() for text in texts]
+
+    monkeypatch.setattr("prepdocslib.embeddings.get_encoding", lambda model_name: MockEncoding())
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+    )
+    batches = embeddings.split_text_into_batches(["one two", "three", "four five six"], [4000, None, 5000])
+    # Only the text without a known token count is encoded
+    assert encoded_batches == [["three"]]
+    assert [batch.texts for batch in batches] == [["one two", "three"], ["four five six"]]
+    assert [batch.token_length for batch in batches] == [4001, 5000]
+
+
+class MockVisionResponse:
+    def __init__(self, status: int, vector: list[float], headers: dict[str, str]):
+        self.status = status
+        self.vector = vector
+        self.headers = headers
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return None
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status)  # type: ignore
+
+    async def json(self):
+        return {"vector": self.vector}
+
+
+@pytest.mark.asyncio
+async def test_image_embeddings_concurrent(monkeypatch):
+    running = 0
+    max_running = 0
+    requests = []
+    sessions = set()
+
+    class MockPost:
+        def __init__(self, url: str):
+            self.url = url
+
+        async def __aenter__(self):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            requests.append(self.url)
+            # The first request for page 2 is rate limited
+            if self.url == "page2" and requests.count("page2") == 1:
+                return MockVisionResponse(429, [], {"retry-after": "0"})
+            return MockVisionResponse(200, [float(self.url[-1])], {})
+
+        async def __aexit__(self, exc_type, exc, tb):
+            return None
+
+    def mock_post(session, url, params, headers, json):
+        sessions.add(id(session))
+        return MockPost(json["url"])
+
+    async def mock_token_provider():
+        return "token"
+
+    monkeypatch.setattr(aiohttp.ClientSession, "post", mock_post)
+    image_embeddings = ImageEmbeddings("https://vision.example.com", mock_token_provider, concurrency=2)
+    urls = [f"page{page}" for page in range(1, 6)]
+    assert await image_embeddings.create_embeddings(urls) == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+    assert await image_embeddings.create_embeddings(urls[:1]) == [[1.0]]
+    await image_embeddings.close()
+
+    assert max_running == 2
+    assert sorted(requests) == sorted(urls + ["page2", "page1"])
+    # All the requests went through the same session
+    assert len(sessions) == 1
+
+
+@pytest.mark.asyncio
+async def test_image_embeddings_client_error(monkeypatch):
+    attempts = 0
+
+    def mock_post(session, url, params, headers, json):
+        nonlocal attempts
+        attempts += 1
+        return MockVisionResponse(400, [], {})
+
+    async def mock_token_provider():
+        return "token"
+
+    monkeypatch.setattr(aiohttp.ClientSession, "post", mock_post)
+    image_embeddings = ImageEmbeddings("https://vision.example.com", mock_token_provider)
+    with pytest.raises(aiohttp.ClientResponseError):
+        await image_embeddings.create_embeddings(["page1"])
+    await image_embeddings.close()
+    # Errors that can't succeed when sent again are not retried
+    assert attempts == 1
@@ -2,18 +2,24 @@ import os
 
 import pytest
 from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import IndexingResult
 
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.fileprocessor import FileProcessor
 from prepdocslib.filestrategy import FileStrategy
+from prepdocslib.indexuploader import IndexingError
+from prepdocslib.ingestionmanifest import IngestionManifest
+from prepdocslib.ingestionpipeline import PipelineConfig, PipelineStage, run_pipeline
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
+    LocalListFileStrategy,
 )
+from prepdocslib.searchmanager import SearchManager
 from prepdocslib.strategy import SearchInfo
 from prepdocslib.textparser import TextParser
 from prepdocslib.textsplitter import SimpleTextSplitter
 
-from .mocks import MockAzureCredential
+from .mocks import MockAsyncPageIterator, MockAzureCredential
 
 
 @pytest.mark.asyncio
@@ -101,3 +107,254 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "storageUrl": "https://test.blob.core.windows.net/c.txt",
         },
     ]
+
+
+@pytest.mark.asyncio
+async def test_file_strategy_adls2_pipeline(monkeypatch, mock_env, mock_data_lake_service_client):
+    adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a", data_lake_filesystem="a", data_lake_path="a", credential=MockAzureCredential()
+    )
+    blob_manager = BlobManager(
+        endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        container=os.environ["AZURE_STORAGE_CONTAINER"],
+        account=os.environ["AZURE_STORAGE_ACCOUNT"],
+        resourceGroup=os.environ["AZURE_STORAGE_RESOURCE_GROUP"],
+        subscriptionId=os.environ["AZURE_SUBSCRIPTION_ID"],
+        store_page_images=False,
+    )
+
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+
+    async def mock_upload_blob(self, name, *args, **kwargs):
+        pass
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+
+    uploaded_to_search = []
+
+    async def mock_upload_documents(self, documents):
+        uploaded_to_search.extend(documents)
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    file_strategy = FileStrategy(
+        list_file_strategy=adlsgen2_list_strategy,
+        blob_manager=blob_manager,
+        search_info=SearchInfo(
+            endpoint="https://testsearchclient.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            index_name="test",
+        ),
+        file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter())},
+        use_acls=True,
+        pipeline_config=PipelineConfig.from_spec("parse=2,blob=2:1,embed=1,index=2"),
+    )
+
+    await file_strategy.run()
+
+    assert sorted(document["sourcefile"] for document in uploaded_to_search) == ["a.txt", "b.txt", "c.txt"]
+    assert all(document["content"] == "texttext" for document in uploaded_to_search)
+
+
+@pytest.mark.asyncio
+async def test_run_pipeline_propagates_errors():
+    async def source():
+        for i in range(10):
+            yield i
+
+    async def double(item):
+        return item * 2
+
+    async def fail_on_six(item):
+        if item == 6:
+            raise ValueError("bad item")
+
+    with pytest.raises(ValueError, match="bad item"):
+        await run_pipeline(source(), [(PipelineStage(2, 1), double), (PipelineStage(1, 1), fail_on_six)])
+
+
+def test_pipeline_config_from_spec():
+    config = PipelineConfig.from_spec("parse=8, embed=3:5")
+    assert config.parse == PipelineStage(workers=8, queue_size=16)
+    assert config.embed == PipelineStage(workers=3, queue_size=5)
+    assert config.index == PipelineConfig().index
+    assert PipelineConfig.from_spec("") == PipelineConfig()
+    with pytest.raises(ValueError):
+        PipelineConfig.from_spec("unknown=2")
+    with pytest.raises(ValueError):
+        PipelineConfig.from_spec("parse=0")
+    with pytest.raises(ValueError):
+        PipelineConfig.from_spec("parse=two")
+
+
+@pytest.mark.asyncio
+async def test_file_strategy_manifest_removes_deleted_files(monkeypatch, mock_env, tmp_path):
+    for filename in ["a.txt", "b.txt"]:
+        (tmp_path / filename).write_text("text")
+    manifest = IngestionManifest(str(tmp_path / "manifest.db"))
+    list_strategy = LocalListFileStrategy(path_pattern=f"{tmp_path}/*.txt", manifest=manifest)
+    blob_manager = BlobManager(
+        endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        container=os.environ["AZURE_STORAGE_CONTAINER"],
+        account=os.environ["AZURE_STORAGE_ACCOUNT"],
+        resourceGroup=os.environ["AZURE_STORAGE_RESOURCE_GROUP"],
+        subscriptionId=os.environ["AZURE_SUBSCRIPTION_ID"],
+        store_page_images=False,
+    )
+
+    async def mock_upload_blob(self, file):
+        return None
+
+    removed_blobs = []
+
+    async def mock_remove_blob(self, path=None):
+        removed_blobs.append(path)
+
+    monkeypatch.setattr(BlobManager, "upload_blob", mock_upload_blob)
+    monkeypatch.setattr(BlobManager, "remove_blob", mock_remove_blob)
+
+    uploaded_to_search = []
+
+    async def mock_upload_documents(self, documents):
+        uploaded_to_search.extend(documents)
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    removed_content = []
+
+    async def mock_remove_content(self, path=None, only_oid=None):
+        removed_content.append(path)
+
+    monkeypatch.setattr(SearchManager, "remove_content", mock_remove_content)
+
+    file_strategy = FileStrategy(
+        list_file_strategy=list_strategy,
+        blob_manager=blob_manager,
+        search_info=SearchInfo(
+            endpoint="https://testsearchclient.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            index_name="test",
+        ),
+        file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter())},
+    )
+
+    await file_strategy.run()
+    assert sorted(document["sourcefile"] for document in uploaded_to_search) == ["a.txt", "b.txt"]
+
+    # Unchanged files are skipped, and deleted files are removed from the blob storage and the index
+    uploaded_to_search.clear()
+    os.remove(tmp_path / "a.txt")
+    await file_strategy.run()
+    assert uploaded_to_search == []
+    assert removed_blobs == [str(tmp_path / "a.txt")]
+    assert removed_content == [str(tmp_path / "a.txt")]
+    assert manifest.paths(f"{tmp_path}/*.txt") == [str(tmp_path / "b.txt")]
+    manifest.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("pipeline_config", [None, PipelineConfig()])
+async def test_file_strategy_removes_chunks_of_emptied_file(monkeypatch, mock_env, tmp_path, pipeline_config):
+    (tmp_path / "a.txt").write_text("")
+    manifest = IngestionManifest(str(tmp_path / "manifest.db"))
+    list_strategy = LocalListFileStrategy(path_pattern=f"{tmp_path}/*.txt", manifest=manifest)
+
+    async def mock_search(self, *args, **kwargs):
+        return MockAsyncPageIterator(
+            data=[{"id": "file-a_txt-612E747874-stale1"}, {"id": "file-a_txt-612E747874-stale2"}]
+        )
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    removed_ids = []
+
+    async def mock_delete_documents(self, documents):
+        removed_ids.extend(document["id"] for document in documents)
+        return documents
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    file_strategy = FileStrategy(
+        list_file_strategy=list_strategy,
+        blob_manager=BlobManager(
+            endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            container=os.environ["AZURE_STORAGE_CONTAINER"],
+            account=os.environ["AZURE_STORAGE_ACCOUNT"],
+            resourceGroup=os.environ["AZURE_STORAGE_RESOURCE_GROUP"],
+            subscriptionId=os.environ["AZURE_SUBSCRIPTION_ID"],
+            store_page_images=False,
+        ),
+        search_info=SearchInfo(
+            endpoint="https://testsearchclient.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            index_name="test",
+        ),
+        file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter())},
+        pipeline_config=pipeline_config,
+        use_content_hash_ids=True,
+    )
+    await file_strategy.run()
+
+    # The file no longer has any sections, so all the chunks of its previous version are removed
+    assert sorted(removed_ids) == ["file-a_txt-612E747874-stale1", "file-a_txt-612E747874-stale2"]
+    assert manifest.paths(f"{tmp_path}/*.txt") == [str(tmp_path / "a.txt")]
+    manifest.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("pipeline_config", [None, PipelineConfig()])
+async def test_file_strategy_does_not_record_file_that_failed_to_index(
+    monkeypatch, mock_env, tmp_path, pipeline_config
+):
+    (tmp_path / "a.txt").write_text("text")
+    manifest = IngestionManifest(str(tmp_path / "manifest.db"))
+    list_strategy = LocalListFileStrategy(path_pattern=f"{tmp_path}/*.txt", manifest=manifest)
+
+    async def mock_upload_blob(self, file):
+        return None
+
+    monkeypatch.setattr(BlobManager, "upload_blob", mock_upload_blob)
+
+    async def mock_upload_documents(self, documents):
+        results = []
+        for document in documents:
+            result = IndexingResult()
+            result.key = document["id"]
+            result.status_code = 400
+            result.succeeded = False
+            results.append(result)
+        return results
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    file_strategy = FileStrategy(
+        list_file_strategy=list_strategy,
+        blob_manager=BlobManager(
+            endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            container=os.environ["AZURE_STORAGE_CONTAINER"],
+            account=os.environ["AZURE_STORAGE_ACCOUNT"],
+            resourceGroup=os.environ["AZURE_STORAGE_RESOURCE_GROUP"],
+            subscriptionId=os.environ["AZURE_SUBSCRIPTION_ID"],
+            store_page_images=False,
+        ),
+        search_info=SearchInfo(
+            endpoint="https://testsearchclient.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            index_name="test",
+        ),
+        file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter())},
+        pipeline_config=pipeline_config,
+    )
+    with pytest.raises(IndexingError):
+        await file_strategy.run()
+
+    # The file is ingested again by the next run
+    assert manifest.paths(f"{tmp_path}/*.txt") == []
+    manifest.close()
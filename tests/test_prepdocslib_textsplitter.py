@@ -1,4 +1,5 @@
 import json
+import random
 import shutil
 from pathlib import Path
 
@@ -11,6 +12,7 @@ from prepdocslib.pdfparser import LocalPdfParser
 from prepdocslib.searchmanager import Section
 from prepdocslib.textsplitter import (
     ENCODING_MODEL,
+    IndexedSentenceTextSplitter,
     SentenceTextSplitter,
     SimpleTextSplitter,
 )
@@ -29,6 +31,7 @@ def test_sentencetextsplitter_split_small_pages():
     assert len(split_pages) == 1
     assert split_pages[0].page_num == 0
     assert split_pages[0].text == "Not a large page"
+    assert split_pages[0].token_count == len(tiktoken.encoding_for_model(ENCODING_MODEL).encode("Not a large page"))
 
 
 @pytest.mark.asyncio
@@ -122,8 +125,10 @@ async def test_sentencetextsplitter_multilang(test_doc, tmp_path):
         for section in sections:
             assert section.split_page.text != ""
             assert len(section.split_page.text) <= (text_splitter.max_section_length * 1.2)
-            # Verify the number of tokens is below 500
-            token_lengths.append((len(bpe.encode(section.split_page.text)), len(section.split_page.text)))
+            # Verify the number of tokens is below 500, and that the splitter counted them
+            token_length = len(bpe.encode(section.split_page.text))
+            assert section.split_page.token_count == token_length
+            token_lengths.append((token_length, len(section.split_page.text)))
         # verify that none of the numbers in token_lengths are above 500
         assert all([tok_len <= text_splitter.max_tokens_per_section for tok_len, _ in token_lengths]), (
             test_doc.name,
@@ -186,3 +191,89 @@ def test_pages_with_figures(snapshot):
     split_pages_dicts = [{"text": split_page.text, "page_num": split_page.page_num} for split_page in split_pages]
     split_pages_json = json.dumps(split_pages_dicts, indent=2)
     snapshot.assert_match(split_pages_json, "split_pages_with_figures.json")
+
+
+def split_pages_as_tuples(splitter, pages):
+    return [
+        (split_page.page_num, split_page.text, split_page.token_count) for split_page in splitter.split_pages(pages)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_indexed_sentencetextsplitter_matches_pdfs(test_doc):
+    with open(test_doc, "rb") as f:
+        pages = [page async for page in LocalPdfParser().parse(content=f)]
+    assert split_pages_as_tuples(IndexedSentenceTextSplitter(), pages) == split_pages_as_tuples(
+        SentenceTextSplitter(), pages
+    )
+
+
+def test_indexed_sentencetextsplitter_matches_figures():
+    file_path = Path(__file__).parent / "test-data" / "pages_with_figures.json"
+    with open(file_path) as f:
+        pages = [Page(page_num=page["page_num"], offset=page["offset"], text=page["text"]) for page in json.load(f)]
+    assert split_pages_as_tuples(IndexedSentenceTextSplitter(), pages) == split_pages_as_tuples(
+        SentenceTextSplitter(), pages
+    )
+
+
+@pytest.mark.parametrize("max_tokens_per_section", [20, 500])
+def test_indexed_sentencetextsplitter_matches_random_text(max_tokens_per_section):
+    # Random text with few sentence endings and word breaks exercises every fallback of the splitter
+    rng = random.Random(max_tokens_per_section)
+    alphabet = list("abcdefgh ") * 5 + list(".!?,;:()\n\t。，、漢字")
+    current = SentenceTextSplitter(max_tokens_per_section=max_tokens_per_section)
+    indexed = IndexedSentenceTextSplitter(max_tokens_per_section=max_tokens_per_section)
+    for _ in range(30):
+        pages = []
+        offset = 0
+        for page_num in range(rng.randint(1, 4)):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.choice([0, 50, 900, 3000])))
+            pages.append(Page(page_num=page_num, offset=offset, text=text))
+            offset += len(text)
+        assert split_pages_as_tuples(indexed, pages) == split_pages_as_tuples(current, pages)
+
+
+async def stream_pages(pages):
+    for page in pages:
+        yield page
+
+
+async def split_pages_stream_as_tuples(splitter, pages):
+    return [
+        (split_page.page_num, split_page.text, split_page.token_count)
+        async for split_page in splitter.split_pages_stream(stream_pages(pages))
+    ]
+
+
+@pytest.mark.asyncio
+async def test_indexed_sentencetextsplitter_stream_matches_figures():
+    file_path = Path(__file__).parent / "test-data" / "pages_with_figures.json"
+    with open(file_path) as f:
+        pages = [Page(page_num=page["page_num"], offset=page["offset"], text=page["text"]) for page in json.load(f)]
+    assert await split_pages_stream_as_tuples(IndexedSentenceTextSplitter(), pages) == split_pages_as_tuples(
+        SentenceTextSplitter(), pages
+    )
+
+
+@pytest.mark.asyncio
+async def test_indexed_sentencetextsplitter_stream_matches_random_text():
+    rng = random.Random(7)
+    alphabet = list("abcdefgh ") * 5 + list(".!?,;:()\n\t。，、漢字")
+    current = SentenceTextSplitter(max_tokens_per_section=50)
+    indexed = IndexedSentenceTextSplitter(max_tokens_per_section=50)
+    for _ in range(20):
+        pages = []
+        offset = 0
+        for page_num in range(rng.randint(1, 6)):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.choice([0, 50, 900, 3000])))
+            pages.append(Page(page_num=page_num, offset=offset, text=text))
+            offset += len(text)
+        assert await split_pages_stream_as_tuples(indexed, pages) == split_pages_as_tuples(current, pages)
+
+
+@pytest.mark.asyncio
+async def test_simpletextsplitter_split_pages_stream():
+    pages = [Page(page_num=0, offset=0, text="a" * 150), Page(page_num=1, offset=150, text="b" * 30)]
+    splitter = SimpleTextSplitter(max_object_length=100)
+    assert await split_pages_stream_as_tuples(splitter, pages) == split_pages_as_tuples(splitter, pages)
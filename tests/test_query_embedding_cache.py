@@ -0,0 +1,183 @@
+import asyncio
+import logging
+
+import openai.types
+import pytest
+from openai.types.create_embedding_response import Usage
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.promptmanager import PromptyManager
+from core.embeddingcache import InMemoryEmbeddingCacheBackend, QueryEmbeddingCache
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = MockClock()
+    monkeypatch.setattr("core.ttlcache.time.monotonic", clock)
+    return clock
+
+
+def make_compute(calls: list[str], query: str):
+    async def compute():
+        calls.append(query)
+        await asyncio.sleep(0)
+        return [float(len(calls))]
+
+    return compute
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_lru(clock):
+    cache = QueryEmbeddingCache(max_size=2, ttl=60)
+    calls: list[str] = []
+    assert await cache.get_or_compute("model", 3, "a", make_compute(calls, "a")) == [1.0]
+    assert await cache.get_or_compute("model", 3, "b", make_compute(calls, "b")) == [2.0]
+    # The query is normalized, so extra whitespace still hits the cache
+    assert await cache.get_or_compute("model", 3, "  a ", make_compute(calls, "a")) == [1.0]
+    # "b" is the least recently used query, so it is evicted
+    assert await cache.get_or_compute("model", 3, "c", make_compute(calls, "c")) == [3.0]
+    assert await cache.get_or_compute("model", 3, "b", make_compute(calls, "b")) == [4.0]
+    # The model and the dimensions are part of the key
+    assert await cache.get_or_compute("model", 2, "b", make_compute(calls, "b")) == [5.0]
+    assert calls == ["a", "b", "c", "b", "b"]
+    assert cache.stats() == {"size": 2, "hits": 1, "shared_hits": 0, "coalesced": 0, "misses": 5}
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_ttl(clock):
+    cache = QueryEmbeddingCache(max_size=10, ttl=60)
+    calls: list[str] = []
+    assert await cache.get_or_compute("model", 3, "a", make_compute(calls, "a")) == [1.0]
+    clock.now = 59
+    assert await cache.get_or_compute("model", 3, "a", make_compute(calls, "a")) == [1.0]
+    clock.now = 60
+    assert await cache.get_or_compute("model", 3, "a", make_compute(calls, "a")) == [2.0]
+    assert calls == ["a", "a"]
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_coalescing(clock):
+    cache = QueryEmbeddingCache()
+    calls: list[str] = []
+    results = await asyncio.gather(*(cache.get_or_compute("model", 3, "a", make_compute(calls, "a")) for _ in range(5)))
+    assert results == [[1.0]] * 5
+    assert calls == ["a"]
+    assert cache.stats()["coalesced"] == 4
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("Embeddings API is down")
+
+    results = await asyncio.gather(
+        cache.get_or_compute("model", 3, "b", fail),
+        cache.get_or_compute("model", 3, "b", fail),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+    # Failures are not cached
+    assert await cache.get_or_compute("model", 3, "b", make_compute(calls, "b")) == [2.0]
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_leader_cancelled():
+    cache = QueryEmbeddingCache()
+    started = asyncio.Event()
+
+    async def compute():
+        started.set()
+        await asyncio.sleep(0.01)
+        return [1.0]
+
+    leader = asyncio.create_task(cache.get_or_compute("model", 3, "a", compute))
+    await started.wait()
+    follower = asyncio.create_task(cache.get_or_compute("model", 3, "a", compute))
+    await asyncio.sleep(0)
+    # The request that started the call is cancelled, e.g. when its client disconnects
+    leader.cancel()
+
+    assert await follower == [1.0]
+    assert leader.cancelled()
+    assert cache.stats()["coalesced"] == 1
+    assert cache.in_flight == {}
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_logs_stats(clock, caplog):
+    cache = QueryEmbeddingCache(stats_log_interval=2)
+    calls: list[str] = []
+    with caplog.at_level(logging.INFO):
+        await cache.get_or_compute(MOCK_EMBEDDING_MODEL_NAME, MOCK_EMBEDDING_DIMENSIONS, "q", make_compute(calls, "q"))
+        assert "Query embedding cache" not in caplog.text
+        await cache.get_or_compute(MOCK_EMBEDDING_MODEL_NAME, MOCK_EMBEDDING_DIMENSIONS, "q", make_compute(calls, "q"))
+    assert "Query embedding cache: 0 hits, 0 shared hits, 0 coalesced, 1 misses, 1 entries" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache_shared_backend(clock):
+    backend = InMemoryEmbeddingCacheBackend()
+    worker1 = QueryEmbeddingCache(backend=backend)
+    worker2 = QueryEmbeddingCache(backend=backend)
+    calls: list[str] = []
+    assert await worker1.get_or_compute("model", 3, "a", make_compute(calls, "a")) == [1.0]
+    assert await worker2.get_or_compute("model", 3, "a", make_compute(calls, "a")) == [1.0]
+    assert calls == ["a"]
+    assert worker2.stats()["shared_hits"] == 1
+
+
+class MockEmbeddingsClient:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.calls += 1
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[openai.types.Embedding(embedding=[0.1, 0.2, 0.3], index=0, object="embedding")],
+            model=MOCK_EMBEDDING_MODEL_NAME,
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+class MockOpenAIClient:
+    def __init__(self):
+        self.embeddings = MockEmbeddingsClient()
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_uses_cache():
+    openai_client = MockOpenAIClient()
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=None,
+        search_index_name=None,
+        agent_model=None,
+        agent_deployment=None,
+        agent_client=None,
+        auth_helper=None,
+        openai_client=openai_client,
+        chatgpt_model="gpt-4.1",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        embedding_field="embedding3",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        prompt_manager=PromptyManager(),
+        query_embedding_cache=QueryEmbeddingCache(),
+    )
+    first = await chat_approach.compute_text_embedding("What is the deductible?")
+    second = await chat_approach.compute_text_embedding("What is the  deductible?")
+    assert first.vector == second.vector == [0.1, 0.2, 0.3]
+    assert openai_client.embeddings.calls == 1
@@ -15,7 +15,7 @@ from openai.types.create_embedding_response import Usage
 
 from prepdocslib.embeddings import AzureOpenAIEmbeddingService
 from prepdocslib.listfilestrategy import File
-from prepdocslib.searchmanager import SearchManager, Section
+from prepdocslib.searchmanager import SearchManager, Section, batch_sections
 from prepdocslib.strategy import SearchInfo
 from prepdocslib.textsplitter import SplitPage
 
@@ -244,6 +244,37 @@ async def test_update_content_many(monkeypatch, search_info):
     assert len(set(ids)) == 1500, "Document ids are not unique"
 
 
+@pytest.mark.asyncio
+async def test_update_content_streamed_batches(monkeypatch, search_info):
+    ids = []
+
+    async def mock_upload_documents(self, documents):
+        ids.extend([doc["id"] for doc in documents])
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manager = SearchManager(search_info)
+
+    test_io = io.BytesIO(b"test page")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+
+    async def sections():
+        for page_num in range(2500):
+            yield Section(split_page=SplitPage(page_num=page_num, text="test section"), content=file)
+
+    section_offset = 0
+    batch_sizes = []
+    async for batch in batch_sections(sections()):
+        batch_sizes.append(len(batch))
+        await manager.update_content(batch, section_offset=section_offset)
+        section_offset += len(batch)
+
+    assert batch_sizes == [1000, 1000, 500]
+    assert len(set(ids)) == 2500, "Document ids are not unique"
+    assert ids[-1] == "file-foo_pdf-666F6F2E706466-page-2499"
+
+
 @pytest.mark.asyncio
 async def test_update_content_with_embeddings(monkeypatch, search_info):
     async def mock_create_client(*args, **kwargs):
@@ -368,7 +399,7 @@ async def test_remove_content(monkeypatch, search_info):
 
     await manager.remove_content("foo's bar.pdf")
 
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert len(searched_filters) == 1, "It should have searched once, since all the keys fit in one search"
     assert searched_filters[0] == "sourcefile eq 'foo''s bar.pdf'"
     assert len(deleted_documents) == 1, "It should have deleted one document"
     assert deleted_documents[0]["id"] == "file-foo_pdf-666F6F2E706466-page-0"
@@ -452,7 +483,7 @@ async def test_remove_content_only_oid(monkeypatch, search_info):
     manager = SearchManager(search_info)
     await manager.remove_content("foo.pdf", only_oid="A-USER-ID")
 
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert len(searched_filters) == 1, "It should have searched once, since all the keys fit in one search"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 1, "It should have deleted one document"
     assert deleted_documents[0]["id"] == "file-foo_pdf-222"
@@ -496,3 +527,158 @@ async def test_remove_content_no_inf_loop(monkeypatch, search_info):
     assert len(searched_filters) == 1, "It should have searched once"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 0, "It should have deleted no documents"
+
+
+@pytest.mark.asyncio
+async def test_remove_content_many(monkeypatch, search_info):
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        return AsyncSearchResultsIterator([{"id": f"file-foo_pdf-page-{i}"} for i in range(2500)])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    delete_calls = []
+
+    async def mock_delete_documents(self, documents):
+        delete_calls.append(documents)
+        return documents
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manager = SearchManager(search_info)
+    await manager.remove_content()
+
+    assert len(searches) == 1
+    assert searches[0]["filter"] is None
+    assert searches[0]["select"] == ["id"]
+    assert [len(documents) for documents in delete_calls] == [1000, 1000, 500]
+    assert len({document["id"] for documents in delete_calls for document in documents}) == 2500
+
+
+@pytest.mark.asyncio
+async def test_remove_content_past_search_limit(monkeypatch, search_info):
+    monkeypatch.setattr("prepdocslib.searchmanager.MAX_REMOVE_SEARCH_RESULTS", 3)
+    # Deleted sections can still be returned by the next search, until the index catches up
+    pages = [["page-0", "page-1", "page-2"], ["page-1", "page-2", "page-3"], ["page-3"]]
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        return AsyncSearchResultsIterator([{"id": id} for id in pages[len(searches) - 1]])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    deleted_ids = []
+
+    async def mock_delete_documents(self, documents):
+        deleted_ids.extend(document["id"] for document in documents)
+        return documents
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manager = SearchManager(search_info)
+    await manager.remove_content("foo.pdf")
+
+    assert len(searches) == 3
+    assert sorted(deleted_ids) == ["page-0", "page-1", "page-2", "page-3"]
+
+
+@pytest.mark.asyncio
+async def test_update_content_content_hash_ids(monkeypatch, search_info):
+    uploaded = []
+
+    async def mock_upload_documents(self, documents):
+        uploaded.extend(documents)
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manager = SearchManager(search_info, use_content_hash_ids=True)
+
+    test_io = io.BytesIO(b"test page")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+
+    def sections(texts):
+        return [Section(split_page=SplitPage(page_num=0, text=text), content=file) for text in texts]
+
+    await manager.update_content(sections(["first", "second", "third", "second"]))
+    ids = [document["id"] for document in uploaded]
+    # Identical chunks are only indexed once
+    assert len(ids) == 3
+    assert all(id.startswith("file-foo_pdf-666F6F2E706466-") for id in ids)
+
+    # Editing the first chunk keeps the ids of the other chunks
+    uploaded.clear()
+    await manager.update_content(sections(["edited", "second", "third"]))
+    assert [document["id"] for document in uploaded][1:] == ids[1:]
+
+    # Only the changed chunks are uploaded when the indexed chunks are known, and the others are stale
+    search_results = AsyncSearchResultsIterator(
+        [{"id": id} for id in ids] + [{"id": "file-foo_pdf-666F6F2E706466-page-0"}, {"id": "file-other"}]
+    )
+
+    async def mock_search(self, *args, **kwargs):
+        assert kwargs.get("filter") == "sourcefile eq 'foo.pdf'"
+        return search_results
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    deleted_documents = []
+
+    async def mock_delete_documents(self, documents):
+        deleted_documents.extend(documents)
+        return documents
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    indexed_chunks = await manager.get_indexed_chunks(file)
+    assert indexed_chunks.existing_ids == set(ids) | {"file-foo_pdf-666F6F2E706466-page-0"}
+    uploaded.clear()
+    await manager.update_content(sections(["edited", "second", "third"]), indexed_chunks=indexed_chunks)
+    assert [document["content"] for document in uploaded] == ["edited"]
+
+    await manager.remove_stale_chunks(indexed_chunks)
+    assert sorted(document["id"] for document in deleted_documents) == sorted(
+        [ids[0], "file-foo_pdf-666F6F2E706466-page-0"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_content_content_hash_ids_page_images(monkeypatch, search_info):
+    uploaded = []
+
+    async def mock_upload_documents(self, documents):
+        uploaded.extend(documents)
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manager = SearchManager(search_info, use_content_hash_ids=True, search_images=True)
+
+    test_io = io.BytesIO(b"test page")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+    sections = [
+        Section(split_page=SplitPage(page_num=0, text="first"), content=file),
+        Section(split_page=SplitPage(page_num=1, text="second"), content=file),
+    ]
+
+    await manager.update_content(sections, [[0.1], [0.2]], image_hashes=["page-0", "page-1"])
+    ids = [document["id"] for document in uploaded]
+    assert [document["imageEmbedding"] for document in uploaded] == [[0.1], [0.2]]
+
+    # A new image of the second page changes its id, even though its text is the same
+    uploaded.clear()
+    await manager.update_content(sections, [[0.1], [0.3]], image_hashes=["page-0", "page-1-edited"])
+    new_ids = [document["id"] for document in uploaded]
+    assert new_ids[0] == ids[0]
+    assert new_ids[1] != ids[1]
+
+
+@pytest.mark.asyncio
+async def test_get_indexed_chunks_positional_ids(search_info):
+    manager = SearchManager(search_info)
+    test_io = io.BytesIO(b"test page")
+    test_io.name = "test/foo.pdf"
+    assert await manager.get_indexed_chunks(File(test_io)) is None
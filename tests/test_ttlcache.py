@@ -0,0 +1,56 @@
+import pytest
+
+from core.ttlcache import TTLCache
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = MockClock()
+    monkeypatch.setattr("core.ttlcache.time.monotonic", clock)
+    return clock
+
+
+def test_ttl_cache_expiry(clock):
+    cache: TTLCache[str, int] = TTLCache(ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=30)
+    assert cache.get("a") == 1
+    clock.now = 10
+    # Entries expire after the ttl of the cache, unless they were given their own
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    clock.now = 30
+    assert cache.get("b") is None
+    assert len(cache) == 0
+    assert cache.hits == 2
+    assert cache.misses == 2
+
+
+def test_ttl_cache_eviction(clock):
+    cache: TTLCache[str, int] = TTLCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_remove_where(clock):
+    cache: TTLCache[tuple[str, str], bool] = TTLCache()
+    cache.set(("OID_X", "a.pdf"), True)
+    cache.set(("OID_X", "b.pdf"), False)
+    cache.set(("OID_Y", "a.pdf"), True)
+    assert cache.remove_where(lambda key: key[0] == "OID_X") == 2
+    assert cache.get(("OID_X", "a.pdf")) is None
+    assert cache.get(("OID_Y", "a.pdf")) is True
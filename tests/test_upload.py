@@ -227,7 +227,7 @@ async def test_delete_uploaded(auth_client, monkeypatch, mock_data_lake_service_
         "/delete_uploaded", headers={"Authorization": "Bearer test"}, json={"filename": "a's doc.txt"}
     )
     assert response.status_code == 200
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert len(searched_filters) == 1, "It should have searched once, since all the keys fit in one search"
     assert searched_filters[0] == "sourcefile eq 'a''s doc.txt'"
     assert len(deleted_documents) == 1, "It should have only deleted the document solely owned by OID_X"
     assert deleted_documents[0]["id"] == "file-a_txt-7465737420646F63756D656E742E706466"